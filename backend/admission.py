@@ -0,0 +1,177 @@
+"""对话请求准入控制
+
+限制同时执行的图运行数量，避免少数用户的并发请求占满数据库连接池和LLM服务的限流额度：
+- 全局并发上限 Config.ADMISSION_MAX_CONCURRENT，超出时进入有界等待队列（Config.ADMISSION_QUEUE_SIZE）；
+- 每个用户同时执行和排队的请求数上限 Config.ADMISSION_MAX_PER_USER，超出时直接拒绝；
+- 队列按优先级出队，交互式的流式请求优先于非流式请求，同优先级先进先出；
+- 排队超过 Config.ADMISSION_QUEUE_TIMEOUT 秒、队列已满或超出用户上限时返回429，
+  Retry-After 按近期请求的平均耗时和排队长度估算。
+
+所有状态只在事件循环线程中修改，不需要加锁；多进程部署时各进程独立限流。
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import time
+from collections import defaultdict
+from fastapi import HTTPException, status
+from fastapi.responses import StreamingResponse
+from utils.config import Config
+from utils.metrics import format_header, format_sample, registry
+
+logger = logging.getLogger(__name__)
+
+# 优先级，数值越小越先出队
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+
+admission_rejections = registry.counter(
+    "admission_rejected_total", "Chat requests rejected by admission control", ["reason"]
+)
+admission_wait = registry.histogram("admission_wait_ms", "Time chat requests spent queued for admission",
+                                    ["priority"])
+
+
+class Permit:
+    """一次准入许可，release 可重复调用"""
+
+    def __init__(self, controller: "AdmissionController", user_id: str):
+        self.controller = controller
+        self.user_id = user_id
+        self.started_at = time.monotonic()
+        self.released = False
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.controller._release(self)
+
+
+class AdmissionController:
+    def __init__(self, max_concurrent: int = Config.ADMISSION_MAX_CONCURRENT,
+                 max_per_user: int = Config.ADMISSION_MAX_PER_USER,
+                 max_queue: int = Config.ADMISSION_QUEUE_SIZE,
+                 queue_timeout: float = Config.ADMISSION_QUEUE_TIMEOUT):
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        # user_id -> 执行中和排队中的请求数
+        self._per_user = defaultdict(int)
+        # 等待队列，元素为 [priority, seq, future, user_id]
+        self._waiters = []
+        self._seq = itertools.count()
+        # 近期请求平均耗时（秒），用于估算 Retry-After
+        self._avg_duration = 5.0
+
+    def _retry_after(self) -> int:
+        return max(1, math.ceil(self._avg_duration * (len(self._waiters) + 1) / max(1, self.max_concurrent)))
+
+    def _reject(self, reason: str, detail: str) -> HTTPException:
+        admission_rejections.inc(reason=reason)
+        logger.warning(f"Chat request rejected by admission control: {reason}")
+        return HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=detail,
+            headers={"Retry-After": str(self._retry_after())},
+        )
+
+    async def acquire(self, user_id: str, priority: int = PRIORITY_BATCH) -> Permit:
+        """获取执行许可，无法在排队超时前获得许可时抛出429"""
+        if self.max_concurrent <= 0:
+            return Permit(self, user_id)
+        if self.max_per_user > 0 and self._per_user[user_id] >= self.max_per_user:
+            raise self._reject("per_user", "您的并发请求过多，请等待当前回复完成后重试")
+        if self.active < self.max_concurrent and not self._waiters:
+            self._per_user[user_id] += 1
+            self.active += 1
+            return Permit(self, user_id)
+        if len(self._waiters) >= self.max_queue:
+            raise self._reject("queue_full", "服务繁忙，请稍后重试")
+
+        self._per_user[user_id] += 1
+        future = asyncio.get_running_loop().create_future()
+        entry = [priority, next(self._seq), future, user_id]
+        heapq.heappush(self._waiters, entry)
+        queued_at = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if not future.done():
+                self._dequeue(entry)
+                self._release_user(user_id)
+                raise self._reject("timeout", "服务繁忙，排队超时，请稍后重试")
+        except asyncio.CancelledError:
+            # 客户端在排队期间断开
+            if future.done():
+                Permit(self, user_id).release()
+            else:
+                self._dequeue(entry)
+                self._release_user(user_id)
+            raise
+        finally:
+            admission_wait.observe((time.monotonic() - queued_at) * 1000, priority=priority)
+        return Permit(self, user_id)
+
+    def _dequeue(self, entry: list) -> None:
+        self._waiters.remove(entry)
+        heapq.heapify(self._waiters)
+
+    def _release_user(self, user_id: str) -> None:
+        self._per_user[user_id] -= 1
+        if self._per_user[user_id] <= 0:
+            del self._per_user[user_id]
+
+    def _release(self, permit: Permit) -> None:
+        if self.max_concurrent <= 0:
+            return
+        duration = time.monotonic() - permit.started_at
+        self._avg_duration = 0.9 * self._avg_duration + 0.1 * duration
+        self._release_user(permit.user_id)
+        self.active -= 1
+        # 按优先级唤醒等待中的请求，许可直接转交，不经过空闲状态
+        while self._waiters and self.active < self.max_concurrent:
+            _, _, future, _ = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self.active += 1
+            future.set_result(True)
+
+    def stats(self) -> dict:
+        return {"active": self.active, "waiting": len(self._waiters), "max_concurrent": self.max_concurrent}
+
+
+class PermitStreamingResponse(StreamingResponse):
+    """持有准入许可的流式响应，整个响应结束后释放许可。
+
+    许可在 __call__ 的 finally 中释放，而不是在响应体生成器中：客户端在响应开始发送前断开时
+    （发送响应头出错或任务被取消），生成器从未开始执行，其 finally 不会运行。
+    """
+
+    def __init__(self, content, permit: Permit, **kwargs):
+        super().__init__(content, **kwargs)
+        self.permit = permit
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.permit.release()
+
+
+admission_controller = AdmissionController()
+
+
+def collect_admission_metrics() -> list:
+    stats = admission_controller.stats()
+    lines = format_header("admission_active", "Chat requests currently admitted", "gauge")
+    lines.append(format_sample("admission_active", stats["active"]))
+    lines.extend(format_header("admission_waiting", "Chat requests waiting for admission", "gauge"))
+    lines.append(format_sample("admission_waiting", stats["waiting"]))
+    return lines
+
+
+registry.register_collector(collect_admission_metrics)
@@ -1,10 +1,20 @@
+import asyncio
+import hashlib
+import ipaddress
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
 from passlib.context import CryptContext
-from fastapi import HTTPException, status, Depends
+from fastapi import HTTPException, Request, status, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 import os
+from utils.cache import LocalTTLCache
+from utils.config import Config
+from utils.metrics import format_header, format_sample, registry
 
 # JWT配置
 SECRET_KEY = os.getenv("JWT_SECRET_KEY", "your-secret-key")
@@ -24,6 +34,163 @@ def get_password_hash(password):
     return pwd_context.hash(password)
 
 
+class PasswordHasher:
+    """在独立的有界线程池中执行 bcrypt 哈希与校验，避免阻塞事件循环。
+
+    bcrypt 计算期间会释放GIL，线程池即可并行；排队和执行中的任务数超过 max_pending 时
+    直接返回503，登录/注册高峰不会拖慢同一进程中的流式对话。
+    """
+
+    def __init__(self, max_workers: int = Config.PASSWORD_HASH_WORKERS,
+                 max_pending: int = Config.PASSWORD_HASH_MAX_PENDING):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="password-hash")
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait_time = 0.0
+        self.total_run_time = 0.0
+
+    async def _submit(self, fn, *args):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="服务繁忙，请稍后重试")
+            self.pending += 1
+        submitted_at = time.perf_counter()
+
+        def task():
+            started_at = time.perf_counter()
+            with self._lock:
+                self.running += 1
+            try:
+                return fn(*args)
+            finally:
+                finished_at = time.perf_counter()
+                with self._lock:
+                    self.running -= 1
+                    self.completed += 1
+                    self.total_wait_time += started_at - submitted_at
+                    self.total_run_time += finished_at - started_at
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, task)
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self._submit(get_password_hash, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._submit(verify_password, plain_password, hashed_password)
+
+    def stats(self) -> dict:
+        """线程池的排队与耗时统计"""
+        with self._lock:
+            return {
+                "queued": self.pending - self.running,
+                "running": self.running,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "avg_wait_ms": self.total_wait_time / self.completed * 1000 if self.completed else 0.0,
+                "avg_run_ms": self.total_run_time / self.completed * 1000 if self.completed else 0.0,
+                "wait_seconds_total": self.total_wait_time,
+                "run_seconds_total": self.total_run_time,
+            }
+
+
+class LoginRateLimiter:
+    """按IP的滑动窗口登录限流，仅在进程内生效，max_attempts 为0时不限流"""
+
+    def __init__(self, max_attempts: int = Config.LOGIN_RATE_LIMIT, window: int = Config.LOGIN_RATE_LIMIT_WINDOW,
+                 max_clients: int = 10000):
+        self.max_attempts = max_attempts
+        self.window = window
+        self.max_clients = max_clients
+        # ip -> 时间窗口内的尝试时间
+        self._attempts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check(self, client_ip: str) -> None:
+        """记录一次登录尝试，超出限制时抛出429"""
+        if self.max_attempts <= 0:
+            return
+        now = time.monotonic()
+        with self._lock:
+            attempts = self._attempts.get(client_ip)
+            if attempts is None:
+                attempts = self._attempts[client_ip] = deque()
+            self._attempts.move_to_end(client_ip)
+            while attempts and attempts[0] <= now - self.window:
+                attempts.popleft()
+            if len(attempts) >= self.max_attempts:
+                retry_after = int(attempts[0] + self.window - now) + 1
+                raise HTTPException(
+                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                    detail="登录尝试过于频繁，请稍后重试",
+                    headers={"Retry-After": str(retry_after)},
+                )
+            attempts.append(now)
+            while len(self._attempts) > self.max_clients:
+                self._attempts.popitem(last=False)
+
+
+def _is_trusted_proxy(address: str, trusted_networks: list) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in trusted_networks)
+
+
+_trusted_proxies = [ipaddress.ip_network(p, strict=False) for p in Config.TRUSTED_PROXIES]
+
+
+def client_ip(request: Request) -> str:
+    """客户端IP：直连地址为 Config.TRUSTED_PROXIES 中的代理时，取 X-Forwarded-For 中最右侧的非代理地址，
+    没有时取 X-Real-IP；其他情况忽略这两个请求头，避免客户端伪造"""
+    peer = request.client.host if request.client else "unknown"
+    if not _is_trusted_proxy(peer, _trusted_proxies):
+        return peer
+    forwarded = [ip.strip() for ip in request.headers.get("x-forwarded-for", "").split(",") if ip.strip()]
+    for address in reversed(forwarded):
+        if not _is_trusted_proxy(address, _trusted_proxies):
+            return address
+    return request.headers.get("x-real-ip", "").strip() or peer
+
+
+password_hasher = PasswordHasher()
+login_rate_limiter = LoginRateLimiter()
+
+
+def collect_password_hash_metrics() -> list:
+    stats = password_hasher.stats()
+    lines = []
+    for name, key, documentation, metric_type in (
+        ("password_hash_queued", "queued", "Password hash tasks waiting for a worker thread", "gauge"),
+        ("password_hash_running", "running", "Password hash tasks currently running", "gauge"),
+        ("password_hash_completed_total", "completed", "Completed password hash tasks", "counter"),
+        ("password_hash_rejected_total", "rejected", "Password hash tasks rejected because the queue was full",
+         "counter"),
+        ("password_hash_wait_seconds_total", "wait_seconds_total", "Total time password hash tasks spent queued",
+         "counter"),
+        ("password_hash_run_seconds_total", "run_seconds_total", "Total time spent hashing or verifying passwords",
+         "counter"),
+    ):
+        lines.extend(format_header(name, documentation, metric_type))
+        lines.append(format_sample(name, stats[key]))
+    return lines
+
+
+registry.register_collector(collect_password_hash_metrics)
+
+# 已验证令牌的缓存始终在进程内：令牌无需跨进程失效，本地 jwt.decode 也比一次 Redis 往返更快
+token_cache = LocalTTLCache()
+
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -41,11 +208,18 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    # 已验证过的令牌直接返回缓存的用户ID，缓存时间不超过令牌的过期时间
+    cache_key = "token:" + hashlib.sha256(credentials.credentials.encode()).hexdigest()
+    user_id = await token_cache.get(cache_key)
+    if user_id is not None:
+        return user_id
     try:
         payload = jwt.decode(credentials.credentials, SECRET_KEY, algorithms=[ALGORITHM])
         user_id: str = payload.get("sub")
         if user_id is None:
             raise credentials_exception
+        ttl = min(Config.AUTH_TOKEN_CACHE_TTL, payload.get("exp", 0) - time.time())
+        await token_cache.set(cache_key, user_id, ttl)
         return user_id
     except JWTError:
         raise credentials_exception
@@ -0,0 +1,205 @@
+"""压测用的模拟模型与工具
+
+不访问任何外部服务，延迟和输出长度可配置，用于在固定条件下对比各项性能改动：
+- FakeChatModel: 模拟 ChatOpenAI，支持 bind_tools、with_structured_output 和流式输出，
+  首个令牌延迟、令牌速率和错误率可配置，并返回 usage_metadata 供令牌统计，多个实例可组成 RoutingChatModel 验证路由；
+- FakeEmbeddings: 模拟 OpenAIEmbeddings，返回与文本对应的固定向量；
+- get_stub_tools: 与 utils.tools_config.get_tools 同名的工具（retrieve/multiply/webSearch/amap_maps），
+  工具路由与真实工具一致。
+"""
+import hashlib
+import itertools
+import json
+import math
+import random
+import time
+from typing import Any, Iterator, List, Optional, get_origin
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import RunnableLambda
+from langchain_core.tools import StructuredTool
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from pydantic import PrivateAttr
+
+# 模拟回复的词表
+_WORDS = ("性能", "测试", "模拟", "回复", "内容", "数据", "分析", "结果", "系统", "响应")
+
+
+def _approx_tokens(messages: List[BaseMessage]) -> int:
+    """按字符数粗略估算输入令牌数"""
+    return max(1, sum(len(str(message.content)) for message in messages) // 2)
+
+
+def _default_value(annotation: Any) -> Any:
+    if annotation is str:
+        return "yes"
+    if annotation in (int, float):
+        return 0
+    if annotation is bool:
+        return True
+    if get_origin(annotation) in (list, List):
+        return []
+    return None
+
+
+class FakeChatModel(BaseChatModel):
+    """延迟可控的模拟聊天模型。
+
+    绑定了工具且本轮尚未调用过工具时，按 tool_call_ratio 的概率返回工具调用（各工具轮流），
+    tool_choice 强制调用工具时（如经路由的结构化输出）总是返回工具调用，否则返回 response_tokens 个令牌的文本回复。
+    每次调用在首个令牌延迟之后按 error_rate 的概率抛出异常。
+    """
+
+    first_token_latency: float = 0.3
+    tokens_per_second: float = 50.0
+    response_tokens: int = 100
+    tool_call_ratio: float = 0.5
+    structured_latency: float = 0.1
+    error_rate: float = 0.0
+    seed: Optional[int] = None
+
+    _random: random.Random = PrivateAttr(default=None)
+    _tool_cycle: Any = PrivateAttr(default=None)
+
+    def model_post_init(self, __context: Any) -> None:
+        self._random = random.Random(self.seed)
+        self._tool_cycle = itertools.count()
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def bind_tools(self, tools, **kwargs):
+        return self.bind(tools=[convert_to_openai_tool(tool) for tool in tools], **kwargs)
+
+    def with_structured_output(self, schema, **kwargs):
+        def respond(_):
+            time.sleep(self.structured_latency)
+            return schema(**{name: _default_value(field.annotation) for name, field in schema.model_fields.items()})
+        return RunnableLambda(respond)
+
+    def _maybe_fail(self) -> None:
+        if self.error_rate and self._random.random() < self.error_rate:
+            raise RuntimeError("模拟LLM服务错误")
+
+    def _should_call_tool(self, messages: List[BaseMessage], tools: Optional[list], tool_choice: Any = None) -> bool:
+        if not tools:
+            return False
+        if tool_choice not in (None, "auto", "none"):
+            return True
+        # 最后一条用户消息之后已有工具结果时直接回答
+        for message in reversed(messages):
+            if isinstance(message, ToolMessage):
+                return False
+            if isinstance(message, HumanMessage):
+                break
+        return self._random.random() < self.tool_call_ratio
+
+    def _tool_call(self, tools: list, forced: bool = False) -> dict:
+        function = tools[next(self._tool_cycle) % len(tools)]["function"]
+        properties = function.get("parameters", {}).get("properties", {})
+        # 强制调用时按结构化输出填充（与 with_structured_output 的默认值一致）
+        text = "yes" if forced else "压测查询"
+        args = {name: 2 if spec.get("type") in ("number", "integer") else text for name, spec in properties.items()}
+        return {"name": function["name"], "args": args, "id": f"call_{self._random.getrandbits(48):x}"}
+
+    def _response_text(self) -> List[str]:
+        return [self._random.choice(_WORDS) for _ in range(self.response_tokens)]
+
+    def _usage(self, messages: List[BaseMessage], output_tokens: int) -> dict:
+        input_tokens = _approx_tokens(messages)
+        return {"input_tokens": input_tokens, "output_tokens": output_tokens,
+                "total_tokens": input_tokens + output_tokens}
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        tools, tool_choice = kwargs.get("tools"), kwargs.get("tool_choice")
+        if self._should_call_tool(messages, tools, tool_choice):
+            time.sleep(self.first_token_latency)
+            self._maybe_fail()
+            message = AIMessage(content="", tool_calls=[self._tool_call(tools, tool_choice not in (None, "auto", "none"))],
+                                usage_metadata=self._usage(messages, 20))
+        else:
+            tokens = self._response_text()
+            time.sleep(self.first_token_latency)
+            self._maybe_fail()
+            time.sleep(len(tokens) / self.tokens_per_second)
+            message = AIMessage(content="".join(tokens), usage_metadata=self._usage(messages, len(tokens)))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        tools, tool_choice = kwargs.get("tools"), kwargs.get("tool_choice")
+        time.sleep(self.first_token_latency)
+        self._maybe_fail()
+        if self._should_call_tool(messages, tools, tool_choice):
+            tool_call = self._tool_call(tools, tool_choice not in (None, "auto", "none"))
+            yield ChatGenerationChunk(message=AIMessageChunk(
+                content="",
+                tool_call_chunks=[{"name": tool_call["name"], "args": json.dumps(tool_call["args"], ensure_ascii=False),
+                                   "id": tool_call["id"], "index": 0}],
+                usage_metadata=self._usage(messages, 20)))
+            return
+        tokens = self._response_text()
+        interval = 1 / self.tokens_per_second
+        for index, token in enumerate(tokens):
+            if index:
+                time.sleep(interval)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=self._usage(messages, len(tokens))))
+
+
+class FakeEmbeddings(Embeddings):
+    """返回确定性单位向量的模拟嵌入模型，每次调用耗时 latency + 每条文本 per_text_latency 秒"""
+
+    def __init__(self, dimensions: int = 1536, latency: float = 0.05, per_text_latency: float = 0.002):
+        self.dimensions = dimensions
+        self.latency = latency
+        self.per_text_latency = per_text_latency
+
+    def _vector(self, text: str) -> List[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "big")
+        rng = random.Random(seed)
+        vector = [rng.gauss(0, 1) for _ in range(self.dimensions)]
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        time.sleep(self.latency + self.per_text_latency * len(texts))
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        time.sleep(self.latency + self.per_text_latency)
+        return self._vector(text)
+
+
+def get_stub_tools(latency: float = 0.2) -> list:
+    """与真实工具同名、固定耗时的模拟工具"""
+    def retrieve(query: str) -> str:
+        time.sleep(latency)
+        return "健康档案：身高175cm，体重70kg，血压正常，无过敏史。" * 5
+
+    def multiply(a: float, b: float) -> float:
+        time.sleep(latency)
+        return a * b
+
+    def webSearch(query: str) -> str:
+        time.sleep(latency)
+        return f"关于“{query}”的搜索结果：" + "相关网页摘要。" * 20
+
+    def amap_maps(query: str) -> str:
+        time.sleep(latency)
+        return f"关于“{query}”的地图查询结果：驾车约25分钟，距离12公里。"
+
+    return [
+        StructuredTool.from_function(retrieve, description="这是健康档案查询工具，搜索并返回有关用户的健康档案信息。"),
+        StructuredTool.from_function(multiply, description="这是计算两个数的乘积的工具，返回最终的计算结果"),
+        StructuredTool.from_function(webSearch, description="web搜索互联网信息查询, 搜索资料"),
+        StructuredTool.from_function(amap_maps, description="地图查询工具"),
+    ]
@@ -0,0 +1,217 @@
+"""热点函数微基准
+
+对每次请求或每次文档入库都会执行的函数使用合成的大输入计时：
+- 文档切分：sent_tokenize、split_text（10MB 文本），extract_text_from_pdf（需通过 --pdf 指定文件）；
+- 响应格式化：format_response（大量代码块 / 1MB 纯文本）；
+- 图路由：filter_messages、get_latest_question、route_after_tools（10k 条消息的状态，以工具结果结尾；
+  route_after_tools 每次计时调用 ROUTE_CALLS 次）。
+
+每个用例重复执行 --repeat 次，取中位数。--save 将结果写入基线文件（默认 benchmarks/micro_baseline.json），
+与 --only 同时使用时只更新运行的用例、保留其余用例的基线。之后的运行与基线对比，
+任一用例的中位数超过基线的 (1 + --tolerance) 倍时以退出码 1 结束，便于在CI中发现性能回退。
+基线与机器相关，更换运行环境后需重新保存。
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "micro_baseline.json")
+
+_SENTENCE = "患者近期血压控制平稳，建议继续保持低盐饮食并规律运动。"
+_CODE_BLOCK = "```python\ndef add(a, b):\n    return a + b\n```"
+# route_after_tools 用例每次计时内的调用次数
+ROUTE_CALLS = 1000
+
+
+def synthetic_text(size_bytes: int) -> str:
+    """生成约 size_bytes 字节（UTF-8）的中文文本"""
+    repeat = max(1, size_bytes // len(_SENTENCE.encode("utf-8")))
+    return _SENTENCE * repeat
+
+
+def synthetic_paragraphs(size_bytes: int, paragraph_sentences: int = 20) -> List[str]:
+    paragraph = _SENTENCE * paragraph_sentences
+    return [paragraph] * max(1, size_bytes // len(paragraph.encode("utf-8")))
+
+
+def synthetic_response(code_blocks: int) -> str:
+    """生成包含 code_blocks 个代码块、段落与代码交替的模型回复"""
+    parts = []
+    for i in range(code_blocks):
+        parts.append(f"第{i}步说明. 先定义函数. 然后调用它. 最后检查结果.")
+        parts.append(f"示例代码如下 {_CODE_BLOCK} 以上是代码.")
+    return "\n\n".join(parts)
+
+
+def synthetic_messages(count: int, human_at_start: bool = True) -> list:
+    """生成 count 条消息：AI/工具消息交替，用户消息只在开头（get_latest_question 的最坏情况），
+    最后一条总是 retrieve 工具的结果，使 route_after_tools 走完工具名查找和路由表"""
+    from langchain_core.messages import AIMessage, HumanMessage, ToolMessage
+    messages = [HumanMessage(content="请帮我查询健康档案")] if human_at_start else []
+    remaining = count - len(messages)
+    for i in range(remaining):
+        if (remaining - i) % 2:
+            messages.append(ToolMessage(content=_SENTENCE, tool_call_id=f"call_{i}", name="retrieve"))
+        else:
+            messages.append(AIMessage(content=_SENTENCE))
+    return messages
+
+
+def build_cases(scale: float, pdf: Optional[str]) -> Dict[str, Callable[[], Callable[[], object]]]:
+    """用例名 -> 准备函数，准备函数生成输入并返回待计时的无参函数"""
+    text_size = int(10 * 1024 * 1024 * scale)
+    message_count = max(2, int(10_000 * scale))
+
+    def sent_tokenize_case():
+        from utils.pdfSplitTest_Ch import sent_tokenize
+        text = synthetic_text(text_size)
+        return lambda: sent_tokenize(text)
+
+    def split_text_case():
+        from utils.pdfSplitTest_Ch import split_text
+        paragraphs = synthetic_paragraphs(text_size)
+        return lambda: split_text(paragraphs, 800, 200)
+
+    def extract_text_from_pdf_case():
+        from utils.pdfSplitTest_Ch import extract_text_from_pdf
+        return lambda: extract_text_from_pdf(pdf, None, 1)
+
+    def format_response_code_blocks_case():
+        from utils.formatter import format_response
+        response = synthetic_response(max(1, int(2000 * scale)))
+        return lambda: format_response(response)
+
+    def format_response_plain_case():
+        from utils.formatter import format_response
+        response = "\n\n".join(["Sentence one. Sentence two. Sentence three."] * max(1, int(25_000 * scale)))
+        return lambda: format_response(response)
+
+    def filter_messages_case():
+        from ragAgent import filter_messages
+        messages = synthetic_messages(message_count)
+        return lambda: filter_messages(messages)
+
+    def get_latest_question_case():
+        from ragAgent import get_latest_question
+        state = {"messages": synthetic_messages(message_count)}
+        return lambda: get_latest_question(state)
+
+    def route_after_tools_case():
+        from benchmarks.fakes import get_stub_tools
+        from ragAgent import ToolConfig, route_after_tools
+        tool_config = ToolConfig(get_stub_tools(latency=0))
+        state = {"messages": synthetic_messages(message_count)}
+        if route_after_tools(state, tool_config) == "generate":
+            raise RuntimeError("route_after_tools 用例应经过工具路由表，而不是回退到 generate")
+
+        # 单次路由只需微秒级，重复执行以获得稳定的计时
+        def route():
+            for _ in range(ROUTE_CALLS):
+                route_after_tools(state, tool_config)
+        return route
+
+    cases = {
+        "chunking.sent_tokenize": sent_tokenize_case,
+        "chunking.split_text": split_text_case,
+        "format.format_response_code_blocks": format_response_code_blocks_case,
+        "format.format_response_plain": format_response_plain_case,
+        "graph.filter_messages": filter_messages_case,
+        "graph.get_latest_question": get_latest_question_case,
+        "graph.route_after_tools": route_after_tools_case,
+    }
+    if pdf:
+        cases["chunking.extract_text_from_pdf"] = extract_text_from_pdf_case
+    return cases
+
+
+@contextmanager
+def quiet_logs(*names: str):
+    """计时期间只输出警告以上的日志，避免用例测到的是日志写入而不是被测函数"""
+    loggers = [logging.getLogger(name) for name in names]
+    levels = [logger.level for logger in loggers]
+    for logger in loggers:
+        logger.setLevel(logging.WARNING)
+    try:
+        yield
+    finally:
+        for logger, level in zip(loggers, levels):
+            logger.setLevel(level)
+
+
+def measure(fn: Callable[[], object], repeat: int) -> Tuple[float, float]:
+    """执行 repeat 次，返回 (中位数, 最小值)，单位秒"""
+    timings = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - started_at)
+    return statistics.median(timings), min(timings)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="热点函数微基准")
+    parser.add_argument("--repeat", type=int, default=5, help="每个用例的执行次数")
+    parser.add_argument("--scale", type=float, default=1.0, help="输入规模系数，1.0 为 10MB 文本 / 10k 条消息")
+    parser.add_argument("--only", nargs="*", help="只运行名称包含这些关键字的用例")
+    parser.add_argument("--pdf", help="extract_text_from_pdf 用例使用的PDF文件")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="基线文件")
+    parser.add_argument("--save", action="store_true", help="将本次结果保存为基线")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="允许的相对基线的变慢比例")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    cases = build_cases(args.scale, args.pdf)
+    if args.only:
+        cases = {name: case for name, case in cases.items() if any(key in name for key in args.only)}
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("scale") != args.scale:
+            print(f"基线的输入规模为 {baseline.get('scale')}，与本次 {args.scale} 不同，跳过对比")
+            baseline = {}
+
+    results = {}
+    regressions = []
+    for name, case in cases.items():
+        fn = case()
+        with quiet_logs("ragAgent"):
+            median, best = measure(fn, args.repeat)
+        results[name] = {"median_s": round(median, 6), "min_s": round(best, 6)}
+        line = f"{name:<38} median={median * 1000:>10.2f}ms min={best * 1000:>10.2f}ms"
+        previous = baseline.get("results", {}).get(name)
+        if previous and not args.save:
+            ratio = median / previous["median_s"] if previous["median_s"] else 1.0
+            line += f"  baseline={previous['median_s'] * 1000:>10.2f}ms ({ratio - 1:+.1%})"
+            if ratio > 1 + args.tolerance:
+                regressions.append(name)
+                line += "  REGRESSION"
+        print(line)
+
+    if args.save:
+        # 只更新本次运行的用例（如 --only），其余用例保留原有基线；输入规模不同时整体替换
+        merged = {**baseline.get("results", {}), **results}
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"scale": args.scale, "repeat": args.repeat, "results": dict(sorted(merged.items()))}, f,
+                      indent=2)
+            f.write("\n")
+        print(f"基线已保存到 {args.baseline}")
+    if regressions:
+        print(f"{len(regressions)} 个用例超过基线 {args.tolerance:.0%} 以上: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,321 @@
+"""LangGraph 检查点保留与压缩
+
+PostgresSaver 会为每一轮对话的每个 super-step 写入一条检查点且从不清理，
+本模块负责：
+（1）每个线程只保留最新的 N 条检查点，并删除对应的 pending writes 和不再被引用的 blobs；
+（2）删除已软删除对话（conversations.is_deleted = TRUE）对应线程的全部检查点数据；
+（3）报告清理前后各检查点表及索引的大小。
+
+所有删除都按批次在独立的短事务中执行，并设置 lock_timeout，避免长时间锁住热表。
+
+命令行用法:
+    python checkpoint_retention.py --keep 10 --batch-size 100 --vacuum
+"""
+import argparse
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
+from psycopg_pool import ConnectionPool
+from utils.config import Config
+
+logger = logging.getLogger(__name__)
+
+# PostgresSaver 使用的检查点相关表
+CHECKPOINT_TABLES = ("checkpoints", "checkpoint_blobs", "checkpoint_writes")
+
+
+def format_bytes(num: int) -> str:
+    """将字节数格式化为可读字符串"""
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(num) < 1024:
+            return f"{num:.1f}{unit}"
+        num /= 1024
+    return f"{num:.1f}TB"
+
+
+class CheckpointRetention:
+    def __init__(self, connection_pool: ConnectionPool,
+                 keep_latest: int = Config.CHECKPOINT_KEEP_LATEST,
+                 batch_size: int = Config.CHECKPOINT_RETENTION_BATCH_SIZE,
+                 pause: float = 0.1,
+                 lock_timeout: str = "2s"):
+        self.connection_pool = connection_pool
+        # 每个线程保留的最新检查点数量，至少保留1条以便恢复对话状态
+        self.keep_latest = max(1, keep_latest)
+        self.batch_size = batch_size
+        # 批次之间的休眠时间（秒），给在线请求让出资源
+        self.pause = pause
+        self.lock_timeout = lock_timeout
+
+    def table_sizes(self) -> Dict[str, Dict[str, int]]:
+        """获取检查点表的数据、索引和总大小（字节）"""
+        conn = None
+        try:
+            conn = self.connection_pool.getconn()
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT relname, pg_table_size(oid), pg_indexes_size(oid), pg_total_relation_size(oid)
+                    FROM pg_class
+                    WHERE relkind = 'r' AND relname = ANY(%s)
+                """, (list(CHECKPOINT_TABLES),))
+                return {
+                    row[0]: {"table": row[1], "indexes": row[2], "total": row[3]}
+                    for row in cursor.fetchall()
+                }
+        except Exception as e:
+            logger.error(f"Error getting checkpoint table sizes: {e}")
+            return {}
+        finally:
+            if conn:
+                self.connection_pool.putconn(conn)
+
+    def _run_batch(self, statements: List[tuple]) -> List[int]:
+        """在一个短事务中执行一批删除语句，返回每条语句影响的行数"""
+        conn = None
+        try:
+            conn = self.connection_pool.getconn()
+            with conn.transaction():
+                with conn.cursor() as cursor:
+                    # 拿不到锁时快速失败，跳过该批次而不是阻塞在线请求
+                    cursor.execute(f"SET LOCAL lock_timeout = '{self.lock_timeout}'")
+                    counts = []
+                    for sql, params in statements:
+                        cursor.execute(sql, params)
+                        counts.append(cursor.rowcount)
+                    return counts
+        except Exception as e:
+            logger.warning(f"Checkpoint retention batch skipped: {e}")
+            return [0] * len(statements)
+        finally:
+            if conn:
+                self.connection_pool.putconn(conn)
+
+    def _fetch_threads_over_limit(self, after_thread_id: str) -> List[str]:
+        """按 thread_id 游标分页获取检查点数超过保留数量的线程"""
+        conn = None
+        try:
+            conn = self.connection_pool.getconn()
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT thread_id
+                    FROM checkpoints
+                    WHERE thread_id > %s
+                    GROUP BY thread_id
+                    HAVING count(*) > %s
+                    ORDER BY thread_id
+                    LIMIT %s
+                """, (after_thread_id, self.keep_latest, self.batch_size))
+                return [row[0] for row in cursor.fetchall()]
+        finally:
+            if conn:
+                self.connection_pool.putconn(conn)
+
+    def prune_threads(self) -> Dict[str, int]:
+        """每个线程仅保留最新的 keep_latest 条检查点"""
+        totals = {"threads": 0, "checkpoints": 0, "writes": 0, "blobs": 0}
+        cursor_thread_id = ""
+        while True:
+            thread_ids = self._fetch_threads_over_limit(cursor_thread_id)
+            if not thread_ids:
+                break
+            cursor_thread_id = thread_ids[-1]
+
+            # checkpoint_id 为 uuid6，按字典序即按时间先后排序
+            doomed = """
+                WITH ranked AS (
+                    SELECT thread_id, checkpoint_ns, checkpoint_id,
+                           row_number() OVER (PARTITION BY thread_id, checkpoint_ns
+                                              ORDER BY checkpoint_id DESC) AS rn
+                    FROM checkpoints
+                    WHERE thread_id = ANY(%s)
+                )
+                SELECT thread_id, checkpoint_ns, checkpoint_id FROM ranked WHERE rn > %s
+            """
+            writes, checkpoints, blobs = self._run_batch([
+                (f"""
+                    DELETE FROM checkpoint_writes w
+                    USING ({doomed}) d
+                    WHERE w.thread_id = d.thread_id AND w.checkpoint_ns = d.checkpoint_ns
+                      AND w.checkpoint_id = d.checkpoint_id
+                """, (thread_ids, self.keep_latest)),
+                (f"""
+                    DELETE FROM checkpoints c
+                    USING ({doomed}) d
+                    WHERE c.thread_id = d.thread_id AND c.checkpoint_ns = d.checkpoint_ns
+                      AND c.checkpoint_id = d.checkpoint_id
+                """, (thread_ids, self.keep_latest)),
+                # 删除不再被任何剩余检查点引用的通道数据。线程可能正在写入新检查点：通道数据先于检查点行提交，
+                # 其版本高于所有已提交的检查点，因此只删除版本低于该通道最新引用版本的数据
+                # （版本号为补零的字符串，按字典序即按先后排序）
+                ("""
+                    DELETE FROM checkpoint_blobs b
+                    WHERE b.thread_id = ANY(%s)
+                      AND NOT EXISTS (
+                          SELECT 1 FROM checkpoints c
+                          WHERE c.thread_id = b.thread_id AND c.checkpoint_ns = b.checkpoint_ns
+                            AND c.checkpoint -> 'channel_versions' ->> b.channel = b.version
+                      )
+                      AND b.version < (
+                          SELECT max(c.checkpoint -> 'channel_versions' ->> b.channel) FROM checkpoints c
+                          WHERE c.thread_id = b.thread_id AND c.checkpoint_ns = b.checkpoint_ns
+                      )
+                """, (thread_ids,)),
+            ])
+            totals["threads"] += len(thread_ids)
+            totals["checkpoints"] += checkpoints
+            totals["writes"] += writes
+            totals["blobs"] += blobs
+            time.sleep(self.pause)
+
+        logger.info(f"Pruned checkpoints to latest {self.keep_latest} per thread: {totals}")
+        return totals
+
+    def purge_deleted_conversations(self) -> Dict[str, int]:
+        """删除软删除对话对应线程（thread_id = user_id@@conversation_id）的全部检查点数据
+
+        只扫描仍有检查点的已删除对话，已清理过的对话不会在每次运行时重复删除，
+        运行开销与待清理的线程数相关，而不是随已删除对话的总数增长。
+        """
+        totals = {"threads": 0, "checkpoints": 0, "writes": 0, "blobs": 0}
+        cursor_id = ""
+        while True:
+            conn = None
+            try:
+                conn = self.connection_pool.getconn()
+                with conn.cursor() as cursor:
+                    cursor.execute("""
+                        SELECT id, user_id
+                        FROM conversations cv
+                        WHERE is_deleted = TRUE AND id > %s
+                          AND EXISTS (
+                              SELECT 1 FROM checkpoints c WHERE c.thread_id = cv.user_id || '@@' || cv.id
+                          )
+                        ORDER BY id
+                        LIMIT %s
+                    """, (cursor_id, self.batch_size))
+                    rows = cursor.fetchall()
+            finally:
+                if conn:
+                    self.connection_pool.putconn(conn)
+            if not rows:
+                break
+            cursor_id = rows[-1][0]
+
+            thread_ids = [f"{user_id}@@{conversation_id}" for conversation_id, user_id in rows]
+            writes, blobs, checkpoints = self._run_batch([
+                (f"DELETE FROM {table} WHERE thread_id = ANY(%s)", (thread_ids,))
+                for table in ("checkpoint_writes", "checkpoint_blobs", "checkpoints")
+            ])
+            totals["threads"] += len(thread_ids)
+            totals["checkpoints"] += checkpoints
+            totals["writes"] += writes
+            totals["blobs"] += blobs
+            time.sleep(self.pause)
+
+        logger.info(f"Purged checkpoints of deleted conversations: {totals}")
+        return totals
+
+    def vacuum(self):
+        """对检查点表执行 VACUUM ANALYZE，回收可复用空间（连接需为自动提交模式）"""
+        conn = None
+        try:
+            conn = self.connection_pool.getconn()
+            with conn.cursor() as cursor:
+                for table in CHECKPOINT_TABLES:
+                    cursor.execute(f"VACUUM (ANALYZE) {table}")
+            logger.info("Vacuumed checkpoint tables")
+        except Exception as e:
+            logger.error(f"Error vacuuming checkpoint tables: {e}")
+        finally:
+            if conn:
+                self.connection_pool.putconn(conn)
+
+    def run(self, vacuum: bool = False) -> dict:
+        """执行一次完整的保留策略，返回清理统计和前后表大小"""
+        started = time.time()
+        before = self.table_sizes()
+        deleted = self.purge_deleted_conversations()
+        pruned = self.prune_threads()
+        if vacuum:
+            self.vacuum()
+        after = self.table_sizes()
+        report = {
+            "deleted_conversations": deleted,
+            "pruned": pruned,
+            "sizes_before": before,
+            "sizes_after": after,
+            "elapsed_seconds": round(time.time() - started, 2),
+        }
+        for table in CHECKPOINT_TABLES:
+            b = before.get(table, {}).get("total", 0)
+            a = after.get(table, {}).get("total", 0)
+            logger.info(f"Checkpoint table {table}: {format_bytes(b)} -> {format_bytes(a)}")
+        return report
+
+
+# 周期性执行检查点保留策略，与 monitor_connection_pool 相同采用守护线程
+def start_checkpoint_retention_job(db_connection_pool: ConnectionPool,
+                                   interval: int = Config.CHECKPOINT_RETENTION_INTERVAL,
+                                   retention: Optional[CheckpointRetention] = None):
+    """启动后台检查点清理线程"""
+    retention = retention or CheckpointRetention(db_connection_pool)
+
+    def _job():
+        while not db_connection_pool.closed:
+            time.sleep(interval)
+            if db_connection_pool.closed:
+                break
+            try:
+                retention.run()
+            except Exception as e:
+                logger.error(f"Checkpoint retention job failed: {e}")
+
+    job_thread = threading.Thread(target=_job, daemon=True, name="checkpoint-retention")
+    job_thread.start()
+    return job_thread
+
+
+def print_report(report: dict):
+    """在命令行输出清理报告"""
+    print(f"已删除对话: {report['deleted_conversations']}")
+    print(f"超出保留数量: {report['pruned']}")
+    print(f"{'表名':<20}{'清理前(表/索引)':>28}{'清理后(表/索引)':>28}")
+    for table in CHECKPOINT_TABLES:
+        b = report["sizes_before"].get(table, {})
+        a = report["sizes_after"].get(table, {})
+        before = f"{format_bytes(b.get('table', 0))}/{format_bytes(b.get('indexes', 0))}"
+        after = f"{format_bytes(a.get('table', 0))}/{format_bytes(a.get('indexes', 0))}"
+        print(f"{table:<20}{before:>28}{after:>28}")
+    print(f"耗时: {report['elapsed_seconds']}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LangGraph 检查点保留与压缩")
+    parser.add_argument("--keep", type=int, default=Config.CHECKPOINT_KEEP_LATEST, help="每个线程保留的最新检查点数量")
+    parser.add_argument("--batch-size", type=int, default=Config.CHECKPOINT_RETENTION_BATCH_SIZE, help="每批处理的线程数")
+    parser.add_argument("--pause", type=float, default=0.1, help="批次之间的休眠秒数")
+    parser.add_argument("--vacuum", action="store_true", help="清理后执行 VACUUM ANALYZE")
+    parser.add_argument("--report-only", action="store_true", help="仅报告表大小，不做删除")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    connection_kwargs = {"autocommit": True, "prepare_threshold": 0, "connect_timeout": 5}
+    db_connection_pool = ConnectionPool(conninfo=Config.DB_URI, max_size=2, min_size=1, kwargs=connection_kwargs,
+                                        timeout=10)
+    try:
+        db_connection_pool.open()
+        retention = CheckpointRetention(db_connection_pool, keep_latest=args.keep,
+                                        batch_size=args.batch_size, pause=args.pause)
+        if args.report_only:
+            for table, sizes in retention.table_sizes().items():
+                print(f"{table:<20}表 {format_bytes(sizes['table'])}  索引 {format_bytes(sizes['indexes'])}  "
+                      f"总计 {format_bytes(sizes['total'])}")
+            return
+        print_report(retention.run(vacuum=args.vacuum))
+    finally:
+        db_connection_pool.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""轻量检查点保存器
+
+PostgresSaver 在每个节点（super-step）结束后都会写入一次检查点，检索文档、网络搜索结果等
+工具输出会随 messages 通道被反复序列化。LightweightPostgresSaver 在其基础上提供可配置的
+持久化模式（Config.CHECKPOINT_DURABILITY）：
+
+- sync: 与 PostgresSaver 完全一致，每个 super-step 写入一次；
+- compact: 每个 super-step 写入，但写入前截断过长的工具输出；
+- exit: 一轮对话内的检查点只缓存在内存中，由 flush() 在该轮结束时一次性写入，
+  同样截断过长的工具输出。进程在一轮对话中途崩溃时，该轮的中间状态会丢失。
+"""
+import logging
+import threading
+from typing import Any, Optional, Sequence, Tuple
+from langchain_core.messages import ToolMessage
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.postgres import PostgresSaver
+from utils.config import Config
+
+logger = logging.getLogger(__name__)
+
+DURABILITY_MODES = ("sync", "compact", "exit")
+
+
+class LightweightPostgresSaver(PostgresSaver):
+    def __init__(self, conn, durability: str = Config.CHECKPOINT_DURABILITY,
+                 max_tool_output_chars: int = Config.CHECKPOINT_TOOL_OUTPUT_MAX_CHARS, serde=None):
+        super().__init__(conn, serde=serde)
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"不支持的检查点持久化模式: {durability}. 可用的模式: {list(DURABILITY_MODES)}")
+        self.durability = durability
+        self.max_tool_output_chars = max_tool_output_chars
+        # exit 模式下缓存的检查点，键为 (thread_id, checkpoint_ns)
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+
+    # 截断过长的工具输出，消息ID保持不变，不影响 add_messages 的合并逻辑
+    def _strip_message(self, message: Any) -> Any:
+        if not isinstance(message, ToolMessage):
+            return message
+        content = str(message.content)
+        if len(content) <= self.max_tool_output_chars:
+            return message
+        stripped = f"{content[:self.max_tool_output_chars]}...[已截断，原始长度{len(content)}字符]"
+        return message.model_copy(update={"content": stripped})
+
+    def _strip_value(self, value: Any) -> Any:
+        if isinstance(value, (list, tuple)):
+            return [self._strip_message(item) for item in value]
+        return self._strip_message(value)
+
+    def _strip_checkpoint(self, checkpoint: dict) -> dict:
+        channel_values = checkpoint.get("channel_values") or {}
+        if "messages" not in channel_values:
+            return checkpoint
+        return {
+            **checkpoint,
+            "channel_values": {**channel_values, "messages": self._strip_value(channel_values["messages"])}
+        }
+
+    @staticmethod
+    def _key(config: RunnableConfig) -> tuple:
+        configurable = config["configurable"]
+        return configurable["thread_id"], configurable.get("checkpoint_ns", "")
+
+    def put(self, config: RunnableConfig, checkpoint: dict, metadata: dict, new_versions: dict) -> RunnableConfig:
+        if self.durability == "sync":
+            return super().put(config, checkpoint, metadata, new_versions)
+
+        checkpoint = self._strip_checkpoint(checkpoint)
+        # 手动 update_state 产生的检查点直接落库
+        if self.durability == "compact" or metadata.get("source") == "update":
+            self.flush(config)
+            return super().put(config, checkpoint, metadata, new_versions)
+
+        thread_id, checkpoint_ns = self._key(config)
+        with self._pending_lock:
+            pending = self._pending.get((thread_id, checkpoint_ns))
+            self._pending[(thread_id, checkpoint_ns)] = {
+                # 父检查点始终指向最后一个已落库的检查点
+                "config": pending["config"] if pending else config,
+                "checkpoint": checkpoint,
+                "metadata": metadata,
+                # 合并本轮所有被更新过的通道，落库时写入它们的最终值
+                "new_versions": {**pending["new_versions"], **new_versions} if pending else dict(new_versions),
+                "writes": [],
+            }
+        return {
+            "configurable": {
+                "thread_id": thread_id,
+                "checkpoint_ns": checkpoint_ns,
+                "checkpoint_id": checkpoint["id"],
+            }
+        }
+
+    def put_writes(self, config: RunnableConfig, writes: Sequence[Tuple[str, Any]], task_id: str,
+                   task_path: str = "") -> None:
+        if self.durability != "sync":
+            writes = [
+                (channel, self._strip_value(value) if channel == "messages" else value)
+                for channel, value in writes
+            ]
+        if self.durability == "exit":
+            with self._pending_lock:
+                pending = self._pending.get(self._key(config))
+                # 写入属于尚未落库的检查点时一并缓存，中间步骤的写入会随新检查点被丢弃
+                if pending and pending["checkpoint"]["id"] == config["configurable"].get("checkpoint_id"):
+                    pending["writes"].append((writes, task_id, task_path))
+                    return
+        super().put_writes(config, writes, task_id, task_path)
+
+    def flush(self, config: RunnableConfig) -> Optional[RunnableConfig]:
+        """将线程缓存的最新检查点写入数据库，返回落库后的配置"""
+        thread_id = config["configurable"]["thread_id"]
+        with self._pending_lock:
+            keys = [key for key in self._pending if key[0] == thread_id]
+            pendings = [self._pending.pop(key) for key in keys]
+
+        next_config = None
+        for pending in pendings:
+            checkpoint = pending["checkpoint"]
+            channel_versions = checkpoint["channel_versions"]
+            new_versions = {k: channel_versions[k] for k in pending["new_versions"] if k in channel_versions}
+            next_config = super().put(pending["config"], checkpoint, pending["metadata"], new_versions)
+            for writes, task_id, task_path in pending["writes"]:
+                super().put_writes(next_config, writes, task_id, task_path)
+            logger.debug(f"Flushed buffered checkpoint {checkpoint['id']} for thread {thread_id}")
+        return next_config
+
+    # 读取前先落库缓存的检查点，保证 get_state 及下一轮对话读取到最新状态
+    def get_tuple(self, config: RunnableConfig):
+        if self.durability == "exit":
+            self.flush(config)
+        return super().get_tuple(config)
+
+    def list(self, config: Optional[RunnableConfig], **kwargs):
+        if self.durability == "exit" and config and config.get("configurable", {}).get("thread_id"):
+            self.flush(config)
+        return super().list(config, **kwargs)
+
+
+def flush_checkpoints(graph, config: RunnableConfig) -> None:
+    """一轮对话结束时调用，写入 exit 模式下缓存的检查点"""
+    checkpointer = getattr(graph, "checkpointer", None)
+    if isinstance(checkpointer, LightweightPostgresSaver):
+        try:
+            checkpointer.flush(config)
+        except Exception as e:
+            logger.error(f"Failed to flush checkpoints for thread {config['configurable'].get('thread_id')}: {e}")
@@ -1,11 +1,131 @@
+import base64
+import json
 import uuid
-from typing import Optional
+from datetime import datetime
+from typing import List, Optional, Tuple, Union
 from auth import get_password_hash
-from model import UserInDB, User
+from utils.tracing import traced
 import logging
 
 logger = logging.getLogger(__name__)
 
+# users 表唯一约束的名称（PostgreSQL 默认命名），用于区分注册冲突的字段
+USERNAME_CONSTRAINT = "users_username_key"
+EMAIL_CONSTRAINT = "users_email_key"
+
+# 对话列表中最后一条消息预览的最大长度
+PREVIEW_LENGTH = 30
+
+
+def make_preview(content: str) -> str:
+    """截取消息内容作为对话预览"""
+    if content and len(content) > PREVIEW_LENGTH:
+        return content[:PREVIEW_LENGTH] + "..."
+    return content
+
+
+def encode_cursor(updated_at: datetime, conversation_id: str) -> str:
+    """将 (updated_at, id) 编码为不透明的分页游标"""
+    raw = json.dumps([updated_at.isoformat(), conversation_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    """解析分页游标，格式错误时抛出 ValueError"""
+    try:
+        updated_at, conversation_id = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        return datetime.fromisoformat(updated_at), conversation_id
+    except Exception:
+        raise ValueError("无效的分页游标")
+
+
+def owner_cache_key(conversation_id: str, user_id: str) -> str:
+    """对话归属检查的缓存键"""
+    return f"conv_owner:{conversation_id}:{user_id}"
+
+
+def parse_message_cursor(value: str) -> Union[datetime, str]:
+    """解析消息分页游标：ISO时间戳（支持 Z 后缀）返回 datetime，否则视为消息ID原样返回"""
+    text = value.strip()
+    if not text:
+        raise ValueError("无效的分页游标")
+    try:
+        # Python 3.10 的 fromisoformat 不支持 Z 后缀
+        return datetime.fromisoformat(text[:-1] + "+00:00" if text[-1] in "Zz" else text)
+    except ValueError:
+        return text
+
+
+def message_id_cursors(before: Optional[str], after: Optional[str]) -> List[str]:
+    """before/after 中的消息ID游标，查询前需确认这些消息属于该对话"""
+    cursors = [parse_message_cursor(value) for value in (before, after) if value]
+    return [cursor for cursor in cursors if isinstance(cursor, str)]
+
+
+# 校验消息ID游标的查询
+MESSAGE_CURSOR_EXISTS_QUERY = "SELECT 1 FROM messages WHERE id = %s AND conversation_id = %s"
+
+
+def build_messages_page_query(conversation_id: str, before: Optional[str], after: Optional[str],
+                              limit: Optional[int]) -> Tuple[str, list, str]:
+    """构造消息分页查询，返回 (SQL, 参数, 排序方向)，limit 为 None 时不分页，同步和异步数据访问层共用"""
+    conditions = ["conversation_id = %s"]
+    params = [conversation_id]
+    for value, op in ((before, "<"), (after, ">")):
+        if not value:
+            continue
+        cursor = parse_message_cursor(value)
+        if isinstance(cursor, datetime):
+            # 时间戳游标：严格比较、不含游标时间本身，与游标时间戳相同的其他消息（如并发写入的消息）会被跳过，
+            # 只适合按时间定位；连续翻页应使用消息ID游标
+            conditions.append(f"timestamp {op} %s")
+            params.append(cursor)
+        else:
+            # 消息ID游标：比较 (timestamp, id) 组合键，时间戳相同的消息按ID排序，翻页不重不漏，
+            # 调用方需先用 MESSAGE_CURSOR_EXISTS_QUERY 确认消息存在
+            conditions.append(
+                f"(timestamp, id) {op} (SELECT timestamp, id FROM messages WHERE id = %s AND conversation_id = %s)"
+            )
+            params.extend([cursor, conversation_id])
+    # 指定 after 时向后翻页，否则取最新（或 before 之前）的一页
+    order = "ASC" if after and not before else "DESC"
+    limit_clause = ""
+    if limit is not None:
+        # 多取一条用于判断是否还有更多消息
+        limit_clause = "LIMIT %s"
+        params.append(limit + 1)
+    query = f"""
+        SELECT id, role, content, timestamp
+        FROM messages
+        WHERE {" AND ".join(conditions)}
+        ORDER BY timestamp {order}, id {order}
+        {limit_clause}
+    """
+    return query, params, order
+
+
+def build_conversations_page_query(user_id: str, limit: Optional[int], cursor: Optional[str]) -> Tuple[str, list]:
+    """构造对话列表的游标分页查询，limit 为 None 时返回全部，游标格式错误时抛出 ValueError"""
+    params = [user_id]
+    keyset = ""
+    if cursor:
+        updated_at, conversation_id = decode_cursor(cursor)
+        keyset = "AND (updated_at, id) < (%s, %s)"
+        params.extend([updated_at, conversation_id])
+    limit_clause = ""
+    if limit is not None:
+        # 多取一条用于判断是否还有下一页
+        limit_clause = "LIMIT %s"
+        params.append(limit + 1)
+    query = f"""
+        SELECT id, title, created_at, updated_at, last_message_preview, last_message_at
+        FROM conversations
+        WHERE user_id = %s AND is_deleted = FALSE {keyset}
+        ORDER BY updated_at DESC, id DESC
+        {limit_clause}
+    """
+    return query, params
+
 
 class UserDB:
     def __init__(self, connection_pool):
@@ -36,161 +156,53 @@ class UserDB:
             if conn:
                 self.connection_pool.putconn(conn)
 
-    def get_user_by_username(self, username: str) -> Optional[UserInDB]:
-        """根据用户名获取用户"""
-        conn = None
-        try:
-            conn = self.connection_pool.getconn()
-            with conn.cursor() as cursor:  # 使用普通游标
-                cursor.execute(
-                    "SELECT id, username, email, hashed_password FROM users WHERE username = %s AND is_active = TRUE",
-                    (username,)
-                )
-                result = cursor.fetchone()
-                if result:
-                    # 通过索引访问结果
-                    return UserInDB(
-                        id=result[0],                   # id
-                        username=result[1],             # username
-                        email=result[2],                # email
-                        hashed_password=result[3]       # hashed_password
-                    )
-        except Exception as e:
-            logger.error(f"Error getting user by username: {e}")
-        finally:
-            if conn:
-                self.connection_pool.putconn(conn)
-        return None
-
-    def get_user_by_email(self, email: str) -> Optional[UserInDB]:
-        """根据邮箱获取用户"""
-        conn = None
-        try:
-            conn = self.connection_pool.getconn()
-            with conn.cursor() as cursor:  # 使用普通游标
-                cursor.execute(
-                    "SELECT id, username, hashed_password FROM users WHERE email = %s AND is_active = TRUE",
-                    (email,)
-                )
-                result = cursor.fetchone()
-                if result:
-                    # 通过索引访问结果
-                    return UserInDB(
-                        id=result[0],                   # id
-                        username=result[1],             # username
-                        email=email,                    # email
-                        hashed_password=result[2]       # hashed_password
-                    )
-        except Exception as e:
-            logger.error(f"Error getting user by username: {e}")
-        finally:
-            if conn:
-                self.connection_pool.putconn(conn)
-        return None
+    def import_users(self, users: list) -> dict:
+        """使用COPY批量导入用户，用于迁移已有用户
 
-    def get_user_by_id(self, user_id: str) -> Optional[UserInDB]:
-        """根据用户ID获取用户"""
-        conn = None
-        try:
-            conn = self.connection_pool.getconn()
-            with conn.cursor() as cursor:  # 使用普通游标
-                cursor.execute(
-                    "SELECT id, username, email, hashed_password FROM users WHERE id = %s AND is_active = TRUE",
-                    (user_id,)
-                )
-                result = cursor.fetchone()
-                if result:
-                    # 通过索引访问结果
-                    return UserInDB(
-                        id=result[0],                   # id
-                        username=result[1],             # username
-                        email=result[2],                # email
-                        hashed_password=result[3]       # hashed_password
-                    )
-        except Exception as e:
-            logger.error(f"Error getting user by id: {e}")
-        finally:
-            if conn:
-                self.connection_pool.putconn(conn)
-        return None
-
-    # 添加检查邮箱是否已存在的方法
-    def check_email_exists(self, email: str) -> bool:
-        """检查邮箱是否已注册"""
-        conn = None
-        try:
-            conn = self.connection_pool.getconn()
-            with conn.cursor() as cursor:
-                cursor.execute("SELECT id FROM users WHERE email = %s AND is_active = True", (email,))
-                result = cursor.fetchone()
-                return result is not None
-        except Exception as e:
-            logger.error(f"Error checking email existence: {e}")
-            return False
-        finally:
-            if conn:
-                self.connection_pool.putconn(conn)
-
-    # 添加检查用户名是否已存在的方法
-    def check_username_exists(self, username: str) -> bool:
-        """检查用户名是否已注册"""
-        conn = None
-        try:
-            conn = self.connection_pool.getconn()
-            with conn.cursor() as cursor:
-                cursor.execute("SELECT id FROM users WHERE username = %s AND is_active = True", (username,))
-                result = cursor.fetchone()
-                return result is not None
-        except Exception as e:
-            logger.error(f"Error checking username existence: {e}")
-            return False
-        finally:
-            if conn:
-                self.connection_pool.putconn(conn)
+        Args:
+            users: 用户字典列表，包含 username、email，以及 hashed_password（或明文 password），可选 id。
 
-    # 修改现有的创建用户方法，添加验证
-    def create_user(self, username: str, email: str, password: str):
-        """创建新用户"""
+        Returns:
+            dict: inserted 为导入成功的用户名列表，skipped 为用户名或邮箱已存在而跳过的用户名列表。
+        """
+        if not users:
+            return {"inserted": [], "skipped": []}
         conn = None
         try:
-            # 检查用户名是否已存在
-            if self.check_username_exists(username):
-                raise ValueError("用户名已存在")
-
-            # 检查邮箱是否已存在
-            if self.check_email_exists(email):
-                raise ValueError("邮箱已注册")
-
-            # 生成用户ID和哈希密码
-            user_id = str(uuid.uuid4())
-            hashed_password = get_password_hash(password)
-
             conn = self.connection_pool.getconn()
-            with conn.cursor() as cursor:
-                cursor.execute(
-                    "INSERT INTO users (id, username, email, hashed_password) VALUES (%s, %s, %s, %s) RETURNING id, username, email, created_at",
-                    (user_id, username, email, hashed_password)
-                )
-                result = cursor.fetchone()
-                conn.commit()
-
-                if result:
-                    user = User(
-                        id=result[0],
-                        username=result[1],
-                        email=result[2],
-                        created_at=result[3]
-                    )
-                    logger.info(f"User created successfully: {username}")
-                    return user
-                else:
-                    raise ValueError("用户创建失败")
-        except ValueError as ve:
-            # 重新抛出验证错误
-            raise ve
+            with conn.transaction():
+                with conn.cursor() as cursor:
+                    # 先COPY到临时表，再一次性插入，重复的用户名/邮箱由唯一约束跳过
+                    cursor.execute("""
+                        CREATE TEMP TABLE users_import (
+                            id VARCHAR(36),
+                            username VARCHAR(50),
+                            email VARCHAR(100),
+                            hashed_password VARCHAR(255)
+                        ) ON COMMIT DROP
+                    """)
+                    with cursor.copy("COPY users_import (id, username, email, hashed_password) FROM STDIN") as copy:
+                        for user in users:
+                            copy.write_row((
+                                user.get("id") or str(uuid.uuid4()),
+                                user["username"],
+                                user["email"],
+                                user.get("hashed_password") or get_password_hash(user["password"]),
+                            ))
+                    cursor.execute("""
+                        INSERT INTO users (id, username, email, hashed_password)
+                        SELECT id, username, email, hashed_password FROM users_import
+                        ON CONFLICT DO NOTHING
+                        RETURNING username
+                    """)
+                    inserted = [row[0] for row in cursor.fetchall()]
+            inserted_set = set(inserted)
+            skipped = [user["username"] for user in users if user["username"] not in inserted_set]
+            logger.info(f"Imported {len(inserted)} users, skipped {len(skipped)} existing users")
+            return {"inserted": inserted, "skipped": skipped}
         except Exception as e:
-            logger.error(f"Error creating user: {e}")
-            raise ValueError("用户注册失败，请稍后重试")
+            logger.error(f"Error importing users: {e}")
+            raise
         finally:
             if conn:
                 self.connection_pool.putconn(conn)
@@ -249,6 +261,41 @@ class ConversationDB:
                         # 其他异常则抛出
                         raise
 
+                # 对话的滚动摘要列，由后台摘要任务维护
+                cursor.execute("ALTER TABLE conversations ADD COLUMN IF NOT EXISTS summary TEXT")
+
+                # 冗余存储最后一条消息的预览和时间，对话列表无需再关联 messages 表
+                cursor.execute("ALTER TABLE conversations ADD COLUMN IF NOT EXISTS last_message_preview TEXT")
+                cursor.execute("ALTER TABLE conversations ADD COLUMN IF NOT EXISTS last_message_at TIMESTAMP")
+                # 消息按 (conversation_id, timestamp, id) 范围分页的复合索引
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_messages_conversation_timestamp
+                    ON messages(conversation_id, timestamp, id)
+                """)
+                # 为历史对话回填预览：只处理 last_message_at 为空的对话，每个对话按上面的索引取最后一条消息，
+                # 回填完成后每次启动只需扫描 conversations 中（没有消息的）少量对话，不再扫描整个 messages 表
+                cursor.execute("""
+                    UPDATE conversations c
+                    SET last_message_preview = CASE WHEN length(m.content) > %s
+                                                    THEN left(m.content, %s) || '...' ELSE m.content END,
+                        last_message_at = m.timestamp
+                    FROM conversations pending
+                    CROSS JOIN LATERAL (
+                        SELECT content, timestamp
+                        FROM messages
+                        WHERE conversation_id = pending.id
+                        ORDER BY timestamp DESC, id DESC
+                        LIMIT 1
+                    ) m
+                    WHERE pending.last_message_at IS NULL AND c.id = pending.id
+                """, (PREVIEW_LENGTH, PREVIEW_LENGTH))
+                # 对话列表按 (updated_at, id) 游标分页的索引
+                cursor.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_conversations_user_keyset
+                    ON conversations(user_id, updated_at DESC, id DESC)
+                    WHERE is_deleted = FALSE
+                """)
+
                 conn.commit()
                 logger.info("Conversation tables created or already exist")
         except Exception as e:
@@ -258,359 +305,94 @@ class ConversationDB:
             if conn:
                 self.connection_pool.putconn(conn)
 
-    def create_conversation(self, user_id: str, title: str) -> str:
-        """创建新对话"""
-        conn = None
-        try:
-            conversation_id = str(uuid.uuid4())
-            conn = self.connection_pool.getconn()
-            with conn.cursor() as cursor:
-                cursor.execute(
-                    "INSERT INTO conversations (id, user_id, title) VALUES (%s, %s, %s) RETURNING id",
-                    (conversation_id, user_id, title)
-                )
-                result = cursor.fetchone()
-                conn.commit()
-                logger.info(f"Created conversation: {conversation_id} for user: {user_id}")
-                return conversation_id
-        except Exception as e:
-            logger.error(f"Error creating conversation: {e}")
-            raise
-        finally:
-            if conn:
-                self.connection_pool.putconn(conn)
+    @traced("ConversationDB.add_messages")
+    def add_messages(self, conversation_id: str, messages: list) -> list:
+        """批量添加消息到对话，一条语句完成消息插入和对话更新时间、预览的更新
+
+        Args:
+            conversation_id: 对话ID。
+            messages: 消息字典列表，包含 role、content，可选 embedding（向量）和 timestamp（时间戳）。
 
-    def add_message(self, conversation_id: str, role: str, content: str, embedding=None):
-        """添加消息到对话 - 确保消息正确保存，支持向量嵌入"""
+        Returns:
+            list: 按输入顺序返回的消息ID列表。
+        """
+        if not messages:
+            return []
         conn = None
         try:
-            message_id = str(uuid.uuid4())
+            message_ids = [str(uuid.uuid4()) for _ in messages]
+            roles = [msg["role"] for msg in messages]
+            contents = [msg["content"] for msg in messages]
+            # 向量以文本形式传入，由 pgvector 解析，无向量时为 NULL
+            vectors = [str(list(msg["embedding"])) if msg.get("embedding") else None for msg in messages]
+            timestamps = [msg.get("timestamp") for msg in messages]
+            last_timestamp = timestamps[-1]
             conn = self.connection_pool.getconn()
             with conn.cursor() as cursor:
-                # 插入消息，支持向量嵌入
-                if embedding:
-                    cursor.execute(
-                        "INSERT INTO messages (id, conversation_id, role, content, content_vector) VALUES (%s, %s, %s, %s, %s::vector)",
-                        (message_id, conversation_id, role, content, embedding)
-                    )
-                else:
-                    cursor.execute(
-                        "INSERT INTO messages (id, conversation_id, role, content) VALUES (%s, %s, %s, %s)",
-                        (message_id, conversation_id, role, content)
-                    )
-
-                # 更新对话的更新时间
+                # 同一批消息的默认时间戳按输入顺序递增1微秒，保证按 (timestamp, id) 排序时顺序不变
                 cursor.execute(
-                    "UPDATE conversations SET updated_at = CURRENT_TIMESTAMP WHERE id = %s",
-                    (conversation_id,)
+                    """
+                    WITH new_messages AS (
+                        INSERT INTO messages (id, conversation_id, role, content, content_vector, timestamp)
+                        SELECT m.id, %s, m.role, m.content, m.content_vector::vector,
+                               COALESCE(m.ts, CURRENT_TIMESTAMP + (m.ord - 1) * INTERVAL '1 microsecond')
+                        FROM unnest(%s::text[], %s::text[], %s::text[], %s::text[], %s::timestamp[])
+                             WITH ORDINALITY AS m(id, role, content, content_vector, ts, ord)
+                        RETURNING id
+                    )
+                    UPDATE conversations
+                    SET updated_at = CURRENT_TIMESTAMP, last_message_preview = %s,
+                        last_message_at = COALESCE(%s::timestamp, CURRENT_TIMESTAMP + %s * INTERVAL '1 microsecond')
+                    WHERE id = %s
+                    """,
+                    (conversation_id, message_ids, roles, contents, vectors, timestamps,
+                     make_preview(contents[-1]), last_timestamp, len(messages) - 1, conversation_id)
                 )
-
                 conn.commit()
-                logger.info(f"Saved message to conversation {conversation_id}: {role} - {content[:50]}...")
-                return message_id
+                logger.info(f"Saved {len(messages)} messages to conversation {conversation_id}: "
+                            f"{roles[-1]} - {contents[-1][:50]}...")
+                return message_ids
         except Exception as e:
-            logger.error(f"Error adding message: {e}")
+            logger.error(f"Error adding messages: {e}")
             raise
         finally:
             if conn:
                 self.connection_pool.putconn(conn)
     
-    def get_relevant_messages(self, conversation_id: str, query_embedding: list, top_k: int = 5) -> list:
-        """使用向量相似度搜索获取相关消息"""
+    @traced("ConversationDB.get_conversation_summary")
+    def get_conversation_summary(self, conversation_id: str) -> Optional[str]:
+        """获取对话的滚动摘要"""
         conn = None
         try:
             conn = self.connection_pool.getconn()
             with conn.cursor() as cursor:
-                # 使用pgvector的vector_cosine_distance函数进行相似度搜索
-                cursor.execute("""
-                    SELECT role, content, timestamp 
-                    FROM messages 
-                    WHERE conversation_id = %s 
-                    ORDER BY vector_cosine_distance(content_vector, %s::vector) ASC 
-                    LIMIT %s
-                """, (conversation_id, query_embedding, top_k))
-                results = cursor.fetchall()
-
-                messages = []
-                for result in results:
-                    messages.append({
-                        'role': result[0],
-                        'content': result[1],
-                        'timestamp': result[2].isoformat() if result[2] else None
-                    })
-                logger.info(f"Retrieved {len(messages)} relevant messages for conversation: {conversation_id}")
-                return messages
-        except Exception as e:
-            logger.error(f"Error getting relevant messages: {e}")
-            # 出错时返回最近的top_k条消息作为备选
-            recent_messages = self.get_conversation_messages(conversation_id)
-            return recent_messages[-top_k:] if recent_messages else []
-        finally:
-            if conn:
-                self.connection_pool.putconn(conn)
-    
-    def update_message_embedding(self, message_id: str, embedding: list) -> bool:
-        """更新消息的向量嵌入"""
-        conn = None
-        try:
-            conn = self.connection_pool.getconn()
-            with conn.cursor() as cursor:
-                cursor.execute(
-                    "UPDATE messages SET content_vector = %s::vector WHERE id = %s",
-                    (embedding, message_id)
-                )
-                conn.commit()
-                logger.info(f"Updated embedding for message: {message_id}")
-                return cursor.rowcount > 0
-        except Exception as e:
-            logger.error(f"Error updating message embedding: {e}")
-            return False
-        finally:
-            if conn:
-                self.connection_pool.putconn(conn)
-
-    def get_conversation_messages(self, conversation_id: str) -> list:
-        """获取对话的所有消息"""
-        conn = None
-        try:
-            conn = self.connection_pool.getconn()
-            with conn.cursor() as cursor:
-                cursor.execute("""
-                    SELECT role, content, timestamp 
-                    FROM messages 
-                    WHERE conversation_id = %s 
-                    ORDER BY timestamp ASC
-                """, (conversation_id,))
-                results = cursor.fetchall()
-
-                messages = []
-                for result in results:
-                    messages.append({
-                        'role': result[0],
-                        'content': result[1],
-                        'timestamp': result[2].isoformat() if result[2] else None
-                    })
-                logger.info(f"Loaded {len(messages)} messages for conversation: {conversation_id}")
-                return messages
-        except Exception as e:
-            logger.error(f"Error getting conversation messages: {e}")
-            return []
-        finally:
-            if conn:
-                self.connection_pool.putconn(conn)
-
-    def update_conversation_title(self, conversation_id: str, title: str, user_id: str) -> bool:
-        """更新对话标题"""
-        conn = None
-        try:
-            conn = self.connection_pool.getconn()
-            with conn.cursor() as cursor:
-                cursor.execute("""
-                    UPDATE conversations 
-                    SET title = %s, updated_at = CURRENT_TIMESTAMP 
-                    WHERE id = %s AND user_id = %s AND is_deleted = FALSE
-                """, (title, conversation_id, user_id))
-                conn.commit()
-
-                success = cursor.rowcount > 0
-                if success:
-                    logger.info(f"Updated conversation title: {conversation_id} -> {title}")
-                return success
-        except Exception as e:
-            logger.error(f"Error updating conversation title: {e}")
-            return False
-        finally:
-            if conn:
-                self.connection_pool.putconn(conn)
-
-    def delete_conversation(self, conversation_id: str, user_id: str) -> bool:
-        """软删除对话"""
-        conn = None
-        try:
-            conn = self.connection_pool.getconn()
-            with conn.cursor() as cursor:
-                cursor.execute("""
-                    UPDATE conversations 
-                    SET is_deleted = TRUE, updated_at = CURRENT_TIMESTAMP 
-                    WHERE id = %s AND user_id = %s
-                """, (conversation_id, user_id))
-                conn.commit()
-
-                success = cursor.rowcount > 0
-                if success:
-                    logger.info(f"Deleted conversation: {conversation_id}")
-                return success
-        except Exception as e:
-            logger.error(f"Error deleting conversation: {e}")
-            return False
-        finally:
-            if conn:
-                self.connection_pool.putconn(conn)
-
-    def get_conversation_preview(self, conversation_id: str) -> str:
-        """获取对话的最后一条消息作为预览"""
-        conn = None
-        try:
-            conn = self.connection_pool.getconn()
-            with conn.cursor() as cursor:
-                cursor.execute("""
-                    SELECT content 
-                    FROM messages 
-                    WHERE conversation_id = %s 
-                    ORDER BY timestamp DESC 
-                    LIMIT 1
-                """, (conversation_id,))
+                cursor.execute("SELECT summary FROM conversations WHERE id = %s", (conversation_id,))
                 result = cursor.fetchone()
-
-                if result:
-                    preview = result[0]
-                    # 截取前30个字符作为预览
-                    if len(preview) > 30:
-                        return preview[:30] + "..."
-                    return preview
-                return "暂无消息"
+                return result[0] if result else None
         except Exception as e:
-            logger.error(f"Error getting conversation preview: {e}")
-            return "暂无消息"
+            logger.error(f"Error getting conversation summary: {e}")
+            return None
         finally:
             if conn:
                 self.connection_pool.putconn(conn)
 
-    def add_message_with_timestamp(self, conversation_id: str, role: str, content: str, timestamp: str = None):
-        """添加消息并指定时间戳（用于前端同步）"""
+    @traced("ConversationDB.update_conversation_summary")
+    def update_conversation_summary(self, conversation_id: str, summary: str) -> bool:
+        """更新对话的滚动摘要"""
         conn = None
         try:
-            message_id = str(uuid.uuid4())
             conn = self.connection_pool.getconn()
             with conn.cursor() as cursor:
-                if timestamp:
-                    cursor.execute(
-                        "INSERT INTO messages (id, conversation_id, role, content, timestamp) VALUES (%s, %s, %s, %s, %s)",
-                        (message_id, conversation_id, role, content, timestamp)
-                    )
-                else:
-                    cursor.execute(
-                        "INSERT INTO messages (id, conversation_id, role, content) VALUES (%s, %s, %s, %s)",
-                        (message_id, conversation_id, role, content)
-                    )
-
-                # 更新对话的更新时间
                 cursor.execute(
-                    "UPDATE conversations SET updated_at = CURRENT_TIMESTAMP WHERE id = %s",
-                    (conversation_id,)
+                    "UPDATE conversations SET summary = %s WHERE id = %s",
+                    (summary, conversation_id)
                 )
-
                 conn.commit()
-                logger.info(f"Saved message with timestamp to conversation {conversation_id}: {role}")
-        except Exception as e:
-            logger.error(f"Error adding message with timestamp: {e}")
-            raise
-        finally:
-            if conn:
-                self.connection_pool.putconn(conn)
-
-    def get_conversations_with_preview(self, user_id: str) -> list:
-        """获取用户的对话列表，包含最后一条消息预览"""
-        conn = None
-        try:
-            conn = self.connection_pool.getconn()
-            with conn.cursor() as cursor:
-                cursor.execute("""
-                    SELECT 
-                        c.id, 
-                        c.title, 
-                        c.created_at, 
-                        c.updated_at,
-                        m.content as last_message
-                    FROM conversations c
-                    LEFT JOIN messages m ON m.id = (
-                        SELECT id FROM messages 
-                        WHERE conversation_id = c.id 
-                        ORDER BY timestamp DESC 
-                        LIMIT 1
-                    )
-                    WHERE c.user_id = %s AND c.is_deleted = FALSE 
-                    ORDER BY c.updated_at DESC
-                """, (user_id,))
-                results = cursor.fetchall()
-
-                conversations = []
-                for result in results:
-                    last_message = result[4]
-                    preview = last_message[:30] + "..." if last_message and len(last_message) > 30 else last_message
-
-                    conversations.append({
-                        'id': result[0],
-                        'title': result[1],
-                        'created_at': result[2],
-                        'updated_at': result[3],
-                        'preview': preview or "暂无消息"
-                    })
-                logger.info(f"Loaded {len(conversations)} conversations with preview for user: {user_id}")
-                return conversations
-        except Exception as e:
-            logger.error(f"Error getting conversations with preview: {e}")
-            return []
-        finally:
-            if conn:
-                self.connection_pool.putconn(conn)
-
-    def get_conversation_by_id(self, conversation_id: str, user_id: str) -> dict:
-        """根据ID获取对话详情"""
-        conn = None
-        try:
-            conn = self.connection_pool.getconn()
-            with conn.cursor() as cursor:
-                cursor.execute("""
-                    SELECT id, title, created_at, updated_at 
-                    FROM conversations 
-                    WHERE id = %s AND user_id = %s AND is_deleted = FALSE
-                """, (conversation_id, user_id))
-                result = cursor.fetchone()
-
-                if result:
-                    conversation = {
-                        'id': result[0],
-                        'title': result[1],
-                        'created_at': result[2].isoformat() if result[2] else None,
-                        'updated_at': result[3].isoformat() if result[3] else None
-                    }
-                    return conversation
-                return None
+                logger.info(f"Updated summary for conversation: {conversation_id}")
+                return cursor.rowcount > 0
         except Exception as e:
-            logger.error(f"Error getting conversation by id: {e}")
-            return None
+            logger.error(f"Error updating conversation summary: {e}")
+            return False
         finally:
             if conn:
                 self.connection_pool.putconn(conn)
-
-    def get_user_conversations(self, user_id: str) -> list:
-        """获取用户的所有对话"""
-        conn = None
-        try:
-            conn = self.connection_pool.getconn()
-            with conn.cursor() as cursor:
-                cursor.execute("""
-                    SELECT id, title, created_at, updated_at 
-                    FROM conversations 
-                    WHERE user_id = %s AND is_deleted = FALSE 
-                    ORDER BY updated_at DESC
-                """, (user_id,))
-                results = cursor.fetchall()
-
-                conversations = []
-                for result in results:
-                    conversations.append({
-                        'id': result[0],
-                        'title': result[1],
-                        'created_at': result[2].isoformat() if result[2] else None,
-                        'updated_at': result[3].isoformat() if result[3] else None
-                    })
-                logger.info(f"Loaded {len(conversations)} conversations for user: {user_id}")
-                return conversations
-        except Exception as e:
-            logger.error(f"Error getting user conversations: {e}")
-            return []
-        finally:
-            if conn:
-                self.connection_pool.putconn(conn)
\ No newline at end of file
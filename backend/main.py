@@ -1,5 +1,6 @@
 import re
 import json
+import asyncio
 import sys
 import time
 import traceback
@@ -10,15 +11,29 @@ import logging
 # 用于定义异步上下文管理器
 from contextlib import asynccontextmanager
 # 用于类型提示，定义列表和可选参数
-from typing import Tuple, List, Dict, Any
+from typing import Tuple, List, Dict, Any, Optional
 from model import Message, ChatCompletionRequest, Token, User, ConversationCreate, MessageCreate, \
-    ChatCompletionResponseChoice, ChatCompletionResponse, UserRegister, UserLogin, ConversationRename
-from fastapi import FastAPI, HTTPException, Depends, status
+    ChatCompletionResponseChoice, ChatCompletionResponse, ChatCompletionUsage, UserRegister, UserLogin, \
+    ConversationRename
+from fastapi import FastAPI, HTTPException, Depends, status, Query, Response, Request, Header
 # 用于返回JSON和流式响应
 from fastapi.responses import JSONResponse, StreamingResponse
-from concurrent_log_handler import ConcurrentRotatingFileHandler
-from auth import create_access_token, get_current_user,  verify_password
+from fastapi.middleware.gzip import GZipMiddleware
+# 用于在响应发送完毕后执行后台任务
+from starlette.background import BackgroundTask
+from auth import create_access_token, get_current_user, password_hasher, login_rate_limiter, client_ip
+from admission import admission_controller, PermitStreamingResponse, PRIORITY_BATCH, PRIORITY_INTERACTIVE
 from database import UserDB, ConversationDB
+from checkpoint_retention import start_checkpoint_retention_job
+from message_writer import MessageQueueFull, MessageWriter
+from repository import create_async_pool, UserRepository, ConversationRepository
+from pools import create_pool, close_pools, PoolMonitor
+from utils.llms import CachedEmbeddings
+from utils.metrics import registry
+from utils.tracing import setup_tracing, shutdown_tracing, set_span_attributes
+from utils.logger import setup_logging, sampled_logger
+from utils.profiler import start_profiling, activate, profile_stage
+from utils.formatter import IncrementalFormatter, format_response
 # 从自定义的库中引入函数
 from ragAgent import (
     ToolConfig,
@@ -27,9 +42,12 @@ from ragAgent import (
     get_llm,
     get_tools,
     Config,
-    ConnectionPool,
     ConnectionPoolError,
-    monitor_connection_pool,
+    ConversationSummarizer,
+    MemoryManager,
+    flush_checkpoints,
+    run_graph,
+    GraphRunResult,
 )
 # 导入向量存储相关库
 from langchain_chroma import Chroma
@@ -47,66 +65,11 @@ llm_embedding = None
 # os.environ["LANGCHAIN_TRACING_V2"] = "true"
 # os.environ["LANGCHAIN_API_KEY"] = ""
 
-# 设置日志基本配置，级别为DEBUG或INFO
+# 安装异步日志：级别由 Config.LOG_LEVEL/LOG_LEVELS 控制（httpx 默认为 WARNING，减少心跳请求日志）
+setup_logging()
 logger = logging.getLogger(__name__)
-# 设置日志器级别为DEBUG
-logger.setLevel(logging.DEBUG)
-# logger.setLevel(logging.INFO)
-logger.handlers = []  # 清空默认处理器
-
-# 降低httpx库的日志级别，减少心跳请求日志
-logging.getLogger("httpx").setLevel(logging.WARNING)
-# 使用ConcurrentRotatingFileHandler
-handler = ConcurrentRotatingFileHandler(
-    # 日志文件
-    Config.LOG_FILE,
-    # 日志文件最大允许大小为5MB，达到上限后触发轮转
-    maxBytes = Config.MAX_BYTES,
-    # 在轮转时，最多保留3个历史日志文件
-    backupCount = Config.BACKUP_COUNT
-)
-# 设置处理器级别为DEBUG
-handler.setLevel(logging.DEBUG)
-handler.setFormatter(logging.Formatter(
-    "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-))
-logger.addHandler(handler)
-
-
-def format_response(response):
-    """对输入的文本进行段落分隔、添加适当的换行符，以及在代码块中增加标记，以便生成更具可读性的输出。
-
-    Args:
-        response: 输入的文本。
-
-    Returns:
-        具有清晰段落分隔的文本。
-    """
-    # 使用正则表达式 \n{2, }将输入的response按照两个或更多的连续换行符进行分割。这样可以将文本分割成多个段落，每个段落由连续的非空行组成
-    paragraphs = re.split(r'\n{2,}', response)
-    # 空列表，用于存储格式化后的段落
-    formatted_paragraphs = []
-    # 遍历每个段落进行处理
-    for para in paragraphs:
-        # 检查段落中是否包含代码块标记
-        if '```' in para:
-            # 将段落按照```分割成多个部分，代码块和普通文本交替出现
-            parts = para.split('```')
-            for i, part in enumerate(parts):
-                # 检查当前部分的索引是否为奇数，奇数部分代表代码块
-                if i % 2 == 1:  # 这是代码块
-                    # 将代码块部分用换行符和```包围，并去除多余的空白字符
-                    parts[i] = f"\n```\n{part.strip()}\n```\n"
-            # 将分割后的部分重新组合成一个字符串
-            para = ''.join(parts)
-        else:
-            # 否则，将句子中的句点后面的空格替换为换行符，以便句子之间有明确的分隔
-            para = para.replace('. ', '.\n')
-        # 将格式化后的段落添加到formatted_paragraphs列表
-        # strip()方法用于移除字符串开头和结尾的空白字符（包括空格、制表符 \t、换行符 \n等）
-        formatted_paragraphs.append(para.strip())
-    # 将所有格式化后的段落用两个换行符连接起来，以形成一个具有清晰段落分隔的文本
-    return '\n\n'.join(formatted_paragraphs)
+# 流式输出的逐块日志按 Config.LOG_STREAM_SAMPLE_RATE 采样
+stream_logger = sampled_logger(__name__)
 
 
 # 管理 FastAPI 应用生命周期的异步上下文管理器，负责启动和关闭时的初始化与清理
@@ -126,10 +89,13 @@ async def lifespan(app: FastAPI):
         Exception: 其他未预期的异常。
     """
     # 声明全局变量 graph 和 tool_config
-    global graph, tool_config, user_db, conversation_db, vector_store, llm_embedding
+    global graph, tool_config, user_db, conversation_db, vector_store, llm_embedding, summarizer, memory_manager, \
+        message_writer, app_pool, user_repo, conversation_repo, pool_monitor
     try:
         # 调用 get_llm 初始化聊天模型和嵌入模型
         llm_chat, llm_embedding = get_llm(Config.LLM_TYPE)
+        # 缓存文本向量，同一轮中消息入库、历史检索和记忆检索对同一问题只计算一次向量
+        llm_embedding = CachedEmbeddings(llm_embedding, max_size=Config.EMBEDDING_CACHE_SIZE)
 
         # 获取工具列表，基于嵌入模型
         tools = get_tools(llm_embedding)
@@ -137,50 +103,54 @@ async def lifespan(app: FastAPI):
         # 创建工具配置实例
         tool_config = ToolConfig(tools)
 
-        # 定义数据库连接参数：自动提交、无预准备阈值、5秒超时
-        connection_kwargs = {"autocommit": True, "prepare_threshold": 0, "connect_timeout": 5}
-        # 创建数据库连接池：最大20个连接，最小2个活跃连接，超时10秒
-        db_connection_pool = ConnectionPool(
-            conninfo=Config.DB_URI,
-            max_size=20,
-            min_size=2,
-            kwargs=connection_kwargs,
-            timeout=10
-        )
-
-        # 尝试打开数据库连接池
+        # 按负载类型创建独立的数据库连接池，检查点写入高峰不会占满接口和后台任务的连接
         try:
-            # 打开连接池以启用数据库连接
-            db_connection_pool.open()
-            # 记录连接池初始化成功的日志（INFO 级别）
-            logger.info("Database connection pool initialized")
-            # 记录详细调试日志（DEBUG 级别）
-            logger.debug("Database connection pool initialized")
+            checkpoint_pool = create_pool("checkpoint", Config.DB_CHECKPOINT_POOL_MIN_SIZE,
+                                          Config.DB_CHECKPOINT_POOL_MAX_SIZE)
+            background_pool = create_pool("background", Config.DB_BACKGROUND_POOL_MIN_SIZE,
+                                          Config.DB_BACKGROUND_POOL_MAX_SIZE)
+            # 接口使用的异步数据访问层，数据库访问不阻塞事件循环
+            app_pool = create_async_pool()
+            await app_pool.open()
         except Exception as e:
             # 记录连接池打开失败的错误日志
             logger.error(f"Failed to open connection pool: {e}")
             # 抛出自定义连接池异常
             raise ConnectionPoolError(f"无法打开数据库连接池: {str(e)}")
 
-        # 启动连接池监控线程，60秒检查一次，设置为守护线程
-        monitor_thread = monitor_connection_pool(db_connection_pool, interval=60)
+        # 启动连接池监控线程，记录使用率和获取连接的等待时间，超过阈值时告警
+        pool_monitor = PoolMonitor()
+        pool_monitor.start()
+
+        # 启动检查点保留任务，定期裁剪旧检查点并清理已删除对话的线程
+        if Config.CHECKPOINT_RETENTION_INTERVAL > 0:
+            start_checkpoint_retention_job(background_pool, interval=Config.CHECKPOINT_RETENTION_INTERVAL)
 
         # 初始化用户数据库和对话数据库
-        user_db = UserDB(db_connection_pool)
-        conversation_db = ConversationDB(db_connection_pool)
+        user_db = UserDB(background_pool)
+        conversation_db = ConversationDB(background_pool)
         user_db.create_user_table()
         conversation_db.create_conversation_tables()
+        user_repo = UserRepository(app_pool)
+        conversation_repo = ConversationRepository(app_pool)
+        # 创建消息异步写入器，消息的向量计算和入库不阻塞对话请求
+        message_writer = MessageWriter(conversation_db, llm_embedding)
 
         # 尝试创建状态图
         try:
-            # 使用数据库连接池和模型创建状态图
-            graph = create_graph(db_connection_pool, llm_chat, llm_embedding, tool_config)
+            # 使用检查点连接池和模型创建状态图
+            graph = create_graph(checkpoint_pool, llm_chat, llm_embedding, tool_config)
         except ConnectionPoolError as e:
             # 记录状态图创建失败的错误日志
             logger.error(f"Graph creation failed: {e}")
             # 退出程序，返回状态码 1
             sys.exit(1)
 
+        # 创建后台对话摘要器，控制长对话的检查点和提示词体积
+        summarizer = ConversationSummarizer(graph, llm_chat, conversation_db)
+        # 创建记忆管理器，响应发送后异步抽取、去重并写入用户记忆
+        memory_manager = MemoryManager(graph.store, llm_chat)
+
         # 保存状态图的可视化表示
         # save_graph_visualization(graph)
 
@@ -197,17 +167,24 @@ async def lifespan(app: FastAPI):
 
     # yield 表示应用运行期间，初始化完成后进入运行状态
     yield
-    # 检查并关闭数据库连接池（清理资源）
-    if db_connection_pool and not db_connection_pool.closed:
-        # 关闭连接池
-        db_connection_pool.close()
-        # 记录连接池关闭的日志
-        logger.info("Database connection pool closed")
+    # 等待正在执行的摘要任务结束，避免关闭连接池时中断写入
+    summarizer.shutdown(wait=True)
+    # 处理完队列中等待抽取的记忆
+    memory_manager.shutdown()
+    # 写完队列中尚未落库的消息
+    message_writer.shutdown()
+    # 关闭数据库连接池（清理资源）
+    pool_monitor.stop()
+    await app_pool.close()
+    close_pools()
+    # 导出尚未发送的 span
+    shutdown_tracing(tracer_provider)
     # 记录服务关闭的日志
     logger.info("The service has been shut down")
 
 
-def get_relevant_history_messages(conversation_id: str, user_input: str, top_k: int = 5) -> List[Dict[str, Any]]:
+async def get_relevant_history_messages(conversation_id: str, user_input: str,
+                                        top_k: int = 5) -> List[Dict[str, Any]]:
     """
     获取与当前用户输入最相关的历史消息
 
@@ -222,56 +199,61 @@ def get_relevant_history_messages(conversation_id: str, user_input: str, top_k:
     global llm_embedding
     
     try:
-        # 加载该对话的所有历史消息
-        history_messages = conversation_db.get_conversation_messages(conversation_id)
-        logger.info(f"[DEBUG] Loaded {len(history_messages)} total history messages for conversation {conversation_id}")
-        logger.info(f"[DEBUG] Current user input: {user_input}")
+        # 等待该对话已提交的消息落库，保证读取到最新的历史
+        await asyncio.to_thread(message_writer.flush, conversation_id)
+        # 只加载最近的top_k条历史消息，用于判断是否需要相似度检索
+        history_messages, has_more = await conversation_repo.get_messages_page(conversation_id, limit=top_k)
+        logger.debug("Loaded %s recent history messages for conversation %s", len(history_messages), conversation_id)
+        logger.debug("Current user input: %s", user_input)
         
         if not history_messages:
-            logger.info(f"[DEBUG] No history messages found for conversation {conversation_id}")
+            logger.debug("No history messages found for conversation %s", conversation_id)
             return []
         
         # 如果历史消息不足top_k条，直接返回所有历史消息
-        if len(history_messages) <= top_k:
-            logger.info(f"[DEBUG] History messages ({len(history_messages)}) <= top_k ({top_k}), returning all messages")
+        if not has_more:
+            logger.debug("History messages (%s) <= top_k (%s), returning all messages", len(history_messages), top_k)
             for i, msg in enumerate(history_messages):
-                logger.info(f"[DEBUG] Message {i+1}: {msg['role']} - {msg['content'][:100]}...")
+                logger.debug("Message %s: %s - %s...", i+1, msg['role'], msg['content'][:100])
             return history_messages
         
         # 生成当前用户输入的向量嵌入
-        logger.info(f"[DEBUG] Generating embedding for user input: {user_input[:100]}...")
-        query_embedding = llm_embedding.embed_query(user_input)
+        logger.debug("Generating embedding for user input: %s...", user_input[:100])
+        query_embedding = await asyncio.to_thread(llm_embedding.embed_query, user_input)
         
         # 使用PG Vector进行相似度搜索
-        logger.info(f"[DEBUG] Performing similarity search with PG Vector")
-        relevant_messages = conversation_db.get_relevant_messages(conversation_id, query_embedding, top_k)
+        logger.debug("Performing similarity search with PG Vector")
+        relevant_messages = await conversation_repo.get_relevant_messages(conversation_id, query_embedding, top_k)
         
         # 确保相关消息按时间排序
-        logger.info(f"[DEBUG] Retrieved {len(relevant_messages)} relevant messages from PG Vector:")
+        logger.debug("Retrieved %s relevant messages from PG Vector:", len(relevant_messages))
         for i, msg in enumerate(relevant_messages):
-            logger.info(f"[DEBUG] Relevant message {i+1}: {msg['role']} - {msg['content'][:100]}... (timestamp: {msg['timestamp']})")
+            logger.debug("Relevant message %s: %s - %s... (timestamp: %s)", i+1, msg['role'], msg['content'][:100], msg['timestamp'])
         
         relevant_messages.sort(key=lambda x: x['timestamp'])
         
-        logger.info(f"[DEBUG] Relevant messages after time sorting (final result):")
+        logger.debug("Relevant messages after time sorting (final result):")
         for i, msg in enumerate(relevant_messages):
-            logger.info(f"[DEBUG] Final {i+1}: {msg['role']} - {msg['content'][:100]}... (timestamp: {msg['timestamp']})")
+            logger.debug("Final %s: %s - %s... (timestamp: %s)", i+1, msg['role'], msg['content'][:100], msg['timestamp'])
         
-        logger.info(f"[DEBUG] Returning {len(relevant_messages)} relevant messages for conversation {conversation_id}")
+        logger.debug("Returning %s relevant messages for conversation %s", len(relevant_messages), conversation_id)
         return relevant_messages
         
     except Exception as e:
-        logger.error(f"[DEBUG] Error getting relevant history messages: {e}")
+        logger.error(f"Error getting relevant history messages: {e}")
         # 出错时返回最近的top_k条消息作为备选
-        history_messages = conversation_db.get_conversation_messages(conversation_id)
-        fallback_messages = history_messages[-top_k:] if history_messages else []
-        logger.info(f"[DEBUG] Using fallback: returning {len(fallback_messages)} most recent messages")
+        fallback_messages, _ = await conversation_repo.get_messages_page(conversation_id, limit=top_k)
+        logger.debug("Using fallback: returning %s most recent messages", len(fallback_messages))
         for i, msg in enumerate(fallback_messages):
-            logger.info(f"[DEBUG] Fallback {i+1}: {msg['role']} - {msg['content'][:100]}... (timestamp: {msg['timestamp']})")
+            logger.debug("Fallback %s: %s - %s... (timestamp: %s)", i+1, msg['role'], msg['content'][:100], msg['timestamp'])
         return fallback_messages
 
 # 创建 FastAPI 实例, lifespan参数用于在应用程序生命周期的开始和结束时执行一些初始化或清理工作
 app = FastAPI(lifespan=lifespan)
+# 对较大的JSON/NDJSON响应启用gzip压缩（text/event-stream 流式响应不会被压缩）
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+# 开启链路追踪（Config.TRACING_EXPORTER 为 none 时不生效），每个HTTP请求一个根 span
+tracer_provider = setup_tracing(app)
 
 
 # 处理非流式响应的异步函数，生成并返回完整的响应内容
@@ -292,7 +274,8 @@ async def handle_non_stream_response1(user_input, graph, tool_config, config):
     content = None
     try:
         # 启动 graph.stream 处理用户输入，生成事件流
-        events = graph.stream({"messages": [{"role": "user", "content": user_input}], "rewrite_count": 0}, config)
+        events = graph.stream({"messages": [{"role": "user", "content": user_input}], "rewrite_count": 0,
+                               "user_info": None}, config)
         # 遍历事件流中的每个事件
         for event in events:
             # 遍历事件中的所有值
@@ -327,11 +310,11 @@ async def handle_non_stream_response1(user_input, graph, tool_config, config):
                         # 获取工具名称
                         tool_name = last_message.name
                         # 记录工具输出日志
-                        logger.info(f"Tool Output [{tool_name}]: {content}")
+                        logger.debug("Tool Output [%s]: %s", tool_name, content)
                     # 处理大模型输出（非工具消息）
                     else:
                         # 记录最终响应日志
-                        logger.info(f"Final Response is: {content}")
+                        logger.debug("Final Response is: %s", content)
                 else:
                     # 记录无内容的消息日志，跳过处理
                     logger.info("Message has no content, skipping")
@@ -345,7 +328,7 @@ async def handle_non_stream_response1(user_input, graph, tool_config, config):
     # 格式化响应内容，若无内容则返回默认值
     formatted_response = str(format_response(content)) if content else "No response generated"
     # 记录格式化后的响应日志
-    logger.info(f"Results for Formatting: {formatted_response}")
+    logger.debug("Results for Formatting: %s", formatted_response)
 
     # 构造返回给客户端的响应对象
     try:
@@ -373,7 +356,7 @@ async def handle_non_stream_response1(user_input, graph, tool_config, config):
         )
 
     # 记录发送给客户端的响应内容日志
-    logger.info(f"Send response content: \n{response}")
+    logger.debug("Send response content: \n%s", response)
     # 返回 JSON 格式的响应对象
     return JSONResponse(content=response.model_dump())
 
@@ -406,7 +389,7 @@ async def handle_stream_response1(user_input, graph, config):
             chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
             # 调用 graph.stream 获取消息流
             stream_data = graph.stream(
-                {"messages": [{"role": "user", "content": user_input}], "rewrite_count": 0},
+                {"messages": [{"role": "user", "content": user_input}], "rewrite_count": 0, "user_info": None},
                 config,
                 stream_mode="messages"
             )
@@ -420,8 +403,8 @@ async def handle_stream_response1(user_input, graph, config):
                     if node_name in ["generate", "agent"]:
                         # 获取消息内容，默认空字符串
                         chunk = getattr(message_chunk, 'content', '')
-                        # 记录流式数据块日志
-                        logger.info(f"Streaming chunk from {node_name}: {chunk}")
+                        # 逐块日志经采样后写入，默认级别下不输出
+                        stream_logger.debug("Streaming chunk from %s: %s", node_name, chunk)
                         # 产出流式数据块
                         yield f"data: {json.dumps({'id': chunk_id, 'object': 'chat.completion.chunk', 'created': int(time.time()), 'choices': [{'index': 0, 'delta': {'content': chunk}, 'finish_reason': None}]})}\n\n"
                         # 添加一个小延迟，确保数据能被实时发送到客户端
@@ -443,110 +426,37 @@ async def handle_stream_response1(user_input, graph, config):
     return StreamingResponse(generate_stream(), media_type="text/event-stream")
 
 
-async def handle_non_stream_response(messages, graph, tool_config, config):
+async def handle_non_stream_response(messages, graph, config) -> GraphRunResult:
     """
-    处理非流式响应的异步函数，生成并返回完整的响应内容。
+    处理非流式响应的异步函数，执行一轮对话并返回收集到的结果。
 
     Args:
         messages: 完整的消息列表（历史 + 新消息）
         graph: 图对象，用于处理消息流。
-        tool_config: 工具配置对象，包含可用工具的名称和定义。
         config (dict): 配置参数，包含线程和用户标识。
 
     Returns:
-        JSONResponse: 包含格式化响应的 JSON 响应对象。
+        GraphRunResult: 格式化后的最终回复（未生成回复时为 None）、调用的工具和令牌用量。
     """
-    # 初始化 content 变量，用于存储最终响应内容
-    content = None
     try:
-        # 启动 graph.stream 处理完整消息列表
-        events = graph.stream({"messages": messages, "rewrite_count": 0}, config)
-        # 遍历事件流中的每个事件
-        for event in events:
-            # 遍历事件中的所有值
-            for value in event.values():
-                # 检查事件值是否包含有效消息列表
-                if "messages" not in value or not isinstance(value["messages"], list):
-                    # 记录警告日志，跳过无效消息
-                    logger.warning("No valid messages in response")
-                    continue
-
-                # 获取消息列表中的最后一条消息
-                last_message = value["messages"][-1]
-
-                # 检查消息是否包含工具调用
-                if hasattr(last_message, "tool_calls") and last_message.tool_calls:
-                    # 遍历所有工具调用
-                    for tool_call in last_message.tool_calls:
-                        # 验证工具调用是否为字典且包含名称
-                        if isinstance(tool_call, dict) and "name" in tool_call:
-                            # 记录工具调用日志
-                            logger.info(f"Calling tool: {tool_call['name']}")
-                    # 跳过本次循环，继续处理下一事件
-                    continue
-
-                # 检查消息是否包含内容
-                if hasattr(last_message, "content"):
-                    # 将消息内容赋值给 content
-                    content = last_message.content
-
-                    # 检查是否为工具输出（基于工具名称）
-                    if hasattr(last_message, "name") and last_message.name in tool_config.get_tool_names():
-                        # 获取工具名称
-                        tool_name = last_message.name
-                        # 记录工具输出日志
-                        logger.info(f"Tool Output [{tool_name}]: {content}")
-                    # 处理大模型输出（非工具消息）
-                    else:
-                        # 记录最终响应日志
-                        logger.info(f"Final Response is: {content}")
-                else:
-                    # 记录无内容的消息日志，跳过处理
-                    logger.info("Message has no content, skipping")
-    except ValueError as ve:
-        # 捕获并记录值错误
-        logger.error(f"Value error in response processing: {ve}")
+        result = run_graph(graph, {"messages": messages, "rewrite_count": 0, "user_info": None}, config)
     except Exception as e:
-        # 捕获并记录其他未预期的异常
+        # 捕获并记录图执行中的异常
         logger.error(f"Error processing response: {e}")
+        result = GraphRunResult()
+    finally:
+        # 一轮对话结束，写入缓存的检查点
+        flush_checkpoints(graph, config)
 
-    # 格式化响应内容，若无内容则返回默认值
-    formatted_response = str(format_response(content)) if content else "No response generated"
-    # 记录格式化后的响应日志
-    logger.info(f"Results for Formatting: {formatted_response}")
+    if result.tool_calls:
+        logger.info("Called tools: %s", ", ".join(result.tool_calls))
+    # 格式化最终回复
+    result.answer = format_response(str(result.answer)) if result.answer else None
+    logger.debug("Results for Formatting: %s", result.answer)
+    return result
 
-    # 构造返回给客户端的响应对象
-    try:
-        response = ChatCompletionResponse(
-            choices=[
-                ChatCompletionResponseChoice(
-                    index=0,
-                    message=Message(role="assistant", content=formatted_response),
-                    finish_reason="stop"
-                )
-            ]
-        )
-    except Exception as resp_error:
-        # 捕获并记录构造响应对象时的异常
-        logger.error(f"Error creating response object: {resp_error}")
-        # 构造错误响应对象
-        response = ChatCompletionResponse(
-            choices=[
-                ChatCompletionResponseChoice(
-                    index=0,
-                    message=Message(role="assistant", content="Error generating response"),
-                    finish_reason="error"
-                )
-            ]
-        )
-
-    # 记录发送给客户端的响应内容日志
-    logger.info(f"Send response content: \n{response}")
-    # 返回 JSON 格式的响应对象
-    return JSONResponse(content=response.model_dump())
 
-
-async def handle_stream_response(messages, graph, config, conversation_id):
+async def handle_stream_response(messages, graph, config, conversation_id, profiler=None, permit=None):
     """
     处理流式响应的异步函数，生成并返回流式数据。
 
@@ -555,6 +465,8 @@ async def handle_stream_response(messages, graph, config, conversation_id):
         graph: 图对象，用于处理消息流。
         config (dict): 配置参数，包含线程和用户标识。
         conversation_id: 对话ID，用于保存助手消息到数据库。
+        profiler: 请求级耗时分析器，不为空时在流结束后追加一条 timings 事件。
+        permit: 准入许可，不为空时在响应结束（包括客户端断开）后释放。
 
     Returns:
         StreamingResponse: 流式响应对象，媒体类型为 text/event-stream。
@@ -570,13 +482,17 @@ async def handle_stream_response(messages, graph, config, conversation_id):
             Exception: 流生成过程中可能抛出的异常。
         """
         try:
+            # 生成器在响应发送时才执行，需重新激活本请求的分析器
+            activate(profiler)
             # 生成唯一的 chunk ID
             chunk_id = f"chatcmpl-{uuid.uuid4().hex}"
             # 初始化完整的助手消息内容
             full_content = ""
+            # 与非流式响应相同的格式化规则，逐块输出格式化后的增量
+            formatter = IncrementalFormatter()
             # 调用 graph.stream 获取消息流，使用完整的消息列表
             stream_data = graph.stream(
-                {"messages": messages, "rewrite_count": 0},
+                {"messages": messages, "rewrite_count": 0, "user_info": None},
                 config,
                 stream_mode="messages"
             )
@@ -590,29 +506,54 @@ async def handle_stream_response(messages, graph, config, conversation_id):
                     if node_name in ["generate", "agent"]:
                         # 获取消息内容，默认空字符串
                         chunk = getattr(message_chunk, 'content', '')
-                        # 记录流式数据块日志
-                        logger.info(f"Streaming chunk from {node_name}: {chunk}")
+                        # 逐块日志经采样后写入，默认级别下不输出
+                        stream_logger.debug("Streaming chunk from %s: %s", node_name, chunk)
+                        # 格式化器可能暂存片段末尾的空白或不完整的代码块标记，此时没有可输出的内容
+                        delta = formatter.feed(chunk)
+                        if not delta:
+                            continue
                         # 累加完整的助手消息内容
-                        full_content += chunk
+                        full_content += delta
                         # 产出流式数据块
-                        yield f"data: {json.dumps({'id': chunk_id, 'object': 'chat.completion.chunk', 'created': int(time.time()), 'choices': [{'index': 0, 'delta': {'content': chunk}, 'finish_reason': None}]})}\n\n"
+                        yield f"data: {json.dumps({'id': chunk_id, 'object': 'chat.completion.chunk', 'created': int(time.time()), 'choices': [{'index': 0, 'delta': {'content': delta}, 'finish_reason': None}]})}\n\n"
                         # 添加一个小延迟，确保数据能被实时发送到客户端
                         await asyncio.sleep(0.01)
                 except Exception as chunk_error:
                     logger.error(f"Error processing stream chunk: {chunk_error}")
                     continue
 
-            # 流结束后，保存完整的助手消息到数据库
+            # 输出格式化器中剩余的内容（如补全未闭合的代码块）
+            delta = formatter.finish()
+            if delta:
+                full_content += delta
+                yield f"data: {json.dumps({'id': chunk_id, 'object': 'chat.completion.chunk', 'created': int(time.time()), 'choices': [{'index': 0, 'delta': {'content': delta}, 'finish_reason': None}]})}\n\n"
+
+            # 流结束后，提交完整的助手消息，由后台写入数据库
             if full_content:
                 logger.info(f"Saving complete assistant message to conversation {conversation_id}: {full_content[:50]}...")
-                conversation_db.add_message(conversation_id, "assistant", full_content)
+                try:
+                    await message_writer.asubmit(conversation_id,
+                                                 [{"role": "assistant", "content": full_content, "embed": True}])
+                except MessageQueueFull:
+                    # 回复已发送给客户端，写入队列持续满载时只能放弃保存（已记录错误日志）
+                    pass
+                # 后台折叠较早的对话内容
+                summarizer.submit(config, conversation_id)
 
             yield f"data: {json.dumps({'id': chunk_id, 'object': 'chat.completion.chunk', 'created': int(time.time()), 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]})}\n\n"
+            # 调试模式下最后发送本次请求的耗时分析
+            if profiler is not None:
+                yield f"data: {json.dumps({'id': chunk_id, 'object': 'chat.completion.timings', 'timings': profiler.to_dict()})}\n\n"
         except Exception as stream_error:
             logger.error(f"Stream generation error: {stream_error}")
             yield f"data: {json.dumps({'error': 'Stream processing failed'})}\n\n"
+        finally:
+            # 一轮对话结束（包括客户端中途断开），写入缓存的检查点
+            flush_checkpoints(graph, config)
 
     # 返回流式响应对象
+    if permit is not None:
+        return PermitStreamingResponse(generate_stream(), permit, media_type="text/event-stream")
     return StreamingResponse(generate_stream(), media_type="text/event-stream")
 
 
@@ -678,10 +619,12 @@ async def register(user_data: UserRegister):
                 }
             )
 
-        user = user_db.create_user(
+        # 在密码哈希线程池中计算哈希，不阻塞事件循环
+        hashed_password = await password_hasher.hash(user_data.password)
+        user = await user_repo.create_user(
             username=user_data.username,
             email=user_data.email,
-            password=user_data.password
+            hashed_password=hashed_password
         )
 
         if user:
@@ -734,6 +677,8 @@ async def register(user_data: UserRegister):
                 }
             )
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Registration error: {e}")
         return JSONResponse(
@@ -747,13 +692,15 @@ async def register(user_data: UserRegister):
 
 
 @app.post("/login", response_model=Token)
-async def login(user_data: UserLogin):
+async def login(user_data: UserLogin, request: Request):
+    # 按客户端IP限制登录频率
+    login_rate_limiter.check(client_ip(request))
     if "@" in user_data.username:
         # 邮箱登录
-        user = user_db.get_user_by_email(user_data.username)
+        user = await user_repo.get_user_by_email(user_data.username)
     else:
-        user = user_db.get_user_by_username(user_data.username)
-    if not user or not verify_password(user_data.password, user.hashed_password):
+        user = await user_repo.get_user_by_username(user_data.username)
+    if not user or not await password_hasher.verify(user_data.password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="用户名或密码错误",
@@ -770,36 +717,82 @@ async def login(user_data: UserLogin):
 
 @app.get("/users/me", response_model=User)
 async def read_users_me(current_user_id: str = Depends(get_current_user)):
-    user = user_db.get_user_by_id(current_user_id)
+    user = await user_repo.get_user_by_id(current_user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
-    return User(id=user.id, username=user.username, email=user.email)
+    return user
+
+
+@app.get("/metrics")
+async def metrics():
+    """以 Prometheus 文本格式输出进程内指标：连接池、图节点、工具、Embedding 和 LLM 调用"""
+    return Response(content=registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 
 @app.get("/conversations", response_model=List[dict])
-async def get_conversations(current_user_id: str = Depends(get_current_user)):
-    """获取用户的所有对话"""
+async def get_conversations(
+        response: Response,
+        limit: Optional[int] = Query(None, ge=1, le=200),
+        cursor: Optional[str] = None,
+        current_user_id: str = Depends(get_current_user)
+):
+    """按更新时间倒序获取用户的对话。
+
+    指定 limit 或 cursor 时分页返回（limit 默认50），下一页游标通过 X-Next-Cursor 响应头返回；
+    都不指定时返回全部对话，与未分页时的接口行为一致。
+    """
+    if cursor and limit is None:
+        limit = 50
     try:
-        conversations = conversation_db.get_user_conversations(current_user_id)
+        conversations, next_cursor = await conversation_repo.list_conversations(current_user_id, limit=limit,
+                                                                                cursor=cursor)
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
         return conversations
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error getting conversations: {e}")
         raise HTTPException(status_code=500, detail="获取对话列表失败")
 
 
 @app.get("/conversations/{conversation_id}/messages", response_model=List[dict])
-async def get_conversation_messages(conversation_id: str, current_user_id: str = Depends(get_current_user)):
-    """获取对话的所有消息"""
+async def get_conversation_messages(
+        conversation_id: str,
+        response: Response,
+        before: Optional[str] = None,
+        after: Optional[str] = None,
+        limit: Optional[int] = Query(None, ge=1, le=500),
+        format: str = Query("json", pattern="^(json|ndjson)$"),
+        current_user_id: str = Depends(get_current_user)
+):
+    """分页获取对话消息
+
+    before/after 可以是消息ID或ISO时间戳，消息ID不属于该对话时返回400；指定 before/after 或 limit 时分页返回
+    （limit 默认50），都不指定时返回全部消息，与未分页时的接口行为一致。
+    连续翻页应以当前页首条/末条消息的ID作为游标，时间戳游标不包含与其时间相同的消息，时间相同的消息会被跳过。
+    是否还有更多消息通过 X-Has-More 响应头返回；format=ndjson 时按行流式返回每条消息。
+    """
+    if (before or after) and limit is None:
+        limit = 50
     try:
         # 验证用户是否有权访问这个对话
-        conversation = conversation_db.get_conversation_by_id(conversation_id, current_user_id)
-        if not conversation:
+        if not await conversation_repo.owns_conversation(conversation_id, current_user_id):
             raise HTTPException(status_code=404, detail="对话不存在")
 
-        messages = conversation_db.get_conversation_messages(conversation_id)
+        await asyncio.to_thread(message_writer.flush, conversation_id)
+        messages, has_more = await conversation_repo.get_messages_page(conversation_id, before=before,
+                                                                      after=after, limit=limit)
+        headers = {"X-Has-More": "true" if has_more else "false"}
+        if format == "ndjson":
+            lines = (json.dumps(msg, ensure_ascii=False) + "\n" for msg in messages)
+            return StreamingResponse(lines, media_type="application/x-ndjson", headers=headers)
+        response.headers.update(headers)
         return messages
     except HTTPException:
         raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error getting conversation messages: {e}")
         raise HTTPException(status_code=500, detail="获取消息失败")
@@ -809,8 +802,8 @@ async def get_conversation_messages(conversation_id: str, current_user_id: str =
 async def create_conversation(conversation: ConversationCreate, current_user_id: str = Depends(get_current_user)):
     """创建新对话"""
     try:
-        conversation_id = conversation_db.create_conversation(current_user_id, conversation.title)
-        new_conversation = conversation_db.get_conversation_by_id(conversation_id, current_user_id)
+        conversation_id = await conversation_repo.create_conversation(current_user_id, conversation.title)
+        new_conversation = await conversation_repo.get_conversation_by_id(conversation_id, current_user_id)
         return new_conversation
     except Exception as e:
         logger.error(f"Error creating conversation: {e}")
@@ -822,11 +815,11 @@ async def rename_conversation(conversation_id: str, rename_data: ConversationRen
                               current_user_id: str = Depends(get_current_user)):
     """重命名对话"""
     try:
-        success = conversation_db.update_conversation_title(conversation_id, rename_data.title, current_user_id)
+        success = await conversation_repo.update_conversation_title(conversation_id, rename_data.title, current_user_id)
         if not success:
             raise HTTPException(status_code=404, detail="对话不存在")
 
-        updated_conversation = conversation_db.get_conversation_by_id(conversation_id, current_user_id)
+        updated_conversation = await conversation_repo.get_conversation_by_id(conversation_id, current_user_id)
         return updated_conversation
     except HTTPException:
         raise
@@ -839,7 +832,7 @@ async def rename_conversation(conversation_id: str, rename_data: ConversationRen
 async def delete_conversation(conversation_id: str, current_user_id: str = Depends(get_current_user)):
     """删除对话"""
     try:
-        success = conversation_db.delete_conversation(conversation_id, current_user_id)
+        success = await conversation_repo.delete_conversation(conversation_id, current_user_id)
         if not success:
             raise HTTPException(status_code=404, detail="对话不存在")
         return {"message": "对话删除成功"}
@@ -859,14 +852,15 @@ async def add_message_to_conversation(
     """添加消息到对话"""
     try:
         # 验证用户是否有权访问这个对话
-        conversation = conversation_db.get_conversation_by_id(conversation_id, current_user_id)
-        if not conversation:
+        if not await conversation_repo.owns_conversation(conversation_id, current_user_id):
             raise HTTPException(status_code=404, detail="对话不存在")
 
-        conversation_db.add_message(conversation_id, message.role, message.content)
+        await message_writer.asubmit(conversation_id, [{"role": message.role, "content": message.content}])
         return {"message": "消息添加成功"}
     except HTTPException:
         raise
+    except MessageQueueFull:
+        raise HTTPException(status_code=503, detail="服务繁忙，请稍后重试", headers={"Retry-After": "5"})
     except Exception as e:
         logger.error(f"Error adding message to conversation: {e}")
         raise HTTPException(status_code=500, detail="添加消息失败")
@@ -877,7 +871,7 @@ async def add_message_to_conversation(
 async def get_conversation(conversation_id: str, current_user_id: str = Depends(get_current_user)):
     """获取对话详情"""
     try:
-        conversation = conversation_db.get_conversation_by_id(conversation_id, current_user_id)
+        conversation = await conversation_repo.get_conversation_by_id(conversation_id, current_user_id)
         if not conversation:
             raise HTTPException(status_code=404, detail="对话不存在")
         return conversation
@@ -892,10 +886,17 @@ async def get_conversation(conversation_id: str, current_user_id: str = Depends(
 async def chat_completions(
         request: ChatCompletionRequest,
         current_user_id: str = Depends(get_current_user),
-        dependencies: Tuple[any, any] = Depends(get_dependencies)
+        dependencies: Tuple[any, any] = Depends(get_dependencies),
+        x_debug_timings: Optional[str] = Header(default=None)
 ):
+    # 准入控制：超出全局或用户并发上限时排队或返回429，流式请求优先
+    permit = await admission_controller.acquire(current_user_id,
+                                                PRIORITY_INTERACTIVE if request.stream else PRIORITY_BATCH)
+    streaming = False
     try:
         graph, tool_config = dependencies
+        # 调试模式：记录本次请求各阶段的耗时、令牌数、工具调用和缓存命中
+        profiler = start_profiling() if request.debug or x_debug_timings in ("1", "true") else None
         if not request.messages:
             logger.error("Invalid request: Empty messages")
             raise HTTPException(status_code=400, detail="Messages cannot be empty")
@@ -910,31 +911,35 @@ async def chat_completions(
         # 如果没有对话ID，说明是全新对话，创建新对话
         if not conversation_id:
             title = user_input[:20] + ("..." if len(user_input) > 20 else "") if user_input else "新对话"
-            conversation_id = conversation_db.create_conversation(current_user_id, title)
+            conversation_id = await conversation_repo.create_conversation(current_user_id, title)
             logger.info(f"Created new conversation: {conversation_id}")
         else:
             # 验证用户是否有权访问这个对话
-            conversation = conversation_db.get_conversation_by_id(conversation_id, current_user_id)
-            if not conversation:
+            if not await conversation_repo.owns_conversation(conversation_id, current_user_id):
                 raise HTTPException(status_code=404, detail="对话不存在或无权访问")
             logger.info(f"Using existing conversation: {conversation_id}")
+        set_span_attributes(**{"conversation.id": conversation_id, "user.id": current_user_id})
 
-        # 保存用户消息到当前对话
-        for msg in request.messages:
-            if msg.role == "user":  # 只保存用户消息
-                logger.info(f"Saving user message to conversation {conversation_id}: {msg.content[:50]}...")
-                # 生成消息的向量嵌入
-                message_embedding = llm_embedding.embed_query(msg.content)
-                # 保存消息并包含向量嵌入
-                conversation_db.add_message(conversation_id, msg.role, msg.content, message_embedding)
-
-        # 加载与当前用户输入最相关的历史消息作为上下文（最多5条）
-        relevant_messages = get_relevant_history_messages(conversation_id, user_input, top_k=5)
+        # 加载与当前用户输入最相关的历史消息作为上下文（最多5条），此时本轮的用户消息尚未入库
+        with profile_stage("history"):
+            relevant_messages = await get_relevant_history_messages(conversation_id, user_input, top_k=5)
         logger.info(f"Loaded {len(relevant_messages)} relevant history messages for conversation {conversation_id}")
 
+        # 保存用户消息到当前对话（只保存用户消息），向量计算和入库由后台写入器完成
+        user_messages = [msg for msg in request.messages if msg.role == "user"]
+        if user_messages:
+            logger.info(f"Saving {len(user_messages)} user messages to conversation {conversation_id}: "
+                        f"{user_messages[-1].content[:50]}...")
+            try:
+                await message_writer.asubmit(conversation_id, [
+                    {"role": msg.role, "content": msg.content, "embed": True} for msg in user_messages
+                ])
+            except MessageQueueFull:
+                raise HTTPException(status_code=503, detail="服务繁忙，请稍后重试", headers={"Retry-After": "5"})
+
         # 构建完整的消息列表：相关历史消息 + 当前用户输入
         all_messages = []
-        for msg in relevant_messages:
+        for msg in relevant_messages + [{"role": msg.role, "content": msg.content} for msg in user_messages]:
             all_messages.append({
                 "role": msg['role'],
                 "content": msg['content']
@@ -951,38 +956,67 @@ async def chat_completions(
 
         # 使用完整的消息列表（所有历史消息）调用AI
         if request.stream:
-            response = await handle_stream_response(all_messages, graph, config, conversation_id)
+            # 流式响应的许可在响应结束（发送完毕或客户端断开）后释放
+            response = await handle_stream_response(all_messages, graph, config, conversation_id, profiler, permit)
+            streaming = True
+            # 流式响应发送完毕后再提交记忆抽取
+            response.background = BackgroundTask(memory_manager.enqueue, current_user_id, user_input)
             return response
 
         # 非流式输出
-        response = await handle_non_stream_response(all_messages, graph, tool_config, config)
-
-        # 立即保存助手消息到数据库
-        if hasattr(response, 'body'):
-            import json
-            response_data = json.loads(response.body.decode())
-            assistant_content = response_data['choices'][0]['message']['content']
-            logger.info(f"Saving assistant message to conversation {conversation_id}: {assistant_content[:50]}...")
-            # 生成助手消息的向量嵌入
-            assistant_embedding = llm_embedding.embed_query(assistant_content)
-            # 保存助手消息并包含向量嵌入
-            conversation_db.add_message(conversation_id, "assistant", assistant_content, assistant_embedding)
-
-        # 返回对话ID和更新后的对话信息
-        response_data = json.loads(response.body.decode())
+        with profile_stage("graph"):
+            result = await handle_non_stream_response(all_messages, graph, config)
+
+        # 提交助手消息，响应无需等待入库
+        if result.answer:
+            logger.info(f"Saving assistant message to conversation {conversation_id}: {result.answer[:50]}...")
+            # 助手消息连同向量嵌入由后台写入器保存
+            try:
+                await message_writer.asubmit(conversation_id,
+                                             [{"role": "assistant", "content": result.answer, "embed": True}])
+            except MessageQueueFull:
+                # 回复照常返回，写入队列持续满载时只能放弃保存（已记录错误日志）
+                pass
+            # 后台折叠较早的对话内容
+            summarizer.submit(config, conversation_id)
+
+        # 构造响应，附带对话ID和更新后的对话信息
+        response_data = ChatCompletionResponse(
+            choices=[
+                ChatCompletionResponseChoice(
+                    index=0,
+                    message=Message(role="assistant", content=result.answer or "No response generated"),
+                    finish_reason="stop"
+                )
+            ],
+            usage=ChatCompletionUsage(
+                prompt_tokens=result.input_tokens,
+                completion_tokens=result.output_tokens,
+                total_tokens=result.input_tokens + result.output_tokens
+            )
+        ).model_dump()
         response_data['conversation_id'] = conversation_id
 
         # 获取更新后的对话信息
-        updated_conversation = conversation_db.get_conversation_by_id(conversation_id, current_user_id)
+        updated_conversation = await conversation_repo.get_conversation_by_id(conversation_id, current_user_id)
         response_data['conversation'] = updated_conversation
+        if profiler is not None:
+            response_data['timings'] = profiler.to_dict()
 
-        return JSONResponse(content=response_data)
+        # 响应发送完毕后再提交记忆抽取
+        return JSONResponse(content=response_data,
+                            background=BackgroundTask(memory_manager.enqueue, current_user_id, user_input))
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error handling chat completion: {str(e)}")
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        if not streaming:
+            permit.release()
 
 
 if __name__ == "__main__":
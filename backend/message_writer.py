@@ -0,0 +1,176 @@
+"""消息异步写入（write-behind）
+
+对话接口只把消息放入有界队列即返回，后台线程按批次计算向量并写入 Postgres：
+同一对话的消息合并为一次 ConversationDB.add_messages 调用，写入失败时按指数退避重试。
+flush(conversation_id) 等待该对话已提交的消息全部落库，读取对话历史前调用以保证
+同一进程内的读己之写；多进程部署时只保证本进程提交的消息。
+
+队列满时提交方最多等待 Config.MESSAGE_WRITE_SUBMIT_TIMEOUT 秒，仍无空位则抛出 MessageQueueFull，
+写入始终由后台线程按提交顺序完成。事件循环中应使用 asubmit，等待在线程中进行，不阻塞事件循环。
+"""
+import asyncio
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+from utils.config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class MessageQueueFull(Exception):
+    """写入队列在等待时间内一直是满的"""
+    pass
+
+
+class MessageWriter:
+    def __init__(self, conversation_db, embedding=None,
+                 max_queue_size: int = Config.MESSAGE_WRITE_QUEUE_SIZE,
+                 batch_size: int = Config.MESSAGE_WRITE_BATCH_SIZE,
+                 flush_interval: float = Config.MESSAGE_WRITE_INTERVAL,
+                 max_retries: int = Config.MESSAGE_WRITE_MAX_RETRIES,
+                 submit_timeout: float = Config.MESSAGE_WRITE_SUBMIT_TIMEOUT):
+        self.conversation_db = conversation_db
+        self.embedding = embedding
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.submit_timeout = submit_timeout
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        # asubmit 在队列满时把提交交给单线程执行器等待空位，按提交顺序入队；
+        # 仍有等待中的提交时，后续提交也走执行器，避免越过前面的消息。计数只在事件循环线程中修改
+        self._handoff = ThreadPoolExecutor(max_workers=1, thread_name_prefix="message-submit")
+        self._handoffs = 0
+        # 每个对话尚未落库的消息数
+        self._pending = defaultdict(int)
+        self._pending_cond = threading.Condition()
+        self._stopped = threading.Event()
+        self._worker = threading.Thread(target=self._run, daemon=True, name="message-writer")
+        self._worker.start()
+
+    def submit(self, conversation_id: str, messages: List[dict], timeout: Optional[float] = None) -> None:
+        """提交待写入的消息，不等待落库；队列满时最多等待 timeout 秒（默认 submit_timeout）
+
+        Args:
+            conversation_id: 对话ID。
+            messages: 消息字典列表，包含 role、content，可选 embedding 和 timestamp；
+                      embed 为 True 且没有 embedding 时由后台线程计算向量。
+            timeout: 队列满时的等待时间，为0时不等待。
+
+        Raises:
+            MessageQueueFull: 等待时间内队列一直是满的。
+        """
+        if not messages:
+            return
+        if not self._enqueue(conversation_id, messages, self.submit_timeout if timeout is None else timeout):
+            logger.error(f"Message write queue is full, rejected {len(messages)} messages "
+                         f"for conversation {conversation_id}")
+            raise MessageQueueFull("消息写入队列已满")
+
+    async def asubmit(self, conversation_id: str, messages: List[dict]) -> None:
+        """在事件循环中提交消息：队列有空位时直接入队，否则在线程中等待，参数和异常与 submit 相同"""
+        if not messages:
+            return
+        if not self._handoffs and self._enqueue(conversation_id, messages, 0):
+            return
+        self._handoffs += 1
+        try:
+            await asyncio.wrap_future(self._handoff.submit(self.submit, conversation_id, messages))
+        finally:
+            self._handoffs -= 1
+
+    def _enqueue(self, conversation_id: str, messages: List[dict], timeout: float) -> bool:
+        with self._pending_cond:
+            self._pending[conversation_id] += len(messages)
+        try:
+            self.queue.put((conversation_id, messages), block=timeout > 0, timeout=timeout if timeout > 0 else None)
+            return True
+        except queue.Full:
+            self._done(conversation_id, len(messages))
+            return False
+
+    def _run(self):
+        while not self._stopped.is_set() or not self.queue.empty():
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                continue
+            # 凑批：队列中已有的消息一并写入
+            count = len(batch[0][1])
+            while count < self.batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+                count += len(item[1])
+            self.process_batch(batch)
+
+    def process_batch(self, batch: List[tuple]) -> None:
+        """按对话分组写入，组内保持提交顺序"""
+        grouped = OrderedDict()
+        for conversation_id, messages in batch:
+            grouped.setdefault(conversation_id, []).extend(messages)
+        for conversation_id, messages in grouped.items():
+            self._write(conversation_id, messages)
+
+    def _embed(self, messages: List[dict]) -> List[dict]:
+        to_embed = [i for i, msg in enumerate(messages) if msg.get("embed") and not msg.get("embedding")]
+        if not to_embed or self.embedding is None:
+            return messages
+        try:
+            vectors = self.embedding.embed_documents([messages[i]["content"] for i in to_embed])
+        except Exception as e:
+            # 向量只用于相似度检索，计算失败时消息照常写入
+            logger.error(f"Error embedding messages before write: {e}")
+            return messages
+        messages = list(messages)
+        for i, vector in zip(to_embed, vectors):
+            messages[i] = {**messages[i], "embedding": vector}
+        return messages
+
+    def _write(self, conversation_id: str, messages: List[dict]) -> None:
+        try:
+            messages = self._embed(messages)
+            for attempt in range(self.max_retries + 1):
+                try:
+                    self.conversation_db.add_messages(conversation_id, messages)
+                    return
+                except Exception as e:
+                    if attempt == self.max_retries:
+                        logger.error(f"Dropping {len(messages)} messages for conversation {conversation_id} "
+                                     f"after {attempt + 1} failed attempts: {e}")
+                        return
+                    delay = min(0.1 * 2 ** attempt, 5.0)
+                    logger.warning(f"Error writing messages for conversation {conversation_id}, "
+                                   f"retrying in {delay:.1f}s: {e}")
+                    time.sleep(delay)
+        finally:
+            self._done(conversation_id, len(messages))
+
+    def _done(self, conversation_id: str, count: int) -> None:
+        with self._pending_cond:
+            self._pending[conversation_id] -= count
+            if self._pending[conversation_id] <= 0:
+                del self._pending[conversation_id]
+            self._pending_cond.notify_all()
+
+    def flush(self, conversation_id: Optional[str] = None, timeout: Optional[float] = 30.0) -> bool:
+        """等待对话（为 None 时为所有对话）已提交的消息落库，超时返回 False"""
+        with self._pending_cond:
+            return self._pending_cond.wait_for(
+                lambda: not (self._pending.get(conversation_id) if conversation_id else self._pending),
+                timeout=timeout
+            )
+
+    def shutdown(self, timeout: float = 30.0) -> None:
+        """停止后台线程，写完队列中剩余的消息"""
+        self._handoff.shutdown(wait=True)
+        self._stopped.set()
+        self._worker.join(timeout=timeout)
+        if self._worker.is_alive():
+            logger.error(f"Message writer did not finish within {timeout}s, "
+                         f"{self.queue.qsize()} batches may be lost")
@@ -18,6 +18,8 @@ class ChatCompletionRequest(BaseModel):
     messages: List[Message]
     stream: bool = False
     conversation_id: Optional[str] = None
+    # 为 true 时在响应中附带各阶段耗时（timings），也可通过请求头 X-Debug-Timings: 1 开启
+    debug: bool = False
 
 
 # 定义ChatCompletionResponseChoice类
@@ -27,12 +29,20 @@ class ChatCompletionResponseChoice(BaseModel):
     finish_reason: Optional[str] = None
 
 
+# 定义ChatCompletionUsage类，本轮所有LLM调用的令牌用量
+class ChatCompletionUsage(BaseModel):
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    total_tokens: int = 0
+
+
 # 定义ChatCompletionResponse类
 class ChatCompletionResponse(BaseModel):
     id: str = Field(default_factory=lambda: f"chatcmpl-{uuid.uuid4().hex}")
     object: str = "chat.completion"
     created: int = Field(default_factory=lambda: int(time.time()))
     choices: List[ChatCompletionResponseChoice]
+    usage: Optional[ChatCompletionUsage] = None
     system_fingerprint: Optional[str] = None
 
 
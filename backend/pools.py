@@ -0,0 +1,169 @@
+"""数据库连接池
+
+按负载类型划分独立的连接池，避免相互争抢连接：
+- app: FastAPI 接口的异步数据访问（repository.py）；
+- checkpoint: LangGraph 检查点（PostgresSaver）和长期记忆（PostgresStore）；
+- background: 消息写入、对话摘要、检查点清理等后台任务及建表。
+
+各连接池记录获取连接的等待时间直方图，PoolMonitor 周期性检查使用率和等待时间，
+超过阈值时输出告警日志。
+"""
+import logging
+import threading
+import time
+from typing import Dict, Optional
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
+from utils.config import Config
+from utils.metrics import Histogram, format_header, format_histogram, format_sample, registry
+
+logger = logging.getLogger(__name__)
+
+
+class MonitoredConnectionPool(ConnectionPool):
+    """记录获取连接等待时间（毫秒）的同步连接池"""
+
+    def __init__(self, *args, **kwargs):
+        self.wait_histogram = Histogram()
+        super().__init__(*args, **kwargs)
+
+    def getconn(self, timeout: Optional[float] = None):
+        started_at = time.perf_counter()
+        try:
+            return super().getconn(timeout=timeout)
+        finally:
+            self.wait_histogram.observe((time.perf_counter() - started_at) * 1000)
+
+
+class MonitoredAsyncConnectionPool(AsyncConnectionPool):
+    """记录获取连接等待时间（毫秒）的异步连接池"""
+
+    def __init__(self, *args, **kwargs):
+        self.wait_histogram = Histogram()
+        super().__init__(*args, **kwargs)
+
+    async def getconn(self, timeout: Optional[float] = None):
+        started_at = time.perf_counter()
+        try:
+            return await super().getconn(timeout=timeout)
+        finally:
+            self.wait_histogram.observe((time.perf_counter() - started_at) * 1000)
+
+
+# 已创建的连接池，名称 -> 连接池
+pools: Dict[str, object] = {}
+
+
+def connection_kwargs(**extra) -> dict:
+    # 自动提交、无预准备阈值、5秒连接超时
+    return {"autocommit": True, "prepare_threshold": 0, "connect_timeout": 5, **extra}
+
+
+def create_pool(name: str, min_size: int, max_size: int, timeout: float = 10,
+                conninfo: str = Config.DB_URI, **kwargs) -> MonitoredConnectionPool:
+    """创建并打开同步连接池"""
+    pool = MonitoredConnectionPool(conninfo=conninfo, min_size=min_size, max_size=max_size,
+                                   kwargs=kwargs or connection_kwargs(), timeout=timeout, open=False, name=name)
+    pool.open()
+    pools[name] = pool
+    logger.info(f"Database connection pool '{name}' initialized (min={min_size}, max={max_size})")
+    return pool
+
+
+def register_pool(name: str, pool) -> None:
+    """登记在别处创建的连接池（如异步连接池），纳入监控"""
+    pools[name] = pool
+
+
+def pool_usage(pool) -> dict:
+    """连接池的瞬时状态"""
+    stats = pool.get_stats()
+    size = stats.get("pool_size", 0)
+    available = stats.get("pool_available", 0)
+    return {
+        "max_size": pool.max_size,
+        "size": size,
+        "in_use": size - available,
+        "waiting": stats.get("requests_waiting", 0),
+    }
+
+
+def collect_pool_metrics() -> list:
+    """以 Prometheus 格式输出各连接池的等待时间直方图和连接使用情况"""
+    lines = format_header("db_pool_wait_ms", "Time spent waiting for a pooled connection in milliseconds",
+                          "histogram")
+    for name, pool in list(pools.items()):
+        lines.extend(format_histogram("db_pool_wait_ms", pool.wait_histogram, {"pool": name}))
+    gauges = (
+        ("db_pool_connections_in_use", "Connections currently checked out", "in_use"),
+        ("db_pool_connections", "Connections currently open", "size"),
+        ("db_pool_max_connections", "Configured maximum pool size", "max_size"),
+        ("db_pool_requests_waiting", "Requests waiting for a connection", "waiting"),
+    )
+    usages = {name: pool_usage(pool) for name, pool in list(pools.items()) if not pool.closed}
+    for metric, documentation, field in gauges:
+        lines.extend(format_header(metric, documentation, "gauge"))
+        for name, usage in usages.items():
+            lines.append(format_sample(metric, usage[field], {"pool": name}))
+    return lines
+
+
+registry.register_collector(collect_pool_metrics)
+
+
+class PoolMonitor:
+    """周期性检查各连接池，使用率或等待时间超过阈值时告警，恢复正常后输出恢复日志"""
+
+    def __init__(self, interval: int = Config.DB_POOL_MONITOR_INTERVAL,
+                 saturation_threshold: float = Config.DB_POOL_SATURATION_THRESHOLD,
+                 wait_alert_ms: float = Config.DB_POOL_WAIT_ALERT_MS):
+        self.interval = interval
+        self.saturation_threshold = saturation_threshold
+        self.wait_alert_ms = wait_alert_ms
+        # 上次检查时各连接池的等待时间分桶计数，用于计算检查间隔内的分位数
+        self._last_counts = {}
+        self._alerting = set()
+        self._stopped = threading.Event()
+
+    def check(self) -> None:
+        for name, pool in list(pools.items()):
+            if pool.closed:
+                continue
+            try:
+                usage = pool_usage(pool)
+                counts = pool.wait_histogram.snapshot()[0]
+                last = self._last_counts.get(name, [0] * len(counts))
+                self._last_counts[name] = counts
+                delta = [c - l for c, l in zip(counts, last)]
+                p95 = pool.wait_histogram.quantile_upper_bound(0.95, delta)
+                saturation = usage["in_use"] / usage["max_size"] if usage["max_size"] else 0
+                logger.info(f"Connection pool '{name}' status: {usage['in_use']}/{usage['max_size']} in use, "
+                            f"{usage['waiting']} waiting, p95 wait <= {p95}ms")
+                if saturation >= self.saturation_threshold or usage["waiting"] > 0 or p95 > self.wait_alert_ms:
+                    self._alerting.add(name)
+                    logger.warning(f"Connection pool '{name}' saturated: {usage['in_use']}/{usage['max_size']} in use, "
+                                   f"{usage['waiting']} waiting, p95 wait <= {p95}ms")
+                elif name in self._alerting:
+                    self._alerting.discard(name)
+                    logger.info(f"Connection pool '{name}' recovered")
+            except Exception as e:
+                logger.error(f"Failed to monitor connection pool '{name}': {e}")
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.check()
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self._run, daemon=True, name="pool-monitor")
+        thread.start()
+        return thread
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+
+def close_pools() -> None:
+    """关闭所有同步连接池，异步连接池需由创建方 await close()"""
+    for name, pool in list(pools.items()):
+        if isinstance(pool, ConnectionPool) and not pool.closed:
+            pool.close()
+            logger.info(f"Database connection pool '{name}' closed")
@@ -1,13 +1,10 @@
 # 导入日志模块，用于记录程序运行时的信息
+import contextvars
+import functools
 import logging
-from concurrent_log_handler import ConcurrentRotatingFileHandler
 import sys
 import threading
 import time
-# 导入UUID模块，用于生成唯一标识符
-import uuid
-# 从html模块导入escape函数，用于转义HTML特殊字符
-from html import escape
 # 从typing模块导入类型提示工具
 from typing import Literal, Annotated, Sequence, Optional
 # 从typing_extensions导入TypedDict，用于定义类型化的字典
@@ -15,7 +12,7 @@ from typing_extensions import TypedDict
 # 导入LangChain的提示模板类
 from langchain_core.prompts import PromptTemplate, ChatPromptTemplate
 # 导入LangChain的消息基类
-from langchain_core.messages import BaseMessage
+from langchain_core.messages import BaseMessage, RemoveMessage
 # 导入消息处理函数，用于追加消息
 from langgraph.graph.message import add_messages
 # 导入预构建的工具条件和工具节点
@@ -33,40 +30,36 @@ from langgraph.store.postgres import PostgresStore
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 # 导入 psycopg2 的操作异常类，用于捕获数据库连接错误
 from psycopg2 import OperationalError
-# 导入Postgres检查点保存类
-from langgraph.checkpoint.postgres import PostgresSaver
+# 导入支持可配置持久化模式的Postgres检查点保存类
+from checkpointer import LightweightPostgresSaver, flush_checkpoints
+from pools import create_pool, PoolMonitor
 # 导入PostgreSQL连接池类
 from psycopg_pool import ConnectionPool
 # 导入Pydantic的基类和字段定义工具
 from pydantic import BaseModel, Field
 # 导入自定义的get_llm函数，用于获取LLM模型
 from utils.llms import get_llm
+# 导入多服务路由的按节点模型选择
+from utils.llm_router import node_llm
 # 导入工具配置模块
 from utils.tools_config import get_tools
 # 导入统一的 Config 类
 from utils.config import Config
-
-# # 设置日志基本配置，级别为DEBUG或INFO
+# 导入带缓存的跨线程记忆检索函数和记忆管理器
+from utils.memory import search_memories, MemoryManager
+# 导入图节点、工具调用的指标
+from utils.metrics import (graph_node_errors, graph_node_latency, graph_rewrite_limit_reached, graph_rewrites,
+                           tool_calls, tool_latency)
+# 导入链路追踪
+from utils.tracing import tracer
+# 导入请求级耗时分析
+from utils.profiler import profile_stage, record_tool
+# 导入异步日志
+from utils.logger import setup_logging
+
+# 安装异步日志，级别由 Config.LOG_LEVEL/LOG_LEVELS 控制
+setup_logging()
 logger = logging.getLogger(__name__)
-# 设置日志器级别为DEBUG
-logger.setLevel(logging.DEBUG)
-# logger.setLevel(logging.INFO)
-logger.handlers = []  # 清空默认处理器
-# 使用ConcurrentRotatingFileHandler
-handler = ConcurrentRotatingFileHandler(
-    # 日志文件
-    Config.LOG_FILE,
-    # 日志文件最大允许大小为5MB，达到上限后触发轮转
-    maxBytes=Config.MAX_BYTES,
-    # 在轮转时，最多保留3个历史日志文件
-    backupCount=Config.BACKUP_COUNT
-)
-# 设置处理器级别为DEBUG
-handler.setLevel(logging.DEBUG)
-handler.setFormatter(logging.Formatter(
-    "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-))
-logger.addHandler(handler)
 
 
 # 定义消息状态类，使用TypedDict进行类型注解
@@ -77,6 +70,10 @@ class MessagesState(TypedDict):
     relevance_score: Annotated[Optional[str], "Relevance score of retrieved documents, 'yes' or 'no'"]
     # 定义rewrite_count字段，用于跟踪问题重写的次数，达到次数退出graph的递归循环
     rewrite_count: Annotated[int, "Number of times query has been rewritten"]
+    # 定义summary字段，存储由后台摘要任务折叠的较早对话内容
+    summary: Annotated[Optional[str], "Running summary of older conversation turns"]
+    # 定义user_info字段，缓存本轮检索到的跨线程记忆，每轮输入时重置为None
+    user_info: Annotated[Optional[str], "Cross-thread memories retrieved once per turn"]
 
 
 # 定义工具配置管理类，用于管理工具及其路由配置
@@ -159,6 +156,12 @@ class ParallelToolNode(ToolNode):
     # 定义私有方法，用于执行单个工具调用，返回ToolMessage对象
     def _run_single_tool(self, tool_call: dict, tool_map: dict) -> ToolMessage:
         """执行单个工具调用"""
+        # 记录工具调用开始时间，用于统计耗时
+        started_at = time.perf_counter()
+        # 每个工具调用一个 span，挂在 call_tools 节点的 span 下
+        span = tracer.start_span(f"tool.{tool_call.get('name', 'unknown')}",
+                                 attributes={"tool.name": tool_call.get("name", "unknown")})
+        status = "error"
         # 使用try-except块捕获工具执行中的异常
         try:
             # 从tool_call字典中提取工具名称
@@ -170,6 +173,8 @@ class ParallelToolNode(ToolNode):
                 raise ValueError(f"Tool {tool_name} not found")
             # 调用工具的invoke方法，传入工具参数，执行工具逻辑
             result = tool.invoke(tool_call["args"])
+            status = "success"
+            tool_calls.inc(tool=tool_name, status=status)
             # 创建并返回ToolMessage对象，包含工具执行结果、调用ID和工具名称
             return ToolMessage(
                 content=str(result),
@@ -180,12 +185,20 @@ class ParallelToolNode(ToolNode):
         except Exception as e:
             # 记录工具执行失败的错误日志，包含工具名称和异常信息
             logger.error(f"Error executing tool {tool_call.get('name', 'unknown')}: {e}")
+            tool_calls.inc(tool=tool_call.get("name", "unknown"), status="error")
+            span.record_exception(e)
+            span.set_attribute("tool.error", True)
             # 返回包含错误内容的ToolMessage对象，用于状态更新
             return ToolMessage(
                 content=f"Error: {str(e)}",
                 tool_call_id=tool_call["id"],
                 name=tool_call.get("name", "unknown")
             )
+        finally:
+            elapsed_ms = (time.perf_counter() - started_at) * 1000
+            tool_latency.observe(elapsed_ms, tool=tool_call.get("name", "unknown"))
+            record_tool(tool_call.get("name", "unknown"), elapsed_ms, status)
+            span.end()
 
     # 定义可调用方法，使实例可直接调用，实现并行执行所有工具调用
     def __call__(self, state: dict) -> dict:
@@ -209,8 +222,9 @@ class ParallelToolNode(ToolNode):
         # 使用线程池管理并行任务，max_workers控制最大并发线程数
         with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
             # 使用字典推导式提交所有工具调用任务到线程池，返回future到tool_call的映射
+            # 每个任务在当前上下文的副本中执行，工具的 span 才能关联到当前节点的 span
             future_to_tool = {
-                executor.submit(self._run_single_tool, tool_call, tool_map): tool_call
+                executor.submit(contextvars.copy_context().run, self._run_single_tool, tool_call, tool_map): tool_call
                 for tool_call in tool_calls
             }
             # 遍历已完成的future对象，按完成顺序收集结果
@@ -279,9 +293,9 @@ def filter_messages(messages: list) -> list:
     return filtered[-5:] if len(filtered) > 5 else filtered
 
 
-# 定义跨线程的持久化存储的存储和过滤函数
+# 定义跨线程的持久化存储的检索函数
 def store_memory(question: BaseMessage, config: RunnableConfig, store: BaseStore) -> str:
-    """存储用户输入中的记忆信息。
+    """检索与用户输入相关的记忆信息。新记忆由 MemoryManager 在响应发送后异步抽取写入。
 
     Args:
         question: 用户输入的消息。
@@ -291,19 +305,11 @@ def store_memory(question: BaseMessage, config: RunnableConfig, store: BaseStore
     Returns:
         str: 用户相关的记忆信息字符串。
     """
-    namespace = ("memories", config["configurable"]["user_id"])
+    user_id = config["configurable"]["user_id"]
     try:
-        # 在跨线程存储数据库中搜索相关记忆
-        memories = store.search(namespace, query=str(question.content))
-        user_info = "\n".join([d.value["data"] for d in memories])
-
-        # 如果包含“记住”，存储新记忆
-        if "记住" in question.content.lower():
-            memory = escape(question.content)
-            store.put(namespace, str(uuid.uuid4()), {"data": memory})
-            logger.info(f"Stored memory: {memory}")
-
-        return user_info
+        # 在跨线程存储数据库中搜索相关记忆，结果按用户缓存，写入新记忆时失效
+        memories = search_memories(store, user_id, str(question.content))
+        return "\n".join([d.value["data"] for d in memories])
     except Exception as e:
         logger.error(f"Error in store_memory: {e}")
         return ""
@@ -335,7 +341,7 @@ def create_chain(llm_chat, template_file: str, structured_output=None):
         # 先检查缓存，无锁访问
         if template_file in create_chain.prompt_cache:
             prompt_template = create_chain.prompt_cache[template_file]
-            logger.info(f"Using cached prompt template for {template_file}")
+            logger.debug("Using cached prompt template for %s", template_file)
         else:
             # 使用锁保护缓存访问
             with create_chain.lock:
@@ -360,8 +366,8 @@ def create_chain(llm_chat, template_file: str, structured_output=None):
 @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=10),
        retry=retry_if_exception_type(OperationalError))
 def test_connection(db_connection_pool: ConnectionPool) -> bool:
-    """测试连接池是否可用"""
-    with db_connection_pool.getconn() as conn:
+    """测试连接池是否可用，连接池暂时占满时最多等待连接池的获取超时时间"""
+    with db_connection_pool.connection() as conn:
         with conn.cursor() as cursor:
             cursor.execute("SELECT 1")
             result = cursor.fetchone()
@@ -370,26 +376,22 @@ def test_connection(db_connection_pool: ConnectionPool) -> bool:
     return True
 
 
-# 周期性检查连接池状态，记录可用连接数和异常情况，提前预警
-def monitor_connection_pool(db_connection_pool: ConnectionPool, interval: int = 60):
-    """周期性监控连接池状态"""
-
-    def _monitor():
-        while not db_connection_pool.closed:
-            try:
-                stats = db_connection_pool.get_stats()
-                active = stats.get("connections_in_use", 0)
-                total = db_connection_pool.max_size
-                logger.info(f"Connection db_connection_pool status: {active}/{total} connections in use")
-                if active >= total * 0.8:
-                    logger.warning(f"Connection db_connection_pool nearing capacity: {active}/{total}")
-            except Exception as e:
-                logger.error(f"Failed to monitor connection db_connection_pool: {e}")
-            time.sleep(interval)
-
-    monitor_thread = threading.Thread(target=_monitor, daemon=True)
-    monitor_thread.start()
-    return monitor_thread
+# 包装节点函数，统计每个节点的耗时和失败次数，并为每次执行创建一个 span
+def timed_node(name: str, fn):
+    # functools.wraps 保留原函数签名，LangGraph 据此决定是否传入 config
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            with tracer.start_as_current_span(f"graph.{name}", attributes={"graph.node": name}), \
+                    profile_stage(f"graph.{name}"):
+                return fn(*args, **kwargs)
+        except Exception:
+            graph_node_errors.inc(node=name)
+            raise
+        finally:
+            graph_node_latency.observe((time.perf_counter() - started_at) * 1000, node=name)
+    return wrapper
 
 
 # 定义 Node agent分诊函数
@@ -408,16 +410,16 @@ def agent(state: MessagesState, config: RunnableConfig, *, store: BaseStore, llm
     """
     # 记录代理开始处理查询
     logger.info("Agent processing user query")
-    # 定义存储命名空间，使用用户ID
-    namespace = ("memories", config["configurable"]["user_id"])
     # 尝试执行以下代码块
     try:
         # 获取最后一条消息即用户问题
         question = state["messages"][-1]
-        logger.info(f"agent question:{question}")
+        logger.debug("agent question:%s", question)
 
-        # 自定义跨线程持久化存储记忆并获取相关信息
-        user_info = store_memory(question, config, store)
+        # 自定义跨线程持久化存储记忆并获取相关信息，每轮只检索一次，rewrite 后再次进入 agent 时直接复用
+        user_info = state.get("user_info")
+        if user_info is None:
+            user_info = store_memory(question, config, store)
         # 自定义线程内存储逻辑 过滤消息
         messages = filter_messages(state["messages"])
 
@@ -427,10 +429,11 @@ def agent(state: MessagesState, config: RunnableConfig, *, store: BaseStore, llm
         # 创建代理处理链
         agent_chain = create_chain(llm_chat_with_tool, Config.PROMPT_TEMPLATE_TXT_AGENT)
         # 调用代理链处理消息
-        response = agent_chain.invoke({"question": question, "messages": messages, "userInfo": user_info})
+        response = agent_chain.invoke({"question": question, "messages": messages, "userInfo": user_info or "无",
+                                       "summary": state.get("summary") or "无"})
         # logger.info(f"Agent response: {response}")
-        # 返回更新后的对话状态
-        return {"messages": [response]}
+        # 返回更新后的对话状态，同时缓存本轮的记忆检索结果
+        return {"messages": [response], "user_info": user_info}
     # 捕获异常
     except Exception as e:
         # 记录错误日志
@@ -517,6 +520,7 @@ def rewrite(state: MessagesState, llm_chat) -> dict:
         # logger.info(f"rewrite question:{response}")
         # 重写次数+1
         rewrite_count = state.get("rewrite_count", 0) + 1
+        graph_rewrites.inc()
         logger.info(f"Rewrite count: {rewrite_count}")
         # 返回更新后的对话状态
         return {"messages": [response], "rewrite_count": rewrite_count}
@@ -646,6 +650,7 @@ def route_after_grade(state: MessagesState) -> str:
 
     # 如果重写次数超过 3 次，强制路由到 generate
     if rewrite_count >= 3:
+        graph_rewrite_limit_reached.inc()
         logger.info("Max rewrite limit reached, proceeding to generate")
         return "generate"
 
@@ -717,13 +722,6 @@ def create_graph(db_connection_pool: ConnectionPool, llm_chat, llm_embedding, to
         logger.error("Connection db_connection_pool is None or closed")
         raise ConnectionPoolError("数据库连接池未初始化或已关闭")
     try:
-        # 获取当前活动连接数和最大连接数
-        active_connections = db_connection_pool.get_stats().get("connections_in_use", 0)
-        max_connections = db_connection_pool.max_size
-        if active_connections >= max_connections:
-            logger.error(
-                f"Connection db_connection_pool exhausted: {active_connections}/{max_connections} connections in use")
-            raise ConnectionPoolError("连接池已耗尽，无可用连接")
         if not test_connection(db_connection_pool):
             raise ConnectionPoolError("连接池测试失败")
         logger.info("Connection db_connection_pool status: OK, test connection successful")
@@ -736,8 +734,8 @@ def create_graph(db_connection_pool: ConnectionPool, llm_chat, llm_embedding, to
 
     # 线程内持久化存储
     try:
-        # 创建Postgres检查点保存实例
-        checkpointer = PostgresSaver(db_connection_pool)
+        # 创建Postgres检查点保存实例，持久化模式由 Config.CHECKPOINT_DURABILITY 决定
+        checkpointer = LightweightPostgresSaver(db_connection_pool, durability=Config.CHECKPOINT_DURABILITY)
         # 初始化检查点
         checkpointer.setup()
     except Exception as e:
@@ -746,8 +744,8 @@ def create_graph(db_connection_pool: ConnectionPool, llm_chat, llm_embedding, to
 
     # 跨线程持久化存储
     try:
-        # 创建Postgres存储实例，指定嵌入维度和函数
-        store = PostgresStore(db_connection_pool, index={"dims": 1536, "embed": llm_embedding})
+        # 创建Postgres存储实例，指定嵌入维度和函数，仅对记忆文本字段计算向量
+        store = PostgresStore(db_connection_pool, index={"dims": 1536, "embed": llm_embedding, "fields": ["data"]})
         store.setup()
     except Exception as e:
         logger.error(f"Failed to setup PostgresStore: {e}")
@@ -756,16 +754,19 @@ def create_graph(db_connection_pool: ConnectionPool, llm_chat, llm_embedding, to
     # 创建状态图实例，使用MessagesState作为状态类型
     workflow = StateGraph(MessagesState)
     # 添加代理节点
-    workflow.add_node("agent", lambda state, config: agent(state, config, store=store, llm_chat=llm_chat,
-                                                           tool_config=tool_config))
+    workflow.add_node("agent", timed_node("agent", lambda state, config: agent(
+        state, config, store=store, llm_chat=node_llm(llm_chat, "agent"), tool_config=tool_config)))
     # 添加工具节点，使用并行工具节点
-    workflow.add_node("call_tools", ParallelToolNode(tool_config.get_tools(), max_workers=5))
+    # ToolNode 作为 Runnable 被调用时走的是父类逻辑，这里显式调用 ParallelToolNode.__call__ 以并行执行工具
+    tool_node = ParallelToolNode(tool_config.get_tools(), max_workers=5)
+    workflow.add_node("call_tools", timed_node("call_tools", lambda state: tool_node(state)))
     # 添加重写节点
-    workflow.add_node("rewrite", lambda state: rewrite(state, llm_chat=llm_chat))
+    workflow.add_node("rewrite", timed_node("rewrite", lambda state: rewrite(state, llm_chat=node_llm(llm_chat, "rewrite"))))
     # 添加生成节点
-    workflow.add_node("generate", lambda state: generate(state, llm_chat=llm_chat))
+    workflow.add_node("generate", timed_node("generate", lambda state: generate(state, llm_chat=node_llm(llm_chat, "generate"))))
     # 添加文档相关性评分节点
-    workflow.add_node("grade_documents", lambda state: grade_documents(state, llm_chat=llm_chat))
+    workflow.add_node("grade_documents", timed_node("grade_documents",
+                                                    lambda state: grade_documents(state, llm_chat=node_llm(llm_chat, "grade_documents"))))
 
     # 添加从起始到代理的边
     workflow.add_edge(START, end_key="agent")
@@ -787,6 +788,173 @@ def create_graph(db_connection_pool: ConnectionPool, llm_chat, llm_embedding, to
     return graph
 
 
+def checkpoint_id(snapshot) -> Optional[str]:
+    """状态快照对应的检查点ID"""
+    return (snapshot.config or {}).get("configurable", {}).get("checkpoint_id")
+
+
+# 后台滚动摘要：将较早的对话折叠进摘要，并裁剪检查点中的消息列表
+class ConversationSummarizer:
+    """后台对话摘要器。
+
+    每轮对话结束后提交一次摘要任务，当线程检查点中的消息数超过阈值时，
+    将较早的消息交给LLM并入滚动摘要，再通过 RemoveMessage 从检查点中删除，
+    使每轮的提示词长度和检查点读写体积保持基本稳定。
+
+    摘要在后台执行，期间下一轮对话可能已经开始：写回前重新读取检查点，
+    线程已推进（检查点ID变化或有待执行的节点）时放弃本次结果，由之后的轮次重新摘要，
+    避免覆盖新一轮写入的状态。conversations.summary 保存摘要的持久副本，
+    检查点中没有摘要（如线程检查点被清理）时以其作为已有摘要继续折叠。
+    """
+
+    def __init__(self, graph, llm_chat, conversation_db=None,
+                 trigger_messages: int = Config.SUMMARY_TRIGGER_MESSAGES,
+                 keep_messages: int = Config.SUMMARY_KEEP_MESSAGES,
+                 max_workers: int = 2):
+        self.graph = graph
+        self.llm_chat = llm_chat
+        # 可选的对话数据库，用于将摘要持久化到 conversations 表
+        self.conversation_db = conversation_db
+        self.trigger_messages = trigger_messages
+        self.keep_messages = keep_messages
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="summarizer")
+        # 正在摘要的线程ID集合，同一线程同一时间只允许一个摘要任务
+        self._running = set()
+        self._lock = threading.Lock()
+
+    def submit(self, config: dict, conversation_id: Optional[str] = None):
+        """提交后台摘要任务，同一线程已有任务在执行时直接跳过"""
+        thread_id = config["configurable"]["thread_id"]
+        with self._lock:
+            if thread_id in self._running:
+                logger.info(f"Summary already running for thread {thread_id}, skipping")
+                return None
+            self._running.add(thread_id)
+        return self.executor.submit(self._run, config, conversation_id)
+
+    def _run(self, config: dict, conversation_id: Optional[str]) -> bool:
+        thread_id = config["configurable"]["thread_id"]
+        try:
+            return self.summarize(config, conversation_id)
+        except Exception as e:
+            logger.error(f"Error summarizing thread {thread_id}: {e}")
+            return False
+        finally:
+            with self._lock:
+                self._running.discard(thread_id)
+
+    def summarize(self, config: dict, conversation_id: Optional[str] = None) -> bool:
+        """同步执行一次摘要，返回是否裁剪了检查点中的消息"""
+        snapshot = self.graph.get_state(config)
+        # 图仍有待执行的节点（上一轮异常中断或正在运行），不做裁剪
+        if snapshot.next:
+            return False
+        messages = list(snapshot.values.get("messages", []))
+        if len(messages) <= self.trigger_messages:
+            return False
+
+        # 保留区从一条用户消息开始，避免把一轮对话拆成两半
+        cut = len(messages) - self.keep_messages
+        while cut > 0 and messages[cut].__class__.__name__ != "HumanMessage":
+            cut -= 1
+        if cut <= 0:
+            return False
+        folded = messages[:cut]
+
+        # 仅将用户与助手的消息并入摘要，工具输出截断后附带
+        lines = []
+        for msg in folded:
+            name = msg.__class__.__name__
+            if name == "HumanMessage":
+                lines.append(f"用户: {msg.content}")
+            elif name == "AIMessage" and msg.content:
+                lines.append(f"助手: {msg.content}")
+            elif name == "ToolMessage":
+                lines.append(f"工具[{msg.name}]: {str(msg.content)[:200]}")
+
+        previous = snapshot.values.get("summary")
+        if not previous and self.conversation_db and conversation_id:
+            previous = self.conversation_db.get_conversation_summary(conversation_id)
+        summary_chain = create_chain(self.llm_chat, Config.PROMPT_TEMPLATE_TXT_SUMMARY)
+        response = summary_chain.invoke({
+            "summary": previous or "无",
+            "messages": "\n".join(lines)
+        })
+        summary = response.content
+
+        # 调用LLM期间线程可能已进入下一轮，此时写回会覆盖新一轮的状态，放弃本次摘要
+        latest = self.graph.get_state(config)
+        if latest.next or checkpoint_id(latest) != checkpoint_id(snapshot):
+            logger.info(f"Thread {config['configurable']['thread_id']} advanced during summarization, "
+                        f"discarding summary")
+            return False
+
+        # 以 generate 节点身份写回状态，generate 之后固定为 END，不会产生待执行节点
+        self.graph.update_state(
+            config,
+            {"messages": [RemoveMessage(id=msg.id) for msg in folded], "summary": summary},
+            as_node="generate"
+        )
+        if self.conversation_db and conversation_id:
+            self.conversation_db.update_conversation_summary(conversation_id, summary)
+        logger.info(f"Folded {len(folded)} messages into summary for thread {config['configurable']['thread_id']}")
+        return True
+
+    def shutdown(self, wait: bool = True):
+        """关闭后台线程池"""
+        self.executor.shutdown(wait=wait)
+
+
+# 一次图执行的结果
+class GraphRunResult(BaseModel):
+    # 最终回复，未生成回复时为 None
+    answer: Optional[str] = None
+    # 按调用顺序记录的工具名称
+    tool_calls: list = Field(default_factory=list)
+    # 本轮所有LLM回复的令牌数（来自消息的 usage_metadata）
+    input_tokens: int = 0
+    output_tokens: int = 0
+
+
+# 产生最终回复的节点
+ANSWER_NODES = ("agent", "generate")
+
+
+def run_graph(graph: StateGraph, inputs: dict, config: dict) -> GraphRunResult:
+    """执行一轮对话并收集结果，不记录中间消息内容。
+
+    使用 stream_mode="updates" 只接收各节点返回的增量，从中提取工具调用、令牌用量和最终回复。
+    最终回复由 generate 或不再调用工具的 agent 产生，此后图直接结束；流仍被完整消费，
+    以保证最后一个检查点被写入。
+
+    Args:
+        graph: 状态图实例。
+        inputs: 图的输入状态。
+        config: 运行时配置。
+
+    Returns:
+        GraphRunResult: 最终回复、工具调用和令牌用量。
+    """
+    result = GraphRunResult()
+    for update in graph.stream(inputs, config, stream_mode="updates"):
+        for node_name, value in update.items():
+            if not isinstance(value, dict) or not isinstance(value.get("messages"), list):
+                continue
+            for message in value["messages"]:
+                if not isinstance(message, BaseMessage):
+                    continue
+                usage = getattr(message, "usage_metadata", None)
+                if usage:
+                    result.input_tokens += usage.get("input_tokens", 0)
+                    result.output_tokens += usage.get("output_tokens", 0)
+                tool_calls = getattr(message, "tool_calls", None)
+                if tool_calls:
+                    result.tool_calls.extend(call.get("name", "unknown") for call in tool_calls)
+                elif node_name in ANSWER_NODES and message.content:
+                    result.answer = message.content
+    return result
+
+
 # 定义响应函数
 def graph_response(graph: StateGraph, user_input: str, config: dict, tool_config: ToolConfig) -> None:
     """处理用户输入并输出响应，区分工具输出和大模型输出，支持多工具。
@@ -798,7 +966,8 @@ def graph_response(graph: StateGraph, user_input: str, config: dict, tool_config
     """
     try:
         # 启动状态图流处理用户输入
-        events = graph.stream({"messages": [{"role": "user", "content": user_input}], "rewrite_count": 0}, config)
+        events = graph.stream({"messages": [{"role": "user", "content": user_input}], "rewrite_count": 0,
+                               "user_info": None}, config)
         # 遍历事件流
         for event in events:
             # 遍历事件中的值
@@ -843,6 +1012,9 @@ def graph_response(graph: StateGraph, user_input: str, config: dict, tool_config
     except Exception as e:
         logger.error(f"Error processing response: {e}")
         print("Assistant: 处理响应时发生未知错误")
+    finally:
+        # 一轮对话结束，写入缓存的检查点
+        flush_checkpoints(graph, config)
 
 
 # 定义主函数
@@ -860,23 +1032,16 @@ def main():
         # 创建 ToolConfig 实例
         tool_config = ToolConfig(tools)
 
-        # 定义数据库连接参数，自动提交且无预准备阈值，5秒超时
-        connection_kwargs = {"autocommit": True, "prepare_threshold": 0, "connect_timeout": 5}
-        # 创建数据库连接池，最大连接数20,最小保持2个活跃连接,从池中获取连接的最大等待时间10秒
-        db_connection_pool = ConnectionPool(conninfo=Config.DB_URI, max_size=20, min_size=2, kwargs=connection_kwargs,
-                                            timeout=10)
-
-        # 打开连接池
+        # 创建并打开检查点连接池，从池中获取连接的最大等待时间10秒
         try:
-            db_connection_pool.open()
-            logger.info("Database connection pool initialized")
-            logger.debug("Database connection pool initialized")
+            db_connection_pool = create_pool("checkpoint", Config.DB_CHECKPOINT_POOL_MIN_SIZE,
+                                             Config.DB_CHECKPOINT_POOL_MAX_SIZE)
         except Exception as e:
             logger.error(f"Failed to open connection pool: {e}")
             raise ConnectionPoolError(f"无法打开数据库连接池: {str(e)}")
 
         # 启动连接池监控 监控线程为守护线程，随主程序退出而停止
-        monitor_thread = monitor_connection_pool(db_connection_pool, interval=60)
+        PoolMonitor().start()
 
         # 创建状态图
         try:
@@ -890,6 +1055,9 @@ def main():
         # 保存状态图可视化（可选项，生成要注释掉）
         # save_graph_visualization(graph)
 
+        # 创建记忆管理器，在每轮回复后异步抽取用户记忆
+        memory_manager = MemoryManager(graph.store, llm_chat)
+
         # 打印机器人就绪提示
         print("聊天机器人准备就绪！输入 'quit'、'exit' 或 'q' 结束对话。")
         # 定义运行时配置，包含线程ID和用户ID
@@ -908,6 +1076,8 @@ def main():
                 continue
             # 处理用户输入并选择是否流式输出响应
             graph_response(graph, user_input, config, tool_config)
+            # 回复输出后再提交记忆抽取
+            memory_manager.enqueue(config["configurable"]["user_id"], user_input)
 
     except ConnectionPoolError as e:
         # 捕获连接池相关的异常
@@ -0,0 +1,289 @@
+"""异步数据访问层
+
+基于 psycopg_pool.AsyncConnectionPool，供 FastAPI 接口直接 await，不阻塞事件循环：
+- 连接通过 async with 自动归还连接池；
+- 连接级默认语句超时（Config.DB_STATEMENT_TIMEOUT_MS），单条查询可通过 timeout_ms 覆盖；
+- 高频查询使用服务端预处理语句（Config.DB_PREPARED_STATEMENTS，经 PgBouncer 事务池连接时需关闭）；
+- 使用 dict_row 行工厂直接返回字典。
+
+database.py 中的同步 UserDB/ConversationDB 只保留建表、用户导入和后台线程（消息写入、摘要）使用的方法。
+"""
+import logging
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import Any, Optional, Sequence, Tuple
+from psycopg.errors import UniqueViolation
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+from database import (
+    USERNAME_CONSTRAINT,
+    EMAIL_CONSTRAINT,
+    MESSAGE_CURSOR_EXISTS_QUERY,
+    build_conversations_page_query,
+    build_messages_page_query,
+    message_id_cursors,
+    encode_cursor,
+    owner_cache_key,
+)
+from model import UserInDB, User
+from pools import MonitoredAsyncConnectionPool, register_pool
+from utils.cache import cache
+from utils.config import Config
+from utils.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+
+def create_async_pool(conninfo: str = Config.DB_URI, min_size: int = Config.DB_ASYNC_POOL_MIN_SIZE,
+                      max_size: int = Config.DB_ASYNC_POOL_MAX_SIZE, name: str = "app") -> AsyncConnectionPool:
+    """创建（未打开的）异步连接池并纳入连接池监控，调用方需 await pool.open()"""
+    connection_kwargs = {
+        "autocommit": True,
+        "connect_timeout": 5,
+        # 连接级默认语句超时
+        "options": f"-c statement_timeout={Config.DB_STATEMENT_TIMEOUT_MS}",
+    }
+    if not Config.DB_PREPARED_STATEMENTS:
+        connection_kwargs["prepare_threshold"] = None
+    pool = MonitoredAsyncConnectionPool(conninfo=conninfo, min_size=min_size, max_size=max_size,
+                                        kwargs=connection_kwargs, timeout=10, open=False, name=name)
+    register_pool(name, pool)
+    return pool
+
+
+def _iso(value: Optional[datetime]) -> Optional[str]:
+    return value.isoformat() if value else None
+
+
+def _query_span(query: str):
+    """为一条查询创建 span，只记录SQL文本，不记录参数"""
+    return tracer.start_as_current_span("db.query", attributes={
+        "db.system": "postgresql",
+        "db.statement": " ".join(query.split())[:500],
+    })
+
+
+class AsyncRepository:
+    def __init__(self, pool: AsyncConnectionPool):
+        self.pool = pool
+        self.prepare = True if Config.DB_PREPARED_STATEMENTS else None
+
+    @asynccontextmanager
+    async def connection(self):
+        """从连接池借出连接，退出时自动归还"""
+        async with self.pool.connection() as conn:
+            yield conn
+
+    @asynccontextmanager
+    async def _cursor(self, timeout_ms: Optional[int] = None):
+        async with self.connection() as conn:
+            if timeout_ms is None:
+                async with conn.cursor(row_factory=dict_row) as cur:
+                    yield cur
+                return
+            # 单条查询的超时只在本事务内生效，与查询一起以管道方式发送
+            async with conn.transaction(), conn.pipeline():
+                async with conn.cursor(row_factory=dict_row) as cur:
+                    await cur.execute("SELECT set_config('statement_timeout', %s, true)", (str(timeout_ms),))
+                    yield cur
+
+    async def fetchone(self, query: str, params: Sequence[Any] = (), prepare: bool = False,
+                       timeout_ms: Optional[int] = None) -> Optional[dict]:
+        with _query_span(query):
+            async with self._cursor(timeout_ms) as cur:
+                await cur.execute(query, params, prepare=self.prepare if prepare else None)
+                return await cur.fetchone()
+
+    async def fetchall(self, query: str, params: Sequence[Any] = (), prepare: bool = False,
+                       timeout_ms: Optional[int] = None) -> list:
+        with _query_span(query):
+            async with self._cursor(timeout_ms) as cur:
+                await cur.execute(query, params, prepare=self.prepare if prepare else None)
+                return await cur.fetchall()
+
+    async def execute(self, query: str, params: Sequence[Any] = (), prepare: bool = False,
+                      timeout_ms: Optional[int] = None) -> int:
+        """执行写入语句，返回影响的行数"""
+        with _query_span(query):
+            async with self._cursor(timeout_ms) as cur:
+                await cur.execute(query, params, prepare=self.prepare if prepare else None)
+                return cur.rowcount
+
+
+class UserRepository(AsyncRepository):
+    async def get_user_by_id(self, user_id: str) -> Optional[User]:
+        """根据用户ID获取用户资料（不含密码哈希），结果缓存 Config.USER_CACHE_TTL 秒。
+
+        缓存可能是共享的 Redis，因此只缓存 id、username、email，密码哈希仅在登录时从数据库读取。
+        """
+        cached = await cache.get(f"user_profile:{user_id}")
+        if cached is not None:
+            return User(**cached)
+        row = await self.fetchone(
+            "SELECT id, username, email FROM users WHERE id = %s AND is_active = TRUE",
+            (user_id,), prepare=True
+        )
+        if not row:
+            return None
+        user = User(**row)
+        await cache.set(f"user_profile:{user_id}", user.model_dump(), Config.USER_CACHE_TTL)
+        return user
+
+    async def get_user_by_username(self, username: str) -> Optional[UserInDB]:
+        """根据用户名获取用户"""
+        row = await self.fetchone(
+            "SELECT id, username, email, hashed_password FROM users WHERE username = %s AND is_active = TRUE",
+            (username,), prepare=True
+        )
+        return UserInDB(**row) if row else None
+
+    async def get_user_by_email(self, email: str) -> Optional[UserInDB]:
+        """根据邮箱获取用户"""
+        row = await self.fetchone(
+            "SELECT id, username, email, hashed_password FROM users WHERE email = %s AND is_active = TRUE",
+            (email,), prepare=True
+        )
+        return UserInDB(**row) if row else None
+
+    async def create_user(self, username: str, email: str, hashed_password: str) -> User:
+        """创建新用户，用户名/邮箱冲突时抛出 ValueError（"用户名已存在"/"邮箱已注册"）"""
+        try:
+            row = await self.fetchone(
+                "INSERT INTO users (id, username, email, hashed_password) VALUES (%s, %s, %s, %s) "
+                "RETURNING id, username, email, created_at",
+                (str(uuid.uuid4()), username, email, hashed_password)
+            )
+        except UniqueViolation as e:
+            if e.diag.constraint_name == USERNAME_CONSTRAINT:
+                raise ValueError("用户名已存在")
+            if e.diag.constraint_name == EMAIL_CONSTRAINT:
+                raise ValueError("邮箱已注册")
+            logger.error(f"Error creating user: {e}")
+            raise ValueError("用户注册失败，请稍后重试")
+        logger.info(f"User created successfully: {username}")
+        return User(**row)
+
+
+class ConversationRepository(AsyncRepository):
+    async def create_conversation(self, user_id: str, title: str) -> str:
+        """创建新对话"""
+        conversation_id = str(uuid.uuid4())
+        await self.execute(
+            "INSERT INTO conversations (id, user_id, title) VALUES (%s, %s, %s)",
+            (conversation_id, user_id, title)
+        )
+        await cache.set(owner_cache_key(conversation_id, user_id), True, Config.CONVERSATION_OWNER_CACHE_TTL)
+        logger.info(f"Created conversation: {conversation_id} for user: {user_id}")
+        return conversation_id
+
+    async def owns_conversation(self, conversation_id: str, user_id: str) -> bool:
+        """检查对话是否属于该用户且未删除，只缓存肯定的结果"""
+        cache_key = owner_cache_key(conversation_id, user_id)
+        if await cache.get(cache_key):
+            return True
+        row = await self.fetchone(
+            "SELECT 1 AS owned FROM conversations WHERE id = %s AND user_id = %s AND is_deleted = FALSE",
+            (conversation_id, user_id), prepare=True
+        )
+        if row:
+            await cache.set(cache_key, True, Config.CONVERSATION_OWNER_CACHE_TTL)
+        return row is not None
+
+    async def get_conversation_by_id(self, conversation_id: str, user_id: str) -> Optional[dict]:
+        """根据ID获取对话详情"""
+        row = await self.fetchone(
+            "SELECT id, title, created_at, updated_at FROM conversations "
+            "WHERE id = %s AND user_id = %s AND is_deleted = FALSE",
+            (conversation_id, user_id), prepare=True
+        )
+        if not row:
+            return None
+        return {**row, "created_at": _iso(row["created_at"]), "updated_at": _iso(row["updated_at"])}
+
+    async def update_conversation_title(self, conversation_id: str, title: str, user_id: str) -> bool:
+        """更新对话标题"""
+        rowcount = await self.execute(
+            "UPDATE conversations SET title = %s, updated_at = CURRENT_TIMESTAMP "
+            "WHERE id = %s AND user_id = %s AND is_deleted = FALSE",
+            (title, conversation_id, user_id)
+        )
+        if rowcount > 0:
+            await cache.delete(owner_cache_key(conversation_id, user_id))
+            logger.info(f"Updated conversation title: {conversation_id} -> {title}")
+        return rowcount > 0
+
+    async def delete_conversation(self, conversation_id: str, user_id: str) -> bool:
+        """软删除对话"""
+        rowcount = await self.execute(
+            "UPDATE conversations SET is_deleted = TRUE, updated_at = CURRENT_TIMESTAMP "
+            "WHERE id = %s AND user_id = %s",
+            (conversation_id, user_id)
+        )
+        if rowcount > 0:
+            await cache.delete(owner_cache_key(conversation_id, user_id))
+            logger.info(f"Deleted conversation: {conversation_id}")
+        return rowcount > 0
+
+    async def list_conversations(self, user_id: str, limit: Optional[int] = 50,
+                                 cursor: Optional[str] = None) -> Tuple[list, Optional[str]]:
+        """按 (updated_at, id) 游标分页获取用户的对话列表，limit 为 None 时返回全部，游标格式错误时抛出 ValueError"""
+        query, params = build_conversations_page_query(user_id, limit, cursor)
+        rows = await self.fetchall(query, params, prepare=True)
+        has_more = limit is not None and len(rows) > limit
+        rows = rows[:limit]
+        conversations = [{
+            'id': row['id'],
+            'title': row['title'],
+            'created_at': _iso(row['created_at']),
+            'updated_at': _iso(row['updated_at']),
+            'preview': row['last_message_preview'] or "暂无消息",
+            'last_message_at': _iso(row['last_message_at'])
+        } for row in rows]
+        next_cursor = encode_cursor(rows[-1]['updated_at'], rows[-1]['id']) if has_more else None
+        return conversations, next_cursor
+
+    async def get_messages_page(self, conversation_id: str, before: Optional[str] = None,
+                                after: Optional[str] = None, limit: Optional[int] = 50) -> Tuple[list, bool]:
+        """按时间范围分页获取对话消息，结果按时间升序排列
+
+        Args:
+            conversation_id: 对话ID。
+            before: 只返回早于该位置的消息，可以是消息ID或ISO时间戳（不含时间相同的消息，翻页应使用消息ID）。
+            after: 只返回晚于该位置的消息，可以是消息ID或ISO时间戳（同上）。
+            limit: 每页条数，为 None 时返回全部。未指定 after 时返回紧邻 before（或最新）的一页，指定 after 时返回紧随其后的一页。
+
+        Returns:
+            Tuple[list, bool]: 当前页消息列表，以及在翻页方向上是否还有更多消息。
+
+        Raises:
+            ValueError: 消息ID游标不属于该对话。
+        """
+        query, params, order = build_messages_page_query(conversation_id, before, after, limit)
+        for message_id in message_id_cursors(before, after):
+            if await self.fetchone(MESSAGE_CURSOR_EXISTS_QUERY, (message_id, conversation_id)) is None:
+                raise ValueError("分页游标对应的消息不存在")
+        rows = await self.fetchall(query, params, prepare=True)
+        has_more = limit is not None and len(rows) > limit
+        rows = rows[:limit]
+        if order == "DESC":
+            rows.reverse()
+        return [{**row, 'timestamp': _iso(row['timestamp'])} for row in rows], has_more
+
+    async def get_relevant_messages(self, conversation_id: str, query_embedding: list, top_k: int = 5) -> list:
+        """使用向量相似度搜索获取相关消息，出错时返回最近的top_k条消息"""
+        try:
+            rows = await self.fetchall("""
+                SELECT role, content, timestamp
+                FROM messages
+                WHERE conversation_id = %s
+                ORDER BY vector_cosine_distance(content_vector, %s::vector) ASC
+                LIMIT %s
+            """, (conversation_id, str(list(query_embedding)), top_k),
+                timeout_ms=Config.DB_VECTOR_SEARCH_TIMEOUT_MS)
+            logger.info(f"Retrieved {len(rows)} relevant messages for conversation: {conversation_id}")
+            return [{**row, 'timestamp': _iso(row['timestamp'])} for row in rows]
+        except Exception as e:
+            logger.error(f"Error getting relevant messages: {e}")
+            recent_messages, _ = await self.get_messages_page(conversation_id, limit=top_k)
+            return recent_messages
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 测试从 backend 目录导入模块（utils、benchmarks 等），与服务运行时的导入方式一致
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
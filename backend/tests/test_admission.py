@@ -0,0 +1,49 @@
+"""流式响应的准入许可在任何结束方式下都要释放，否则用户会被持续拒绝直到进程重启"""
+import asyncio
+import pytest
+
+pytest.importorskip("fastapi")
+
+from admission import AdmissionController, PermitStreamingResponse, PRIORITY_INTERACTIVE
+
+SCOPE = {"type": "http", "asgi": {"spec_version": "2.4"}}
+
+
+async def body():
+    yield "data: x\n\n"
+
+
+async def receive():
+    await asyncio.sleep(10)
+
+
+def run_response(send) -> AdmissionController:
+    async def main():
+        controller = AdmissionController(max_concurrent=1, max_per_user=1)
+        permit = await controller.acquire("user", PRIORITY_INTERACTIVE)
+        response = PermitStreamingResponse(body(), permit, media_type="text/event-stream")
+        try:
+            await response(SCOPE, receive, send)
+        except Exception:
+            pass
+        return controller
+
+    return asyncio.run(main())
+
+
+def test_permit_released_after_stream_completes():
+    async def send(message):
+        pass
+
+    controller = run_response(send)
+    assert controller.stats()["active"] == 0
+
+
+def test_permit_released_when_client_disconnects_before_body():
+    # 发送响应头时连接已断开，响应体生成器从未开始执行
+    async def send(message):
+        raise OSError("connection closed")
+
+    controller = run_response(send)
+    assert controller.stats()["active"] == 0
+    assert not controller._per_user
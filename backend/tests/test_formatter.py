@@ -0,0 +1,49 @@
+"""IncrementalFormatter 的输出不应依赖分片方式：任意切分后逐片输入的结果必须与 format_response 一致"""
+import random
+import pytest
+from utils.formatter import IncrementalFormatter, format_response
+
+CORPUS = [
+    "Hello. World.\n\n\nNew paragraph. Second sentence.",
+    "   leading space. trailing space.   \n\n",
+    "a.  b. \n c\n\n\n\nd",
+    "text ``inline`` and ```js\nvar a = 1;\n``` end.",
+    "```\n\ncode\n```",
+    "```python\n\n  x = 1\n\n  y = 2\n\n```\nAfter. Done.",
+    "``` py \n\n\n\tindented\n```",
+    "```\n\n\n```tail",
+    "````\n`\n```",
+    "```\nunclosed code\n\n",
+    "Before.```sh\necho 1. echo 2.\n```After.",
+]
+
+
+def feed_chunks(parts):
+    formatter = IncrementalFormatter()
+    return "".join(formatter.feed(part) for part in parts) + formatter.finish()
+
+
+def random_chunks(text, rng):
+    if len(text) < 2:
+        return [text]
+    cuts = sorted(rng.sample(range(1, len(text)), rng.randint(1, min(8, len(text) - 1))))
+    return [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+
+
+@pytest.mark.parametrize("text", CORPUS)
+def test_random_chunking_matches_format_response(text):
+    expected = format_response(text)
+    rng = random.Random(text)
+    for _ in range(500):
+        parts = random_chunks(text, rng)
+        assert feed_chunks(parts) == expected, parts
+
+
+@pytest.mark.parametrize("text", CORPUS)
+def test_single_character_chunks_match_format_response(text):
+    assert feed_chunks(list(text)) == format_response(text)
+
+
+def test_blank_lines_after_info_line_are_stripped():
+    assert feed_chunks(["```", "\n", "\ncod", "e\n", "```"]) == "```\ncode\n```"
+    assert feed_chunks(["``` py \n", "\n", "\n\tindented\n```"]) == "```py\n\tindented\n```"
@@ -0,0 +1,86 @@
+"""RoutingChatModel 的失败转移、对冲和健康统计，使用 benchmarks.fakes.FakeChatModel 模拟各服务"""
+import threading
+import time
+import uuid
+import pytest
+
+pytest.importorskip("langchain_core")
+
+from langchain_core.messages import HumanMessage
+from benchmarks.fakes import FakeChatModel
+from utils import llm_router
+from utils.llm_router import RoutingChatModel, get_health
+
+MESSAGES = [HumanMessage(content="你好")]
+
+
+def fake(first_token_latency: float, error_rate: float = 0.0) -> FakeChatModel:
+    return FakeChatModel(first_token_latency=first_token_latency, tokens_per_second=1000, response_tokens=5,
+                         tool_call_ratio=0, error_rate=error_rate, seed=0)
+
+
+def unique(name: str) -> str:
+    # 健康统计在进程内按服务名共享，每个测试使用独立的服务名
+    return f"{name}-{uuid.uuid4().hex[:8]}"
+
+
+def test_failover_when_provider_errors():
+    broken, healthy = unique("broken"), unique("healthy")
+    router = RoutingChatModel(providers={broken: fake(0.01, error_rate=1.0), healthy: fake(0.01)},
+                              hedge_enabled=False)
+    result = router._generate(MESSAGES)
+    assert result.llm_output["provider"] == healthy
+    assert get_health(broken).snapshot()["error_rate"] == 1.0
+
+
+def test_cold_start_hedges_degraded_primary():
+    slow, fast = unique("slow"), unique("fast")
+    router = RoutingChatModel(providers={slow: fake(1.0), fast: fake(0.01)},
+                              hedge_min_delay=0.05, hedge_max_delay=15, hedge_cold_delay=0.1)
+    started_at = time.perf_counter()
+    result = router._generate(MESSAGES)
+    assert result.llm_output["provider"] == fast
+    assert time.perf_counter() - started_at < 0.8
+
+
+def test_degraded_provider_is_ranked_last():
+    slow, fast = unique("slow"), unique("fast")
+    router = RoutingChatModel(providers={slow: fake(0.2), fast: fake(0.01)}, hedge_enabled=False)
+    for _ in range(get_health(slow).min_samples):
+        router._call(slow, MESSAGES, None, None)
+        router._call(fast, MESSAGES, None, None)
+    assert router.ranked() == [fast, slow]
+
+
+def test_hedge_skipped_when_limit_reached(monkeypatch):
+    slots = threading.BoundedSemaphore(1)
+    slots.acquire()
+    monkeypatch.setattr(llm_router, "_hedge_slots", slots)
+    slow, fast = unique("slow"), unique("fast")
+    router = RoutingChatModel(providers={slow: fake(0.3), fast: fake(0.01)},
+                              hedge_min_delay=0.01, hedge_cold_delay=0.01)
+    assert router._generate(MESSAGES).llm_output["provider"] == slow
+
+
+def test_hedge_slot_released_after_both_requests_finish(monkeypatch):
+    slots = threading.BoundedSemaphore(1)
+    monkeypatch.setattr(llm_router, "_hedge_slots", slots)
+    slow, fast = unique("slow"), unique("fast")
+    router = RoutingChatModel(providers={slow: fake(0.3), fast: fake(0.01)},
+                              hedge_min_delay=0.01, hedge_cold_delay=0.05)
+    assert router._generate(MESSAGES).llm_output["provider"] == fast
+    # 落败的首选请求仍在执行，对冲名额尚未释放
+    assert not slots.acquire(blocking=False)
+    time.sleep(0.5)
+    assert slots.acquire(blocking=False)
+
+
+def test_stream_records_time_to_first_chunk():
+    key = unique("stream")
+    model = FakeChatModel(first_token_latency=0.05, tokens_per_second=20, response_tokens=10, tool_call_ratio=0, seed=0)
+    router = RoutingChatModel(providers={key: model})
+    chunks = list(router._stream(MESSAGES))
+    assert len(chunks) > 1
+    stats = get_health(key, "stream").snapshot()
+    assert stats["samples"] == 1 and stats["p50"] < 0.3
+    assert get_health(key).snapshot()["samples"] == 0
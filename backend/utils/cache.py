@@ -0,0 +1,105 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+from .config import Config
+
+try:
+    from redis import asyncio as redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+
+class LocalTTLCache:
+    """进程内带过期时间和容量上限的LRU缓存。
+
+    各进程的缓存相互独立，某个进程中的失效操作不会同步到其他进程，
+    多进程部署时需要配置 CACHE_REDIS_URL 使用 RedisCache。
+    接口与 RedisCache 一致为异步方法，内部只操作内存、不会让出事件循环。
+    """
+
+    def __init__(self, max_size: int = Config.CACHE_MAX_SIZE):
+        self.max_size = max_size
+        # key -> (过期时间, value)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    async def delete(self, *keys: str) -> None:
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+
+class RedisCache:
+    """基于 Redis 的共享缓存，值以 JSON 存储，接口与 LocalTTLCache 相同。
+
+    使用 redis.asyncio 客户端，网络往返期间不阻塞事件循环。
+    Redis 不可用时读取视为未命中、写入被忽略，请求退回到数据库查询。
+    """
+
+    def __init__(self, url: str, prefix: str = "myagent:"):
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self.prefix = prefix
+
+    async def get(self, key: str) -> Optional[Any]:
+        try:
+            raw = await self.client.get(self.prefix + key)
+            return json.loads(raw) if raw is not None else None
+        except Exception as e:
+            logger.warning(f"Redis cache get failed: {e}")
+            return None
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        if ttl <= 0:
+            return
+        try:
+            await self.client.set(self.prefix + key, json.dumps(value, ensure_ascii=False), px=int(ttl * 1000))
+        except Exception as e:
+            logger.warning(f"Redis cache set failed: {e}")
+
+    async def delete(self, *keys: str) -> None:
+        if not keys:
+            return
+        try:
+            await self.client.delete(*(self.prefix + key for key in keys))
+        except Exception as e:
+            logger.warning(f"Redis cache delete failed: {e}")
+
+
+def create_cache():
+    """配置了 CACHE_REDIS_URL 且安装了 redis 时使用 RedisCache，否则使用进程内缓存"""
+    if Config.CACHE_REDIS_URL:
+        if redis is not None:
+            logger.info("Using Redis cache backend")
+            return RedisCache(Config.CACHE_REDIS_URL)
+        logger.warning("CACHE_REDIS_URL is set but redis is not installed, falling back to local cache")
+    return LocalTTLCache()
+
+
+# 全局缓存：用户信息、对话归属（已解码的令牌只缓存在进程内，见 auth.token_cache）
+cache = create_cache()
@@ -14,21 +14,171 @@ class Config:
     PROMPT_TEMPLATE_TXT_REWRITE = "prompts/prompt_template_rewrite.txt"
     # 生成模板（RAG提示词）
     PROMPT_TEMPLATE_TXT_GENERATE = "prompts/prompt_template_generate.txt"
+    # 摘要模板（滚动对话摘要）
+    PROMPT_TEMPLATE_TXT_SUMMARY = "prompts/prompt_template_summary.txt"
+    # 记忆抽取模板
+    PROMPT_TEMPLATE_TXT_MEMORY = "prompts/prompt_template_memory.txt"
+
+    # 滚动对话摘要配置
+    # 检查点中的消息数超过该阈值时触发后台摘要
+    SUMMARY_TRIGGER_MESSAGES = int(os.getenv("SUMMARY_TRIGGER_MESSAGES", 20))
+    # 摘要后在检查点中保留的最近消息数
+    SUMMARY_KEEP_MESSAGES = int(os.getenv("SUMMARY_KEEP_MESSAGES", 6))
+
+    # 检查点保留策略配置
+    # 每个线程保留的最新检查点数量
+    CHECKPOINT_KEEP_LATEST = int(os.getenv("CHECKPOINT_KEEP_LATEST", 10))
+    # 每批处理的线程数，分批提交避免长时间锁表
+    CHECKPOINT_RETENTION_BATCH_SIZE = int(os.getenv("CHECKPOINT_RETENTION_BATCH_SIZE", 100))
+    # 后台清理任务的执行间隔（秒），0 表示不启动后台任务
+    CHECKPOINT_RETENTION_INTERVAL = int(os.getenv("CHECKPOINT_RETENTION_INTERVAL", 3600))
+
+    # 检查点持久化模式
+    # sync: 每个 super-step 都写入检查点（默认）
+    # compact: 每个 super-step 都写入，但截断检查点中过长的工具输出
+    # exit: 仅在一轮对话结束时写入一次检查点，同样截断过长的工具输出
+    CHECKPOINT_DURABILITY = os.getenv("CHECKPOINT_DURABILITY", "sync")
+    # 写入检查点时工具输出保留的最大字符数
+    CHECKPOINT_TOOL_OUTPUT_MAX_CHARS = int(os.getenv("CHECKPOINT_TOOL_OUTPUT_MAX_CHARS", 2000))
+
+    # 跨线程记忆检索配置
+    # 每次检索返回的最大记忆条数
+    MEMORY_SEARCH_LIMIT = int(os.getenv("MEMORY_SEARCH_LIMIT", 5))
+    # 记忆相似度阈值，低于该值的记忆不放入提示词，未设置时不过滤
+    MEMORY_SCORE_THRESHOLD = float(os.getenv("MEMORY_SCORE_THRESHOLD")) if os.getenv("MEMORY_SCORE_THRESHOLD") else None
+    # 进程内记忆检索结果缓存：最多缓存的用户数，以及每个用户缓存的查询数
+    MEMORY_CACHE_MAX_USERS = int(os.getenv("MEMORY_CACHE_MAX_USERS", 1024))
+    MEMORY_CACHE_MAX_QUERIES = int(os.getenv("MEMORY_CACHE_MAX_QUERIES", 32))
+    # 每个用户最多保留的记忆条数，超出时淘汰最久未使用的记忆
+    MEMORY_MAX_PER_USER = int(os.getenv("MEMORY_MAX_PER_USER", 50))
+    # 新事实与已有记忆的相似度达到该值时视为同一事实，合并而不是新增
+    MEMORY_DEDUP_THRESHOLD = float(os.getenv("MEMORY_DEDUP_THRESHOLD", 0.9))
+    # 后台记忆抽取的批大小和等待间隔（秒）
+    MEMORY_EXTRACT_BATCH_SIZE = int(os.getenv("MEMORY_EXTRACT_BATCH_SIZE", 16))
+    MEMORY_EXTRACT_INTERVAL = float(os.getenv("MEMORY_EXTRACT_INTERVAL", 2.0))
+    # 包含这些关键词的用户消息才会进入记忆抽取，逗号分隔，设为空字符串时抽取所有用户消息
+    MEMORY_TRIGGER_KEYWORDS = [k for k in os.getenv("MEMORY_TRIGGER_KEYWORDS", "记住").split(",") if k]
+    # 进程内文本向量缓存的最大条数，1536维向量按单精度保存，默认4096条约占25MB
+    EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", 4096))
+
+    # 消息异步写入（write-behind）配置
+    # 等待写入的消息队列上限，以及队列满时提交方最多等待的秒数，超时后拒绝提交（接口返回503）
+    MESSAGE_WRITE_QUEUE_SIZE = int(os.getenv("MESSAGE_WRITE_QUEUE_SIZE", 1000))
+    MESSAGE_WRITE_SUBMIT_TIMEOUT = float(os.getenv("MESSAGE_WRITE_SUBMIT_TIMEOUT", 5))
+    # 每批最多写入的消息条数和凑批等待时间（秒）
+    MESSAGE_WRITE_BATCH_SIZE = int(os.getenv("MESSAGE_WRITE_BATCH_SIZE", 64))
+    MESSAGE_WRITE_INTERVAL = float(os.getenv("MESSAGE_WRITE_INTERVAL", 0.05))
+    # 写入失败的重试次数，重试间隔按指数增长
+    MESSAGE_WRITE_MAX_RETRIES = int(os.getenv("MESSAGE_WRITE_MAX_RETRIES", 5))
+
+    # 认证与对话归属缓存配置
+    # Redis 连接地址（如 redis://localhost:6379/0），多进程部署时共享缓存；未设置时使用进程内缓存
+    CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL")
+    # 进程内缓存的最大条目数
+    CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", 10000))
+    # 已解码令牌、用户信息、对话归属的缓存时间（秒）
+    AUTH_TOKEN_CACHE_TTL = int(os.getenv("AUTH_TOKEN_CACHE_TTL", 300))
+    USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", 300))
+    CONVERSATION_OWNER_CACHE_TTL = int(os.getenv("CONVERSATION_OWNER_CACHE_TTL", 300))
+
+    # 密码哈希线程池配置：工作线程数，以及排队和执行中的最大任务数，超出时直接拒绝请求
+    PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 2))
+    PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", 32))
+    # 登录限流：每个IP在时间窗口（秒）内最多尝试登录的次数，默认为0（不限流）。
+    # 经 nginx 等反向代理访问时，所有请求的来源地址都是代理的地址，启用前需将代理地址（IP或网段，逗号分隔）
+    # 配置到 TRUSTED_PROXIES，来自这些地址的请求按 X-Real-IP / X-Forwarded-For 识别客户端IP，
+    # 例如 docker-compose 部署时配置为 frontend 容器所在的网段
+    LOGIN_RATE_LIMIT = int(os.getenv("LOGIN_RATE_LIMIT", 0))
+    TRUSTED_PROXIES = [p.strip() for p in os.getenv("TRUSTED_PROXIES", "").split(",") if p.strip()]
+    LOGIN_RATE_LIMIT_WINDOW = int(os.getenv("LOGIN_RATE_LIMIT_WINDOW", 60))
+    # 对话请求准入控制：全局同时执行的图运行数（设为0时不限制）、每个用户同时执行和排队的请求数、
+    # 等待队列长度及排队超时（秒）
+    ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", 16))
+    ADMISSION_MAX_PER_USER = int(os.getenv("ADMISSION_MAX_PER_USER", 2))
+    ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", 64))
+    ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", 15))
+    # LLM服务端限流：对话模型和嵌入模型各自的每分钟请求数、每分钟令牌数上限（设为0时不限制），
+    # 自适应并发的初始值和上下限，被限流（429）后的重试次数，以及估算令牌数时假定的输出长度
+    LLM_REQUESTS_PER_MINUTE = int(os.getenv("LLM_REQUESTS_PER_MINUTE", 0))
+    LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", 0))
+    LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", 8))
+    LLM_MIN_CONCURRENCY = int(os.getenv("LLM_MIN_CONCURRENCY", 1))
+    LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 32))
+    LLM_ESTIMATED_OUTPUT_TOKENS = int(os.getenv("LLM_ESTIMATED_OUTPUT_TOKENS", 500))
+    EMBEDDING_REQUESTS_PER_MINUTE = int(os.getenv("EMBEDDING_REQUESTS_PER_MINUTE", 0))
+    EMBEDDING_TOKENS_PER_MINUTE = int(os.getenv("EMBEDDING_TOKENS_PER_MINUTE", 0))
+    EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", 8))
+    EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", 32))
+    LLM_RATE_LIMIT_RETRIES = int(os.getenv("LLM_RATE_LIMIT_RETRIES", 3))
+    # 超时、连接错误和5xx的重试次数（与原客户端的 max_retries=2 一致）
+    LLM_TRANSIENT_RETRIES = int(os.getenv("LLM_TRANSIENT_RETRIES", 2))
 
     # Chroma 数据库配置
     CHROMADB_DIRECTORY = "chromaDB"
     CHROMADB_COLLECTION_NAME = "demo001"
 
+    # 链路追踪配置：导出方式 none|console|file|otlp，file 方式的输出文件，以及服务名
+    TRACING_EXPORTER = os.getenv("TRACING_EXPORTER", "none")
+    TRACING_FILE = os.getenv("TRACING_FILE", "output/traces.jsonl")
+    TRACING_SERVICE_NAME = os.getenv("TRACING_SERVICE_NAME", "myagent-backend")
+
     # 日志持久化存储
     LOG_FILE = "output/app.log"
-    MAX_BYTES = 5*1024*1024,        # 日志文件单个最大5M
+    MAX_BYTES = 5*1024*1024         # 日志文件单个最大5M
     BACKUP_COUNT = 3                # 备份3个文件
+    # 日志级别与格式：根级别，按模块覆盖的级别（"name=LEVEL,..."），输出格式 json|text，是否同时输出到控制台
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+    LOG_LEVELS = os.getenv("LOG_LEVELS", "httpx=WARNING")
+    LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+    LOG_CONSOLE = os.getenv("LOG_CONSOLE", "true").lower() == "true"
+    # 异步日志队列容量，队列满时丢弃日志
+    LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+    # 流式输出逐块日志的采样率：每N条保留1条
+    LOG_STREAM_SAMPLE_RATE = int(os.getenv("LOG_STREAM_SAMPLE_RATE", 50))
 
     # 数据库 URI，默认值
     DB_URI = os.getenv("DB_URI")
 
+    # 按负载类型划分的连接池大小
+    # app: FastAPI 接口使用的异步连接池
+    DB_ASYNC_POOL_MIN_SIZE = int(os.getenv("DB_ASYNC_POOL_MIN_SIZE", 2))
+    DB_ASYNC_POOL_MAX_SIZE = int(os.getenv("DB_ASYNC_POOL_MAX_SIZE", 10))
+    # checkpoint: LangGraph 检查点和长期记忆存储
+    DB_CHECKPOINT_POOL_MIN_SIZE = int(os.getenv("DB_CHECKPOINT_POOL_MIN_SIZE", 2))
+    DB_CHECKPOINT_POOL_MAX_SIZE = int(os.getenv("DB_CHECKPOINT_POOL_MAX_SIZE", 10))
+    # background: 消息写入、对话摘要、检查点清理等后台任务
+    DB_BACKGROUND_POOL_MIN_SIZE = int(os.getenv("DB_BACKGROUND_POOL_MIN_SIZE", 1))
+    DB_BACKGROUND_POOL_MAX_SIZE = int(os.getenv("DB_BACKGROUND_POOL_MAX_SIZE", 5))
+    # 连接池监控：检查间隔（秒），使用率告警阈值，获取连接等待时间p95告警阈值（毫秒）
+    DB_POOL_MONITOR_INTERVAL = int(os.getenv("DB_POOL_MONITOR_INTERVAL", 60))
+    DB_POOL_SATURATION_THRESHOLD = float(os.getenv("DB_POOL_SATURATION_THRESHOLD", 0.8))
+    DB_POOL_WAIT_ALERT_MS = float(os.getenv("DB_POOL_WAIT_ALERT_MS", 500))
+    # 默认语句超时（毫秒），向量检索使用单独的超时
+    DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 5000))
+    DB_VECTOR_SEARCH_TIMEOUT_MS = int(os.getenv("DB_VECTOR_SEARCH_TIMEOUT_MS", 15000))
+    # 高频查询是否使用服务端预处理语句，经 PgBouncer 事务池连接数据库时需设为 false
+    DB_PREPARED_STATEMENTS = os.getenv("DB_PREPARED_STATEMENTS", "true").lower() == "true"
+
     # openai:调用gpt模型, qwen:调用阿里通义千问大模型, oneapi:调用oneapi方案支持的模型, ollama:调用本地开源大模型
     LLM_TYPE = os.getenv("LLM_TYPE")
+    # 多服务路由：逗号分隔的备选服务（MODEL_CONFIGS 中的键），与 LLM_TYPE 一起按健康度路由，为空时只使用 LLM_TYPE
+    LLM_PROVIDERS = [p.strip() for p in os.getenv("LLM_PROVIDERS", "").split(",") if p.strip()]
+    # 按节点指定模型，格式为 节点=服务:模型[|服务:模型]，多个节点用逗号分隔，
+    # 例如 grade_documents=qwen:qwen-turbo,rewrite=qwen:qwen-turbo|ollama:qwen2.5:7b
+    LLM_NODE_MODELS = os.getenv("LLM_NODE_MODELS", "")
+    # 对冲请求：调用耗时超过首选服务的 p95（限制在上下限之间，单位秒）仍未返回时，向次优服务发送同样的请求
+    LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "true").lower() == "true"
+    LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", 2))
+    LLM_HEDGE_MAX_DELAY = float(os.getenv("LLM_HEDGE_MAX_DELAY", 15))
+    # 首选服务样本不足（冷启动）时的对冲等待时间（秒）
+    LLM_HEDGE_COLD_DELAY = float(os.getenv("LLM_HEDGE_COLD_DELAY", 5))
+    # 同时进行的对冲最多多少组，超过时不再对冲、只等待首选服务；落败的请求无法中断，会一直占用线程直到结束
+    LLM_HEDGE_MAX_IN_FLIGHT = int(os.getenv("LLM_HEDGE_MAX_IN_FLIGHT", 8))
+    # 健康度统计窗口（秒）和参与排序所需的最少样本数，连续失败多少次后熔断及熔断时长（秒）
+    LLM_HEALTH_WINDOW = float(os.getenv("LLM_HEALTH_WINDOW", 300))
+    LLM_HEALTH_MIN_SAMPLES = int(os.getenv("LLM_HEALTH_MIN_SAMPLES", 5))
+    LLM_CIRCUIT_FAILURES = int(os.getenv("LLM_CIRCUIT_FAILURES", 5))
+    LLM_CIRCUIT_COOLDOWN = float(os.getenv("LLM_CIRCUIT_COOLDOWN", 30))
 
     # API服务地址和端口
     HOST = os.getenv("HOST")
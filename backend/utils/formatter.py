@@ -0,0 +1,142 @@
+"""增量响应格式化
+
+IncrementalFormatter 是一个按片段输入的状态机，流式与非流式响应共用同一套格式化规则：
+- 段落之间（两个及以上连续换行）统一为一个空行，段落首尾的空白被去掉；
+- 代码块之外，句点后的空格替换为换行，使句子分行显示；
+- 代码块（```）前后各占一行，保留语言标记，块内内容原样输出，只去掉首尾的空行；
+- 未闭合的代码块在结束时补全。
+
+代码块状态、末尾不完整的反引号和尚未确定去留的空白会跨片段保留，每次 feed 只返回可以确定的部分。
+"""
+import re
+
+# 反引号串、空白串、句点和其余文本
+_TOKEN = re.compile(r"`+|\s+|\.|[^\s.`]+")
+_FENCE = "```"
+
+
+class IncrementalFormatter:
+    def __init__(self):
+        # 尚未处理的输入（末尾可能是不完整的代码块标记）
+        self._buffer = ""
+        self._in_code = False
+        # 代码块开始标记之后、第一个换行之前的内容（语言标记），为 None 时不在收集
+        self._info = None
+        # 语言标记所在行结束后、第一个非空白代码之前，期间的空行全部丢弃
+        self._code_start = False
+        # 待定的空白：代码块外决定是否为段落分隔，代码块内决定是否为结尾空白
+        self._space = ""
+        self._after_period = False
+        self._last_char = ""
+
+    def feed(self, chunk: str) -> str:
+        """输入一个片段，返回可以输出的格式化内容（可能为空字符串）"""
+        self._buffer += chunk
+        return self._drain(final=False)
+
+    def finish(self) -> str:
+        """输入结束，返回剩余的格式化内容"""
+        output = [self._drain(final=True)]
+        if self._in_code:
+            if self._info is not None:
+                output.append(self._emit("\n" + self._info.strip()))
+                self._info = None
+            output.append(self._emit("\n" + _FENCE))
+            self._in_code = False
+        # 结尾空白直接丢弃
+        self._space = ""
+        return "".join(output)
+
+    def _emit(self, text: str) -> str:
+        if text:
+            self._last_char = text[-1]
+        return text
+
+    def _drain(self, final: bool) -> str:
+        output = []
+        position = 0
+        buffer = self._buffer
+        for match in _TOKEN.finditer(buffer):
+            token = match.group()
+            if token[0] == "`":
+                # 末尾不足三个的反引号可能是被截断的代码块标记，留到下一个片段
+                if len(token) < 3 and match.end() == len(buffer) and not final:
+                    break
+                if len(token) >= 3:
+                    output.append(self._fence())
+                    token = token[3:]
+                    if not token:
+                        position = match.end()
+                        continue
+            if token[0].isspace():
+                output.append(self._whitespace(token))
+            else:
+                output.append(self._text(token))
+            position = match.end()
+        self._buffer = buffer[position:]
+        return "".join(output)
+
+    def _fence(self) -> str:
+        if self._in_code:
+            # 闭合代码块：丢弃结尾空白，之后的内容另起一行
+            code = ""
+            if self._info is not None:
+                code = self._emit("\n" + self._info.strip())
+                self._info = None
+            self._in_code = False
+            self._code_start = False
+            self._space = "\n"
+            self._after_period = False
+            return code + self._emit("\n" + _FENCE)
+
+        space, self._space = self._space, ""
+        self._in_code = True
+        self._info = ""
+        self._after_period = False
+        if not self._last_char:
+            return self._emit(_FENCE)
+        if "\n\n" in space:
+            return self._emit("\n\n" + _FENCE)
+        return self._emit(("" if self._last_char == "\n" else "\n") + _FENCE)
+
+    def _whitespace(self, token: str) -> str:
+        if self._in_code and self._info is not None:
+            if "\n" not in token:
+                self._info += token
+                return ""
+            # 语言标记结束，去掉代码开头的空行，保留第一行的缩进
+            info, self._info = self._info.strip(), None
+            self._code_start = True
+            self._space = token[token.rfind("\n") + 1:]
+            return self._emit(info + "\n")
+        self._space += token
+        if self._in_code and self._code_start:
+            # 空行可能落在之后的片段中，直到第一个代码之前只保留最后一行的缩进
+            self._space = self._space[self._space.rfind("\n") + 1:]
+        return ""
+
+    def _text(self, token: str) -> str:
+        if self._in_code:
+            if self._info is not None:
+                self._info += token
+                return ""
+            space, self._space = self._space, ""
+            self._code_start = False
+            return self._emit(space + token)
+
+        space, self._space = self._space, ""
+        if not self._last_char:
+            # 开头的空白直接丢弃
+            space = ""
+        elif "\n\n" in space:
+            space = "\n\n"
+        elif self._after_period and space.startswith(" "):
+            space = "\n" + space[1:]
+        self._after_period = token == "."
+        return self._emit(space + token)
+
+
+def format_response(response: str) -> str:
+    """一次性格式化完整的响应文本"""
+    formatter = IncrementalFormatter()
+    return formatter.feed(response) + formatter.finish()
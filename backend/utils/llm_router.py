@@ -0,0 +1,322 @@
+"""多服务LLM路由
+
+RoutingChatModel 持有多个已配置服务（MODEL_CONFIGS 中的 openai/qwen/oneapi/ollama 等）的对话模型，
+按近期的延迟和错误率把每次调用路由到最健康的服务：
+- 每个服务/模型在 Config.LLM_HEALTH_WINDOW 秒内的调用耗时和成败计入 ProviderHealth，
+  非流式调用记录完整耗时，流式调用记录首个分块的耗时（TTFT），两者分开统计、分别用于各自的排序，
+  样本不少于 Config.LLM_HEALTH_MIN_SAMPLES 时按 中位数耗时 / (1 - 错误率) 排序，样本不足的服务按配置顺序排在后面，
+  窗口过期后服务回到配置顺序，因此短暂故障的服务恢复后会重新被使用；
+- 连续失败 Config.LLM_CIRCUIT_FAILURES 次的服务熔断 Config.LLM_CIRCUIT_COOLDOWN 秒，排在所有服务之后；
+- 非流式调用失败时依次转移到下一个服务；耗时超过首选服务的 p95（样本不足时为 Config.LLM_HEDGE_COLD_DELAY）
+  仍未返回时，向次优服务发送相同的对冲请求，先成功的结果生效。已发出的请求无法中断，落败的一方在后台线程中
+  自然结束、结果丢弃，因此同时进行的对冲数由 Config.LLM_HEDGE_MAX_IN_FLIGHT 限制，达到上限时只等待首选服务；
+- 流式调用不做对冲（已输出的令牌无法撤回），在收到第一个分块之前失败时转移到下一个服务。
+
+服务由名称到 BaseChatModel 的映射给出，路由只调用各模型的 _generate/_stream，
+因此可以直接使用 benchmarks.fakes.FakeChatModel 等本地模拟模型验证路由和对冲行为。
+for_node 按 Config.LLM_NODE_MODELS 为指定节点返回使用其他模型（如 grade_documents、rewrite 使用小模型）的路由。
+"""
+import contextvars
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from pydantic import Field, PrivateAttr
+from .config import Config
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+router_calls = registry.counter("llm_router_calls_total", "LLM calls routed to each provider", ["provider", "status"])
+router_hedges = registry.counter("llm_router_hedges_total", "Hedged LLM calls and which request won", ["winner"])
+router_hedges_skipped = registry.counter("llm_router_hedges_skipped_total",
+                                         "Slow LLM calls not hedged because the in-flight hedge limit was reached")
+
+# 对冲请求和首选请求在线程池中执行，调用方线程只负责等待先完成的一个
+_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="llm-hedge")
+# 进行中的对冲组数，一组的两个请求都结束后才释放
+_hedge_slots = threading.BoundedSemaphore(max(1, Config.LLM_HEDGE_MAX_IN_FLIGHT))
+
+
+class ProviderHealth:
+    """单个服务/模型的滚动健康统计"""
+
+    def __init__(self, window: float = Config.LLM_HEALTH_WINDOW, min_samples: int = Config.LLM_HEALTH_MIN_SAMPLES,
+                 circuit_failures: int = Config.LLM_CIRCUIT_FAILURES,
+                 circuit_cooldown: float = Config.LLM_CIRCUIT_COOLDOWN):
+        self.window = window
+        self.min_samples = min_samples
+        self.circuit_failures = circuit_failures
+        self.circuit_cooldown = circuit_cooldown
+        # (时间, 耗时秒数, 是否成功)
+        self._samples = deque(maxlen=1000)
+        self._consecutive_failures = 0
+        self._open_until = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, latency: float, ok: bool) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._samples.append((now, latency, ok))
+            if ok:
+                self._consecutive_failures = 0
+            else:
+                self._consecutive_failures += 1
+                if self._consecutive_failures >= self.circuit_failures:
+                    self._open_until = now + self.circuit_cooldown
+
+    def _recent(self) -> list:
+        cutoff = time.monotonic() - self.window
+        while self._samples and self._samples[0][0] < cutoff:
+            self._samples.popleft()
+        return list(self._samples)
+
+    def is_open(self) -> bool:
+        return time.monotonic() < self._open_until
+
+    def snapshot(self) -> dict:
+        """近期样本数、错误率和成功调用耗时的 p50/p95（秒，无成功样本时为 None）"""
+        with self._lock:
+            samples = self._recent()
+        latencies = sorted(latency for _, latency, ok in samples if ok)
+        errors = sum(1 for _, _, ok in samples if not ok)
+
+        def quantile(q: float) -> Optional[float]:
+            return latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else None
+
+        return {"samples": len(samples), "error_rate": errors / len(samples) if samples else 0.0,
+                "p50": quantile(0.5), "p95": quantile(0.95), "open": self.is_open()}
+
+    def score(self) -> Optional[float]:
+        """越小越健康，样本不足时返回 None"""
+        stats = self.snapshot()
+        if stats["samples"] < self.min_samples:
+            return None
+        if stats["p50"] is None:
+            return float("inf")
+        return stats["p50"] / max(0.05, 1 - stats["error_rate"])
+
+
+# (服务/模型, 调用方式) -> 健康统计，同一进程内的所有路由共享
+_health: Dict[Tuple[str, str], ProviderHealth] = {}
+_health_lock = threading.Lock()
+
+
+def get_health(key: str, kind: str = "generate") -> ProviderHealth:
+    """kind 为 generate（非流式，完整耗时）或 stream（流式，首个分块耗时）"""
+    with _health_lock:
+        health = _health.get((key, kind))
+        if health is None:
+            health = _health[(key, kind)] = ProviderHealth()
+        return health
+
+
+def _release_when_done(futures: list, release: Callable[[], None]) -> None:
+    """所有 future 结束（包括被取消）后调用一次 release"""
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def on_done(_):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            release()
+
+    for future in futures:
+        future.add_done_callback(on_done)
+
+
+def parse_node_models(spec: str) -> Dict[str, List[Tuple[str, str]]]:
+    """解析 Config.LLM_NODE_MODELS，返回 节点 -> [(服务, 模型)]"""
+    result = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        node, choices = item.split("=", 1)
+        candidates = []
+        for choice in choices.split("|"):
+            # ollama 的模型名可能带冒号，只按第一个冒号拆分
+            provider, _, model = choice.strip().partition(":")
+            if provider and model:
+                candidates.append((provider, model))
+        if candidates:
+            result[node.strip()] = candidates
+    return result
+
+
+class RoutingChatModel(BaseChatModel):
+    """按健康度在多个服务之间路由、失败转移并对冲慢请求的对话模型"""
+
+    # 服务/模型标识 -> 模型，字典顺序即样本不足时的优先顺序
+    providers: Dict[str, BaseChatModel]
+    hedge_enabled: bool = Config.LLM_HEDGE_ENABLED
+    hedge_min_delay: float = Config.LLM_HEDGE_MIN_DELAY
+    hedge_max_delay: float = Config.LLM_HEDGE_MAX_DELAY
+    hedge_cold_delay: float = Config.LLM_HEDGE_COLD_DELAY
+    # 节点 -> [(服务, 模型)]，以及按 (服务, 模型) 创建模型的工厂函数
+    node_models: Dict[str, List[Tuple[str, str]]] = Field(default_factory=dict)
+    model_factory: Optional[Callable[[str, str], BaseChatModel]] = Field(default=None, exclude=True)
+
+    _node_routers: Dict[str, "RoutingChatModel"] = PrivateAttr(default_factory=dict)
+
+    @property
+    def _llm_type(self) -> str:
+        return "routing-chat"
+
+    def bind_tools(self, tools, *, tool_choice=None, **kwargs):
+        """各服务均为 OpenAI 兼容接口，工具统一转换为 OpenAI 格式"""
+        formatted_tools = [convert_to_openai_tool(tool) for tool in tools]
+        if tool_choice:
+            # 只有一个工具时（如结构化输出）直接指定该工具，兼容不支持 required 的服务
+            if tool_choice in ("any", "required", True) and len(formatted_tools) == 1:
+                tool_choice = formatted_tools[0]["function"]["name"]
+            elif tool_choice == "any":
+                tool_choice = "required"
+            if isinstance(tool_choice, str) and tool_choice not in ("auto", "none", "required"):
+                tool_choice = {"type": "function", "function": {"name": tool_choice}}
+            kwargs["tool_choice"] = tool_choice
+        return self.bind(tools=formatted_tools, **kwargs)
+
+    def for_node(self, node: str) -> "RoutingChatModel":
+        """返回指定节点使用的路由，未配置节点模型时返回自身"""
+        candidates = self.node_models.get(node)
+        if not candidates or self.model_factory is None:
+            return self
+        router = self._node_routers.get(node)
+        if router is None:
+            providers = {f"{provider}/{model}": self.model_factory(provider, model) for provider, model in candidates}
+            router = RoutingChatModel(providers=providers, hedge_enabled=self.hedge_enabled,
+                                      hedge_min_delay=self.hedge_min_delay, hedge_max_delay=self.hedge_max_delay,
+                                      hedge_cold_delay=self.hedge_cold_delay, callbacks=self.callbacks)
+            self._node_routers[node] = router
+        return router
+
+    def ranked(self, kind: str = "generate") -> List[str]:
+        """按健康度排序的服务：有足够样本的按得分，其余按配置顺序，熔断中的排在最后"""
+        order = {key: index for index, key in enumerate(self.providers)}
+
+        def sort_key(key: str):
+            health = get_health(key, kind)
+            score = health.score()
+            return health.is_open(), score is None, score or 0.0, order[key]
+
+        return sorted(self.providers, key=sort_key)
+
+    def _hedge_delay(self, key: str) -> float:
+        health = get_health(key)
+        stats = health.snapshot()
+        # 冷启动时没有可信的 p95，按固定等待时间对冲，而不是等到上限
+        delay = self.hedge_cold_delay if stats["samples"] < health.min_samples or stats["p95"] is None else stats["p95"]
+        return min(self.hedge_max_delay, max(self.hedge_min_delay, delay))
+
+    def _call(self, key: str, messages: List[BaseMessage], stop: Optional[List[str]],
+              run_manager: Optional[CallbackManagerForLLMRun], **kwargs: Any) -> ChatResult:
+        """调用单个服务并记录耗时与成败"""
+        started_at = time.perf_counter()
+        try:
+            result = self.providers[key]._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        except Exception:
+            get_health(key).record(time.perf_counter() - started_at, False)
+            router_calls.inc(provider=key, status="error")
+            raise
+        get_health(key).record(time.perf_counter() - started_at, True)
+        router_calls.inc(provider=key, status="success")
+        result.llm_output = {**(result.llm_output or {}), "provider": key}
+        return result
+
+    def _submit(self, key: str, messages: List[BaseMessage], stop: Optional[List[str]],
+                run_manager: Optional[CallbackManagerForLLMRun], **kwargs: Any):
+        # 在调用方的上下文中执行，保留链路追踪和性能分析的上下文
+        context = contextvars.copy_context()
+        return _executor.submit(context.run, self._call, key, messages, stop, run_manager, **kwargs)
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        candidates = self.ranked()
+        last_error = None
+        while candidates:
+            primary = candidates.pop(0)
+            if not self.hedge_enabled or not candidates:
+                try:
+                    return self._call(primary, messages, stop, run_manager, **kwargs)
+                except Exception as e:
+                    logger.warning(f"LLM provider {primary} failed, failing over: {e}")
+                    last_error = e
+                    continue
+
+            pending = {self._submit(primary, messages, stop, run_manager, **kwargs): primary}
+            done, _ = wait(pending, timeout=self._hedge_delay(primary))
+            hedged = False
+            if not done:
+                if _hedge_slots.acquire(blocking=False):
+                    # 首选服务超过 p95 仍未返回，向次优服务发送对冲请求；对冲请求不上报流式回调，避免重复输出
+                    hedge = candidates.pop(0)
+                    pending[self._submit(hedge, messages, stop, None, **kwargs)] = hedge
+                    _release_when_done(list(pending), _hedge_slots.release)
+                    hedged = True
+                    logger.info(f"Hedging slow LLM call on {primary} with {hedge}")
+                else:
+                    router_hedges_skipped.inc()
+                    logger.info(f"Hedge limit reached, waiting for slow LLM call on {primary}")
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.warning(f"LLM provider {key} failed, failing over: {e}")
+                        last_error = e
+                        continue
+                    if hedged:
+                        router_hedges.inc(winner="primary" if key == primary else "hedge")
+                    # 尚未开始执行的请求直接取消，已在执行的只能等其自然结束
+                    for other in pending:
+                        other.cancel()
+                    return result
+        raise last_error or RuntimeError("没有可用的LLM服务")
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        last_error = None
+        for key in self.ranked("stream"):
+            health = get_health(key, "stream")
+            started_at = time.perf_counter()
+            # 首个分块的耗时，输出长度不影响服务的排序
+            first_chunk = None
+            try:
+                for chunk in self.providers[key]._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                    if first_chunk is None:
+                        first_chunk = time.perf_counter() - started_at
+                    yield chunk
+            except Exception as e:
+                health.record(time.perf_counter() - started_at if first_chunk is None else first_chunk, False)
+                router_calls.inc(provider=key, status="error")
+                if first_chunk is not None:
+                    raise
+                logger.warning(f"LLM provider {key} failed before streaming, failing over: {e}")
+                last_error = e
+                continue
+            health.record(time.perf_counter() - started_at if first_chunk is None else first_chunk, True)
+            router_calls.inc(provider=key, status="success")
+            return
+        raise last_error or RuntimeError("没有可用的LLM服务")
+
+    def stats(self) -> dict:
+        return {key: {kind: get_health(key, kind).snapshot() for kind in ("generate", "stream")}
+                for key in self.providers}
+
+
+def node_llm(llm_chat: BaseChatModel, node: str) -> BaseChatModel:
+    """节点使用的模型：路由模型按节点配置选择，其他模型原样返回"""
+    if isinstance(llm_chat, RoutingChatModel):
+        return llm_chat.for_node(node)
+    return llm_chat
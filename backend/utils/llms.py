@@ -1,7 +1,26 @@
 import os
 import logging
+import math
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Any, Iterator, List, Optional
+from langchain_core.callbacks import BaseCallbackHandler, CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult, LLMResult
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from pydantic import ConfigDict, Field
 from dotenv import load_dotenv
+from .metrics import embedding_latency, embedding_texts, llm_calls, llm_tokens
+from .tracing import tracer, set_span_attributes
+from .profiler import profile_stage, record_cache, record_tokens
+from .rate_limit import ProviderRateLimiter, embedding_limiter, estimate_tokens, get_chat_limiter
+from .llm_router import RoutingChatModel, parse_node_models
+from .config import Config
+from opentelemetry import trace
 load_dotenv()
 
 # 设置日志模版
@@ -38,11 +57,140 @@ MODEL_CONFIGS = {
 }
 
 
+class LLMMetricsCallback(BaseCallbackHandler):
+    """统计LLM调用次数和输入/输出令牌数"""
+
+    def __init__(self, model: str, resolve_model: bool = False):
+        self.model = model
+        # 经路由调用时模型由路由决定，按响应中的模型名统计
+        self.resolve_model = resolve_model
+
+    @staticmethod
+    def _response_model(response: LLMResult) -> Optional[str]:
+        model = (response.llm_output or {}).get("model_name")
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                model = model or getattr(message, "response_metadata", {}).get("model_name")
+        return model
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        model = (self.resolve_model and self._response_model(response)) or self.model
+        llm_calls.inc(model=model, status="success")
+        input_tokens = output_tokens = 0
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    input_tokens += usage.get("input_tokens", 0)
+                    output_tokens += usage.get("output_tokens", 0)
+        # 部分兼容接口只在 llm_output 中返回用量
+        if not input_tokens and not output_tokens and response.llm_output:
+            token_usage = response.llm_output.get("token_usage") or {}
+            input_tokens = token_usage.get("prompt_tokens", 0)
+            output_tokens = token_usage.get("completion_tokens", 0)
+        llm_tokens.inc(input_tokens, model=model, direction="input")
+        llm_tokens.inc(output_tokens, model=model, direction="output")
+        record_tokens(input_tokens, output_tokens)
+        # 令牌数记录到当前（节点）span 上，同一节点多次调用LLM时各记录一个事件
+        span = trace.get_current_span()
+        if span.is_recording():
+            span.add_event("llm.usage", {"llm.model": model, "llm.input_tokens": input_tokens,
+                                         "llm.output_tokens": output_tokens})
+
+    def on_llm_error(self, error: BaseException, **kwargs: Any) -> None:
+        llm_calls.inc(model=self.model, status="error")
+
+
+def _result_tokens(result: ChatResult) -> Optional[int]:
+    """从调用结果中取实际消耗的总令牌数"""
+    total = 0
+    for generation in result.generations:
+        usage = getattr(generation.message, "usage_metadata", None)
+        if usage:
+            total += usage.get("total_tokens", 0)
+    if not total and result.llm_output:
+        total = (result.llm_output.get("token_usage") or {}).get("total_tokens", 0)
+    return total or None
+
+
+def _chunk_tokens(chunk: ChatGenerationChunk) -> Optional[int]:
+    usage = getattr(chunk.message, "usage_metadata", None)
+    return usage.get("total_tokens") if usage else None
+
+
+class RateLimitedChatOpenAI(ChatOpenAI):
+    """经过共享限流器调用的 ChatOpenAI，限流错误由限流器排队重试，应将 max_retries 设为0"""
+
+    provider_limiter: Optional[ProviderRateLimiter] = Field(default=None, exclude=True)
+    estimated_output_tokens: int = 500
+
+    def _estimate_tokens(self, messages: List[BaseMessage]) -> int:
+        return estimate_tokens(sum(len(str(message.content)) for message in messages)) + \
+            (self.max_tokens or self.estimated_output_tokens)
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        generate = super()._generate
+        # streaming=True 时父类会转而调用 _stream，由 _stream 负责限流
+        if self.provider_limiter is None or self.streaming:
+            return generate(messages, stop, run_manager, **kwargs)
+        return self.provider_limiter.call(lambda: generate(messages, stop, run_manager, **kwargs),
+                                          self._estimate_tokens(messages), _result_tokens)
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        stream = super()._stream
+        if self.provider_limiter is None:
+            yield from stream(messages, stop, run_manager, **kwargs)
+            return
+        yield from self.provider_limiter.stream(lambda: stream(messages, stop, run_manager, **kwargs),
+                                                self._estimate_tokens(messages), _chunk_tokens)
+
+
+class RateLimitedOpenAIEmbeddings(OpenAIEmbeddings):
+    """经过共享限流器调用的 OpenAIEmbeddings，按文本长度预估令牌数（父类的 embed_query 也经由 embed_documents）"""
+
+    # 父类不允许任意类型的字段，限流器需要单独放开
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    provider_limiter: Optional[ProviderRateLimiter] = Field(default=None, exclude=True)
+
+    def embed_documents(self, texts: List[str], chunk_size: Optional[int] = None, **kwargs: Any) -> List[List[float]]:
+        embed = super().embed_documents
+        if self.provider_limiter is None or not texts:
+            return embed(texts, chunk_size, **kwargs)
+        # 父类按 chunk_size 分批请求，每批计一次请求
+        requests = math.ceil(len(texts) / (chunk_size or self.chunk_size))
+        return self.provider_limiter.call(lambda: embed(texts, chunk_size, **kwargs),
+                                          estimate_tokens(sum(len(text) for text in texts)), requests=requests)
+
+
 class LLMInitializationError(Exception):
     """自定义异常类用于LLM初始化错误"""
     pass
 
 
+def create_chat_model(llm_type: str, model: Optional[str] = None) -> RateLimitedChatOpenAI:
+    """按 MODEL_CONFIGS 创建对话模型，model 为空时使用配置中的 chat_model。
+
+    所有实例共享按服务划分的进程级限流器，限流错误的重试由限流器统一排队完成。
+    """
+    config = MODEL_CONFIGS[llm_type]
+    model = model or config["chat_model"]
+    return RateLimitedChatOpenAI(
+        base_url=config["base_url"],
+        api_key=config["api_key"],
+        model=model,
+        temperature=0.0,
+        timeout=30,  # 添加超时配置（秒）
+        max_retries=0,  # 客户端自身不重试，限流和临时错误都由限流器排队重试，避免各请求同时重试
+        provider_limiter=get_chat_limiter(llm_type),
+        estimated_output_tokens=Config.LLM_ESTIMATED_OUTPUT_TOKENS,
+        callbacks=[LLMMetricsCallback(model)]  # 统计调用次数和令牌数
+    )
+
+
 def initialize_llm(llm_type: str = "qwen"):
     """
     初始化LLM实例
@@ -68,21 +216,16 @@ def initialize_llm(llm_type: str = "qwen"):
             os.environ["OPENAI_API_KEY"] = "NA"
 
         # 创建LLM实例
-        llm_chat = ChatOpenAI(
-            base_url=config["base_url"],
-            api_key=config["api_key"],
-            model=config["chat_model"],
-            temperature=0.0,
-            timeout=30,  # 添加超时配置（秒）
-            max_retries=2  # 添加重试次数
-        )
+        llm_chat = create_chat_model(llm_type)
 
-        llm_embedding = OpenAIEmbeddings(
+        llm_embedding = RateLimitedOpenAIEmbeddings(
             base_url=config["base_url"],
             api_key=config["api_key"],
             model=config["embedding_model"],
             deployment=config["embedding_model"],
-            check_embedding_ctx_length=False
+            check_embedding_ctx_length=False,
+            max_retries=0,  # 同上，重试由限流器完成
+            provider_limiter=embedding_limiter
         )
 
         logger.info(f"成功初始化 {llm_type} LLM")
@@ -96,7 +239,80 @@ def initialize_llm(llm_type: str = "qwen"):
         raise LLMInitializationError(f"初始化LLM失败: {str(e)}")
 
 
-def get_llm(llm_type: str = "qwen") -> ChatOpenAI:
+class CachedEmbeddings(Embeddings):
+    """带进程内LRU缓存的Embedding封装
+
+    同一轮对话中，用户消息入库、历史消息检索和跨线程记忆检索会对同一段文本重复计算向量，
+    这里按文本缓存向量结果，避免重复调用Embedding接口。
+    向量以 array('f')（单精度，与 pgvector 的存储精度相同）保存，1536维的向量每条约6KB，
+    是浮点数列表的约八分之一；命中时返回新的列表，调用方修改结果不会影响缓存。
+    """
+
+    def __init__(self, embeddings: Embeddings, max_size: int = 4096):
+        self.embeddings = embeddings
+        self.max_size = max_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # 其余属性（如 model）透传给被封装的Embedding实例
+        if name == "embeddings":
+            raise AttributeError(name)
+        return getattr(self.embeddings, name)
+
+    def _get(self, text: str) -> Optional[List[float]]:
+        with self._lock:
+            vector = self._cache.get(text)
+            if vector is not None:
+                self._cache.move_to_end(text)
+        return vector.tolist() if vector is not None else None
+
+    def _set(self, text: str, vector: List[float]):
+        packed = array("f", vector)
+        with self._lock:
+            self._cache[text] = packed
+            self._cache.move_to_end(text)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+    def embed_query(self, text: str) -> List[float]:
+        with tracer.start_as_current_span("embedding.query"):
+            vector = self._get(text)
+            set_span_attributes(**{"embedding.cache_hit": vector is not None})
+            record_cache("embedding", vector is not None)
+            if vector is None:
+                embedding_texts.inc(method="query", cache="miss")
+                started_at = time.perf_counter()
+                with profile_stage("embedding"):
+                    vector = self.embeddings.embed_query(text)
+                embedding_latency.observe((time.perf_counter() - started_at) * 1000, method="query")
+                self._set(text, vector)
+            else:
+                embedding_texts.inc(method="query", cache="hit")
+            return vector
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with tracer.start_as_current_span("embedding.documents"):
+            vectors = [self._get(text) for text in texts]
+            # 仅对未命中的文本批量计算向量
+            missing = [i for i, vector in enumerate(vectors) if vector is None]
+            set_span_attributes(**{"embedding.texts": len(texts), "embedding.cache_hits": len(texts) - len(missing)})
+            embedding_texts.inc(len(texts) - len(missing), method="documents", cache="hit")
+            record_cache("embedding", True, len(texts) - len(missing))
+            record_cache("embedding", False, len(missing))
+            if missing:
+                embedding_texts.inc(len(missing), method="documents", cache="miss")
+                started_at = time.perf_counter()
+                with profile_stage("embedding"):
+                    computed = self.embeddings.embed_documents([texts[i] for i in missing])
+                embedding_latency.observe((time.perf_counter() - started_at) * 1000, method="documents")
+                for i, vector in zip(missing, computed):
+                    vectors[i] = vector
+                    self._set(texts[i], vector)
+            return vectors
+
+
+def get_llm(llm_type: str = "qwen"):
     """
     获取LLM实例的封装函数，提供默认值和错误处理
 
@@ -104,15 +320,42 @@ def get_llm(llm_type: str = "qwen") -> ChatOpenAI:
         llm_type (str): LLM类型
 
     Returns:
-        ChatOpenAI: LLM实例
+        tuple: (Chat模型, Embedding模型)，配置了多服务路由时Chat模型为 RoutingChatModel
     """
     try:
-        return initialize_llm(llm_type)
+        llm_chat, llm_embedding = initialize_llm(llm_type)
     except LLMInitializationError as e:
         logger.warning(f"使用默认配置重试: {str(e)}")
         if llm_type != "qwen":
-            return initialize_llm("qwen")
-        raise  # 如果默认配置也失败，则抛出异常
+            llm_type = "qwen"
+            llm_chat, llm_embedding = initialize_llm(llm_type)
+        else:
+            raise  # 如果默认配置也失败，则抛出异常
+    # 配置了备选服务或节点模型时改用路由模型，嵌入模型始终使用主服务的，保证向量维度一致
+    if Config.LLM_PROVIDERS or Config.LLM_NODE_MODELS:
+        llm_chat = create_router(llm_type, llm_chat)
+    return llm_chat, llm_embedding
+
+
+def create_router(llm_type: str, llm_chat: BaseChatModel) -> RoutingChatModel:
+    """以 llm_type 为首选、Config.LLM_PROVIDERS 为备选创建路由模型，初始化失败的备选服务被跳过"""
+    providers = {f"{llm_type}/{llm_chat.model_name}": llm_chat}
+    for provider in Config.LLM_PROVIDERS:
+        if provider == llm_type:
+            continue
+        try:
+            model = create_chat_model(provider)
+        except Exception as e:
+            logger.warning(f"备选LLM服务 {provider} 初始化失败，已跳过: {e}")
+            continue
+        providers[f"{provider}/{model.model_name}"] = model
+    logger.info(f"LLM路由已启用，候选服务: {list(providers)}")
+    return RoutingChatModel(
+        providers=providers,
+        node_models=parse_node_models(Config.LLM_NODE_MODELS),
+        model_factory=create_chat_model,
+        callbacks=[LLMMetricsCallback(llm_chat.model_name, resolve_model=True)],
+    )
 
 
 # 示例使用
@@ -0,0 +1,151 @@
+"""异步日志
+
+所有模块的日志经根日志器上的 QueueHandler 放入内存队列，由后台 QueueListener 线程统一完成
+JSON/文本格式化和写文件（ConcurrentRotatingFileHandler 的跨进程文件锁只在后台线程中获取），
+请求线程只做级别判断和消息拼接：
+- 日志级别：根级别 Config.LOG_LEVEL，按模块覆盖 Config.LOG_LEVELS（如 "ragAgent=DEBUG,httpx=WARNING"）；
+- 日志消息请使用 logger.debug("... %s", value) 的惰性格式化，被级别过滤的日志不会拼接字符串；
+- 流式输出等逐块日志写入 sampled_logger() 返回的日志器，每 Config.LOG_STREAM_SAMPLE_RATE 条只保留一条；
+- 队列满时丢弃日志而不是阻塞请求，丢弃数量记录在 dropped_records。
+"""
+import atexit
+import itertools
+import json
+import logging
+import queue
+import sys
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+from concurrent_log_handler import ConcurrentRotatingFileHandler
+from .config import Config
+
+# 标准 LogRecord 的属性，其余属性（logger.info(..., extra={...}) 传入）作为JSON字段输出
+_RESERVED_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+_listener: Optional[QueueListener] = None
+_setup_lock = threading.Lock()
+dropped_records = 0
+
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出一行JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RESERVED_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """只在调用线程中拼接消息，格式化与写入交给后台线程；队列满时直接丢弃"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 立即固化消息内容，避免参数对象在后台线程写入前被修改；格式化留给监听线程
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        global dropped_records
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_records += 1
+
+
+class SamplingFilter(logging.Filter):
+    """每 rate 条日志保留一条，WARNING 及以上级别始终保留"""
+
+    def __init__(self, rate: int):
+        super().__init__()
+        self.rate = max(1, rate)
+        self._counter = itertools.count()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        return next(self._counter) % self.rate == 0
+
+
+def parse_levels(spec: str) -> Dict[str, str]:
+    """解析 "name=LEVEL,name=LEVEL" 格式的按模块日志级别"""
+    levels = {}
+    for item in spec.split(","):
+        if "=" not in item:
+            continue
+        name, level = item.split("=", 1)
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging(level: str = Config.LOG_LEVEL, levels: str = Config.LOG_LEVELS,
+                  fmt: str = Config.LOG_FORMAT, console: bool = Config.LOG_CONSOLE) -> None:
+    """安装根日志器的 QueueHandler 并启动后台写入线程，重复调用时不做任何事"""
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+        if fmt == "json":
+            formatter = JsonFormatter()
+        else:
+            formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+
+        handlers = []
+        file_handler = ConcurrentRotatingFileHandler(
+            # 日志文件
+            Config.LOG_FILE,
+            # 单个日志文件的最大大小，达到上限后触发轮转
+            maxBytes=Config.MAX_BYTES,
+            # 轮转时最多保留的历史日志文件数
+            backupCount=Config.BACKUP_COUNT
+        )
+        file_handler.setFormatter(formatter)
+        handlers.append(file_handler)
+        if console:
+            console_handler = logging.StreamHandler(sys.stderr)
+            console_handler.setFormatter(formatter)
+            handlers.append(console_handler)
+
+        log_queue = queue.Queue(maxsize=Config.LOG_QUEUE_SIZE)
+        root = logging.getLogger()
+        # 替换掉 basicConfig 等安装的同步处理器
+        root.handlers = [NonBlockingQueueHandler(log_queue)]
+        root.setLevel(level.upper())
+        for name, module_level in parse_levels(levels).items():
+            logging.getLogger(name).setLevel(module_level)
+
+        _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown_logging)
+
+
+def shutdown_logging() -> None:
+    """写完队列中剩余的日志并停止后台线程"""
+    global _listener
+    with _setup_lock:
+        if _listener is None:
+            return
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+def sampled_logger(name: str, rate: int = Config.LOG_STREAM_SAMPLE_RATE) -> logging.Logger:
+    """返回带采样过滤器的子日志器 "<name>.sampled"，用于逐块/逐条的高频日志"""
+    logger = logging.getLogger(f"{name}.sampled")
+    if not any(isinstance(f, SamplingFilter) for f in logger.filters):
+        logger.addFilter(SamplingFilter(rate))
+    return logger
@@ -0,0 +1,268 @@
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+from html import escape
+from typing import Any, Hashable, List, Optional
+from langchain_core.prompts import ChatPromptTemplate, PromptTemplate
+from langgraph.store.base import BaseStore
+from pydantic import BaseModel, Field
+from .config import Config
+from .tracing import tracer, set_span_attributes
+from .profiler import profile_stage, record_cache
+
+logger = logging.getLogger(__name__)
+
+
+def memory_namespace(user_id: str) -> tuple:
+    """跨线程记忆的命名空间"""
+    return ("memories", user_id)
+
+
+class MemorySearchCache:
+    """按用户划分的进程内记忆检索结果LRU缓存。
+
+    同一用户的缓存在写入新记忆（store.put/delete）时整体失效。
+    多进程部署时各进程的缓存相互独立，其他进程写入的记忆要等本进程缓存被淘汰后才可见。
+    """
+
+    def __init__(self, max_users: int = Config.MEMORY_CACHE_MAX_USERS,
+                 max_queries_per_user: int = Config.MEMORY_CACHE_MAX_QUERIES):
+        self.max_users = max_users
+        self.max_queries_per_user = max_queries_per_user
+        # user_id -> OrderedDict(query_key -> results)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: str, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            queries = self._cache.get(user_id)
+            if queries is None or key not in queries:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(user_id)
+            queries.move_to_end(key)
+            self.hits += 1
+            return queries[key]
+
+    def set(self, user_id: str, key: Hashable, value: Any) -> None:
+        with self._lock:
+            queries = self._cache.setdefault(user_id, OrderedDict())
+            self._cache.move_to_end(user_id)
+            queries[key] = value
+            queries.move_to_end(key)
+            while len(queries) > self.max_queries_per_user:
+                queries.popitem(last=False)
+            while len(self._cache) > self.max_users:
+                self._cache.popitem(last=False)
+
+    def invalidate(self, user_id: str) -> None:
+        with self._lock:
+            self._cache.pop(user_id, None)
+
+
+# 全局记忆检索缓存
+memory_cache = MemorySearchCache()
+
+# 被检索命中的记忆，user_id -> {key: 命中时间}，由 MemoryManager 后台批量回写 last_used
+_touched = defaultdict(dict)
+_touched_lock = threading.Lock()
+
+
+def record_access(user_id: str, items: List[Any]) -> None:
+    """记录被检索命中的记忆，用于LRU淘汰"""
+    now = time.time()
+    with _touched_lock:
+        for item in items:
+            _touched[user_id][item.key] = now
+
+
+def _drain_touched(user_id: Optional[str] = None) -> dict:
+    global _touched
+    with _touched_lock:
+        if user_id is None:
+            touched, _touched = _touched, defaultdict(dict)
+            return touched
+        return {user_id: _touched.pop(user_id, {})}
+
+
+def search_memories(store: BaseStore, user_id: str, query: str,
+                    limit: int = Config.MEMORY_SEARCH_LIMIT,
+                    score_threshold: Optional[float] = Config.MEMORY_SCORE_THRESHOLD) -> List[Any]:
+    """检索用户的相关记忆，命中缓存时不再计算查询向量和执行向量查询。
+
+    Args:
+        store: 数据存储实例。
+        user_id: 用户ID。
+        query: 检索语句。
+        limit: 返回的最大记忆条数。
+        score_threshold: 相似度阈值，低于该值的记忆被过滤，为 None 时不过滤。
+
+    Returns:
+        List[SearchItem]: 按相似度排序的记忆列表。
+    """
+    with tracer.start_as_current_span("memory.search"), profile_stage("memory.search"):
+        key = (query, limit, score_threshold)
+        cached = memory_cache.get(user_id, key)
+        set_span_attributes(**{"memory.cache_hit": cached is not None})
+        record_cache("memory", cached is not None)
+        if cached is not None:
+            record_access(user_id, cached)
+            return cached
+
+        items = store.search(memory_namespace(user_id), query=query, limit=limit)
+        if score_threshold is not None:
+            items = [item for item in items if item.score is None or item.score >= score_threshold]
+        set_span_attributes(**{"memory.results": len(items)})
+        memory_cache.set(user_id, key, items)
+        record_access(user_id, items)
+        return items
+
+
+def put_memory(store: BaseStore, user_id: str, key: str, value: dict) -> None:
+    """写入一条用户记忆，并使该用户的检索缓存失效"""
+    store.put(memory_namespace(user_id), key, value)
+    memory_cache.invalidate(user_id)
+
+
+def delete_memory(store: BaseStore, user_id: str, key: str) -> None:
+    """删除一条用户记忆，并使该用户的检索缓存失效"""
+    store.delete(memory_namespace(user_id), key)
+    memory_cache.invalidate(user_id)
+
+
+# 记忆抽取的结构化输出
+class MemoryFacts(BaseModel):
+    facts: List[str] = Field(default_factory=list, description="Facts about the user worth remembering")
+
+
+class MemoryManager:
+    """结构化记忆管理器。
+
+    用户消息在响应发送后进入有界队列，由后台线程按批次调用LLM抽取事实；
+    写入前按向量相似度与已有记忆去重，相同事实合并为一条并更新内容；
+    每个用户的记忆数量有上限，超出时按最近使用时间淘汰。
+    """
+
+    def __init__(self, store: BaseStore, llm_chat,
+                 max_memories_per_user: int = Config.MEMORY_MAX_PER_USER,
+                 dedup_threshold: float = Config.MEMORY_DEDUP_THRESHOLD,
+                 batch_size: int = Config.MEMORY_EXTRACT_BATCH_SIZE,
+                 flush_interval: float = Config.MEMORY_EXTRACT_INTERVAL,
+                 trigger_keywords: Optional[List[str]] = None,
+                 max_queue_size: int = 1000):
+        self.store = store
+        self.max_memories_per_user = max_memories_per_user
+        self.dedup_threshold = dedup_threshold
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.trigger_keywords = Config.MEMORY_TRIGGER_KEYWORDS if trigger_keywords is None else trigger_keywords
+        prompt_template = PromptTemplate.from_file(Config.PROMPT_TEMPLATE_TXT_MEMORY, encoding="utf-8")
+        self.extract_chain = ChatPromptTemplate.from_messages([("human", prompt_template.template)]) | \
+            llm_chat.with_structured_output(MemoryFacts)
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self._stopped = threading.Event()
+        self._worker = threading.Thread(target=self._run, daemon=True, name="memory-manager")
+        self._worker.start()
+
+    def enqueue(self, user_id: str, text: str) -> bool:
+        """提交一条用户消息等待后台抽取，不阻塞请求；队列已满时丢弃"""
+        if self.trigger_keywords and not any(keyword in text for keyword in self.trigger_keywords):
+            return False
+        try:
+            self.queue.put_nowait((user_id, text))
+            return True
+        except queue.Full:
+            logger.warning(f"Memory extraction queue is full, dropping message for user {user_id}")
+            return False
+
+    def _run(self):
+        while not self._stopped.is_set() or not self.queue.empty():
+            try:
+                batch = [self.queue.get(timeout=self.flush_interval)]
+            except queue.Empty:
+                self._flush_touched()
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.process_batch(batch)
+            except Exception as e:
+                logger.error(f"Error processing memory batch: {e}")
+
+    def process_batch(self, batch: List[tuple]) -> None:
+        """按用户分组，每个用户调用一次LLM抽取事实后去重写入并执行淘汰"""
+        texts_by_user = defaultdict(list)
+        for user_id, text in batch:
+            texts_by_user[user_id].append(text)
+        for user_id, texts in texts_by_user.items():
+            facts = self.extract(texts)
+            for fact in facts:
+                self.upsert(user_id, fact)
+            self._flush_touched(user_id)
+            if facts:
+                self.evict(user_id)
+
+    def extract(self, texts: List[str]) -> List[str]:
+        """调用LLM从一批用户消息中抽取事实"""
+        try:
+            result = self.extract_chain.invoke({"messages": "\n".join(texts)})
+            # 去掉空白与批内重复
+            return list(dict.fromkeys(fact.strip() for fact in result.facts if fact and fact.strip()))
+        except Exception as e:
+            logger.error(f"Error extracting memories: {e}")
+            return []
+
+    def upsert(self, user_id: str, fact: str) -> str:
+        """写入一条事实：与已有记忆足够相似时合并为同一条，否则新增"""
+        fact = escape(fact)
+        now = time.time()
+        similar = self.store.search(memory_namespace(user_id), query=fact, limit=1)
+        if similar and similar[0].score is not None and similar[0].score >= self.dedup_threshold:
+            existing = similar[0]
+            # 同一事实的新说法覆盖旧内容，并累计被提及的次数
+            value = {**existing.value, "data": fact, "count": existing.value.get("count", 1) + 1, "last_used": now}
+            put_memory(self.store, user_id, existing.key, value)
+            logger.info(f"Merged memory {existing.key}: {fact}")
+            return existing.key
+        key = str(uuid.uuid4())
+        put_memory(self.store, user_id, key, {"data": fact, "count": 1, "created_at": now, "last_used": now})
+        logger.info(f"Stored memory: {fact}")
+        return key
+
+    def evict(self, user_id: str) -> int:
+        """记忆数量超过上限时，删除最久未使用的记忆"""
+        items = self.store.search(memory_namespace(user_id), limit=self.max_memories_per_user + 100)
+        overflow = len(items) - self.max_memories_per_user
+        if overflow <= 0:
+            return 0
+        items.sort(key=lambda item: item.value.get("last_used", 0))
+        for item in items[:overflow]:
+            delete_memory(self.store, user_id, item.key)
+        logger.info(f"Evicted {overflow} least recently used memories for user {user_id}")
+        return overflow
+
+    def _flush_touched(self, user_id: Optional[str] = None) -> None:
+        """批量回写记忆的最近使用时间，不重新计算向量"""
+        touched = _drain_touched(user_id)
+        for uid, keys in touched.items():
+            for key, last_used in keys.items():
+                try:
+                    item = self.store.get(memory_namespace(uid), key)
+                    if item:
+                        self.store.put(memory_namespace(uid), key, {**item.value, "last_used": last_used}, index=False)
+                except Exception as e:
+                    logger.error(f"Error updating memory access time: {e}")
+
+    def shutdown(self, timeout: float = 10.0) -> None:
+        """停止后台线程，等待队列中的消息处理完毕"""
+        self._stopped.set()
+        self._worker.join(timeout=timeout)
+        self._flush_touched()
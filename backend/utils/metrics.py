@@ -0,0 +1,217 @@
+"""进程内指标
+
+提供计数器和分桶直方图，并以 Prometheus 文本格式输出（GET /metrics），抓取时不依赖任何外部服务。
+多进程部署时每个进程独立计数，需要分别抓取。
+"""
+import bisect
+import math
+import threading
+from typing import Callable, Dict, List, Sequence, Tuple
+
+# 默认的耗时分桶上界（毫秒）
+DEFAULT_MS_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# LLM、工具等较慢操作的耗时分桶上界（毫秒）
+SLOW_MS_BUCKETS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 20000, 30000, 60000)
+
+
+class Histogram:
+    """线程安全的累积分桶直方图，分桶上界为 buckets，最后一个桶为 +Inf"""
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_MS_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self) -> Tuple[list, float, int]:
+        """返回 (各分桶计数（非累积）, 观测值总和, 观测次数)"""
+        with self._lock:
+            return list(self._counts), self._sum, self._count
+
+    def quantile_upper_bound(self, q: float, counts: Sequence[int] = None) -> float:
+        """按分桶估算分位数，返回所在分桶的上界，落在 +Inf 桶时返回 inf"""
+        if counts is None:
+            counts = self.snapshot()[0]
+        total = sum(counts)
+        if total == 0:
+            return 0.0
+        threshold = q * total
+        cumulative = 0
+        for index, count in enumerate(counts):
+            cumulative += count
+            if cumulative >= threshold:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        f'{key}="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for key, value in labels.items()
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+def format_sample(name: str, value: float, labels: Dict[str, str] = None) -> str:
+    """格式化一行样本"""
+    return f"{name}{_format_labels(labels or {})} {_format_value(value)}"
+
+
+def format_header(name: str, documentation: str, metric_type: str) -> List[str]:
+    return [f"# HELP {name} {documentation}", f"# TYPE {name} {metric_type}"]
+
+
+def format_histogram(name: str, histogram: Histogram, labels: Dict[str, str] = None) -> List[str]:
+    """按 Prometheus 格式输出直方图的累积分桶、总和与次数"""
+    labels = labels or {}
+    counts, total, count = histogram.snapshot()
+    lines = []
+    cumulative = 0
+    for bound, bucket_count in zip(list(histogram.buckets) + [float("inf")], counts):
+        cumulative += bucket_count
+        lines.append(format_sample(f"{name}_bucket", cumulative, {**labels, "le": _format_value(bound)}))
+    lines.append(format_sample(f"{name}_sum", total, labels))
+    lines.append(format_sample(f"{name}_count", count, labels))
+    return lines
+
+
+class Counter:
+    """带标签的单调递增计数器"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            return self._values.get(key, 0.0)
+
+    def collect(self) -> List[str]:
+        lines = format_header(self.name, self.documentation, "counter")
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            lines.append(format_sample(self.name, value, dict(zip(self.labelnames, key))))
+        return lines
+
+
+class LabeledHistogram:
+    """按标签划分的直方图"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_MS_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = buckets
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, **labels) -> Histogram:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = Histogram(self.buckets)
+            return child
+
+    def observe(self, value: float, **labels) -> None:
+        self.labels(**labels).observe(value)
+
+    def collect(self) -> List[str]:
+        lines = format_header(self.name, self.documentation, "histogram")
+        with self._lock:
+            children = list(self._children.items())
+        for key, child in children:
+            lines.extend(format_histogram(self.name, child, dict(zip(self.labelnames, key))))
+        return lines
+
+
+class Registry:
+    """指标注册表，collect 函数用于输出抓取时才计算的指标（如连接池状态）"""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_MS_BUCKETS) -> LabeledHistogram:
+        metric = LabeledHistogram(name, documentation, labelnames, buckets)
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector: Callable[[], List[str]]) -> None:
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self) -> str:
+        """以 Prometheus 文本格式输出所有指标"""
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.collect())
+        for collector in collectors:
+            try:
+                lines.extend(collector())
+            except Exception:
+                # 单个采集函数失败不影响其他指标输出
+                continue
+        return "\n".join(lines) + "\n"
+
+
+# 全局指标注册表
+registry = Registry()
+
+# LangGraph 节点耗时与失败次数
+graph_node_latency = registry.histogram("graph_node_latency_ms", "LangGraph node latency in milliseconds",
+                                        ["node"], SLOW_MS_BUCKETS)
+graph_node_errors = registry.counter("graph_node_errors_total", "LangGraph node failures", ["node"])
+# 问题重写次数，以及达到重写上限后强制生成的次数
+graph_rewrites = registry.counter("graph_rewrites_total", "Query rewrites performed by the rewrite node")
+graph_rewrite_limit_reached = registry.counter("graph_rewrite_limit_reached_total",
+                                               "Turns that hit the rewrite limit and were forced to generate")
+# 工具调用耗时与结果
+tool_latency = registry.histogram("tool_latency_ms", "Tool call latency in milliseconds", ["tool"], SLOW_MS_BUCKETS)
+tool_calls = registry.counter("tool_calls_total", "Tool calls by result", ["tool", "status"])
+# Embedding 调用：请求的文本数（按缓存命中划分）与实际调用接口的耗时
+embedding_texts = registry.counter("embedding_texts_total", "Texts requested for embedding", ["method", "cache"])
+embedding_latency = registry.histogram("embedding_latency_ms", "Embedding API call latency in milliseconds",
+                                       ["method"], SLOW_MS_BUCKETS)
+# LLM 调用次数与令牌数
+llm_calls = registry.counter("llm_calls_total", "LLM calls by result", ["model", "status"])
+llm_tokens = registry.counter("llm_tokens_total", "LLM tokens by direction", ["model", "direction"])
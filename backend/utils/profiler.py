@@ -0,0 +1,106 @@
+"""请求级耗时分析
+
+客户端通过请求体 debug=true 或请求头 X-Debug-Timings: 1 开启，处理该请求期间各阶段的耗时、
+令牌数、调用的工具和缓存命中情况记录到一个 RequestProfiler 中，最终以 timings 字段返回。
+
+当前请求的分析器保存在 contextvars 中：asyncio.to_thread、LangGraph 的节点执行线程和
+ParallelToolNode 的工具线程都会复制上下文，因此各层无需显式传递分析器；未开启时记录函数均为空操作。
+"""
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+
+class RequestProfiler:
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self._lock = threading.Lock()
+        # 阶段名 -> [调用次数, 累计耗时(ms)]
+        self.stages = defaultdict(lambda: [0, 0.0])
+        self.tokens = defaultdict(int)
+        self.tools = []
+        # 缓存名 -> {"hit": n, "miss": n}
+        self.cache = defaultdict(lambda: {"hit": 0, "miss": 0})
+
+    def add_stage(self, name: str, elapsed_ms: float) -> None:
+        with self._lock:
+            stage = self.stages[name]
+            stage[0] += 1
+            stage[1] += elapsed_ms
+
+    def add_tokens(self, input_tokens: int, output_tokens: int) -> None:
+        with self._lock:
+            self.tokens["input"] += input_tokens
+            self.tokens["output"] += output_tokens
+
+    def add_tool(self, name: str, elapsed_ms: float, status: str) -> None:
+        with self._lock:
+            self.tools.append({"name": name, "ms": round(elapsed_ms, 2), "status": status})
+
+    def add_cache(self, name: str, hit: bool, count: int = 1) -> None:
+        with self._lock:
+            self.cache[name]["hit" if hit else "miss"] += count
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "total_ms": round((time.perf_counter() - self.started_at) * 1000, 2),
+                "stages": {name: {"count": count, "ms": round(ms, 2)} for name, (count, ms) in self.stages.items()},
+                "tokens": dict(self.tokens),
+                "tools": list(self.tools),
+                "cache": {name: dict(counts) for name, counts in self.cache.items()},
+            }
+
+
+_current: ContextVar[Optional[RequestProfiler]] = ContextVar("request_profiler", default=None)
+
+
+def start_profiling() -> RequestProfiler:
+    """为当前上下文创建并激活一个分析器"""
+    profiler = RequestProfiler()
+    _current.set(profiler)
+    return profiler
+
+
+def activate(profiler: Optional[RequestProfiler]) -> None:
+    """在另一个上下文（如流式响应的生成器）中激活已有的分析器"""
+    _current.set(profiler)
+
+
+def current_profiler() -> Optional[RequestProfiler]:
+    return _current.get()
+
+
+@contextmanager
+def profile_stage(name: str):
+    """统计一个阶段的耗时，同名阶段多次执行时累加"""
+    profiler = _current.get()
+    if profiler is None:
+        yield
+        return
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        profiler.add_stage(name, (time.perf_counter() - started_at) * 1000)
+
+
+def record_tokens(input_tokens: int, output_tokens: int) -> None:
+    profiler = _current.get()
+    if profiler is not None:
+        profiler.add_tokens(input_tokens, output_tokens)
+
+
+def record_tool(name: str, elapsed_ms: float, status: str) -> None:
+    profiler = _current.get()
+    if profiler is not None:
+        profiler.add_tool(name, elapsed_ms, status)
+
+
+def record_cache(name: str, hit: bool, count: int = 1) -> None:
+    profiler = _current.get()
+    if profiler is not None and count:
+        profiler.add_cache(name, hit, count)
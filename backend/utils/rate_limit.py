@@ -0,0 +1,271 @@
+"""LLM服务调用的客户端限流
+
+同一进程内所有对话共享每个服务的对话模型限流器和一个嵌入模型限流器，在请求发出前协调调用速率，
+避免服务端限流（如 DashScope 返回429）时所有进行中的请求同时重试、形成重试风暴：
+- 每分钟请求数与每分钟令牌数各用一个令牌桶，令牌数按输入文本长度和预期输出长度预估，
+  调用完成后按实际用量修正；
+- 并发数按 AIMD 自适应调整：调用成功时缓慢增加（每个并发窗口加1），收到429时减半，
+  1秒内的多次429只减半一次；
+- 被限流的调用释放并发槽位后，按 Retry-After（没有时按指数退避加抖动）等待，再重新经过限流器排队重试，
+  重试次数由 Config.LLM_RATE_LIMIT_RETRIES 控制；超时、连接错误和5xx同样按抖动退避重新排队，
+  重试次数由 Config.LLM_TRANSIENT_RETRIES 控制。客户端自身的重试关闭（max_retries=0），所有重试都经过限流器；
+- 排队等待时间记录到 llm_queue_wait_ms 指标和请求的性能分析阶段（"{name}.queue"）中。
+
+多进程部署时各进程独立限流，每分钟额度需按进程数分摊。
+"""
+import logging
+import math
+import random
+import threading
+import time
+from typing import Any, Callable, Iterator, Optional
+from .config import Config
+from .metrics import format_header, format_sample, registry
+from .profiler import profile_stage
+
+logger = logging.getLogger(__name__)
+
+llm_queue_wait = registry.histogram("llm_queue_wait_ms", "Time LLM provider calls spent waiting in the client-side limiter",
+                                    ["client"])
+llm_retries = registry.counter("llm_retries_total", "Failed LLM provider calls by retry reason and outcome",
+                               ["client", "reason", "outcome"])
+
+
+def is_rate_limit_error(error: BaseException) -> bool:
+    """是否为服务端限流错误（openai.RateLimitError 或状态码429）"""
+    if type(error).__name__ == "RateLimitError":
+        return True
+    return getattr(error, "status_code", None) == 429
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """是否为可重试的临时错误：超时、连接错误（openai.APITimeoutError/APIConnectionError）或服务端5xx"""
+    if type(error).__name__ in ("APITimeoutError", "APIConnectionError", "InternalServerError"):
+        return True
+    status_code = getattr(error, "status_code", None)
+    return isinstance(status_code, int) and status_code >= 500
+
+
+def retry_delay(error: BaseException, attempt: int, max_delay: float = 30.0) -> float:
+    """优先使用响应的 Retry-After，否则按指数退避并加入抖动，避免被限流的请求同时重试"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        retry_after = float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        retry_after = None
+    if retry_after is not None and retry_after >= 0:
+        return min(max_delay, retry_after) + random.uniform(0, 0.5)
+    return random.uniform(0, min(max_delay, 2 ** attempt))
+
+
+class TokenBucket:
+    """每分钟 per_minute 个令牌的令牌桶，容量为一分钟的额度，per_minute <= 0 时不限制。
+
+    reserve 立即扣除令牌并返回需要等待的时间，余额允许为负，后续调用按欠额排在后面，
+    因此预估值偏大或偏小都不会让某个调用无限等待。
+    """
+
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.rate = per_minute / 60.0
+        self._tokens = float(per_minute)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.per_minute, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def reserve(self, amount: float) -> float:
+        """预留 amount 个令牌，返回需要等待的秒数"""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            self._refill()
+            self._tokens -= amount
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def adjust(self, amount: float) -> None:
+        """按实际用量修正：amount 为正时退还令牌，为负时补扣"""
+        if self.rate <= 0 or not amount:
+            return
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.per_minute, self._tokens + amount)
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD 自适应并发上限：成功时每个并发窗口加1，被限流时乘以 decrease_factor"""
+
+    def __init__(self, initial: int, min_limit: int = 1, max_limit: int = 32,
+                 decrease_factor: float = 0.5, cooldown: float = 1.0):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(self.max_limit, max(self.min_limit, initial)))
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self) -> None:
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled: bool = False) -> None:
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                now = time.monotonic()
+                # 同一波限流会让多个进行中的调用先后失败，冷却期内只减半一次
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    self._last_decrease = now
+                    logger.warning(f"LLM provider throttled, concurrency limit lowered to {int(self.limit)}")
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+class ProviderRateLimiter:
+    """组合每分钟请求数、每分钟令牌数和自适应并发三项限制，并负责限流错误的重试"""
+
+    def __init__(self, name: str, requests_per_minute: int, tokens_per_minute: int, concurrency: int,
+                 min_concurrency: int = 1, max_concurrency: int = 32, max_retries: int = 3,
+                 transient_retries: int = 2):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.concurrency = AdaptiveConcurrencyLimiter(concurrency, min_concurrency, max_concurrency)
+        self.max_retries = max_retries
+        self.transient_retries = transient_retries
+
+    def _acquire(self, estimated_tokens: int, requests: int) -> None:
+        started_at = time.perf_counter()
+        with profile_stage(f"{self.name}.queue"):
+            # 先取得并发槽位再扣除速率额度，避免排队中的调用提前消耗额度
+            self.concurrency.acquire()
+            delay = max(self.requests.reserve(requests), self.tokens.reserve(estimated_tokens))
+            if delay > 0:
+                time.sleep(delay)
+        llm_queue_wait.observe((time.perf_counter() - started_at) * 1000, client=self.name)
+
+    def _release(self, estimated_tokens: int, actual_tokens: Optional[int], throttled: bool) -> None:
+        if actual_tokens is not None:
+            self.tokens.adjust(estimated_tokens - actual_tokens)
+        self.concurrency.release(throttled)
+
+    def _retry_delay(self, error: BaseException, retries: dict) -> Optional[float]:
+        """需要重试时返回等待秒数，否则返回 None；retries 记录各类错误已重试的次数"""
+        if is_rate_limit_error(error):
+            reason, limit = "rate_limit", self.max_retries
+        elif is_transient_error(error):
+            reason, limit = "transient", self.transient_retries
+        else:
+            return None
+        attempt = retries.get(reason, 0)
+        if attempt >= limit:
+            llm_retries.inc(client=self.name, reason=reason, outcome="failed")
+            return None
+        retries[reason] = attempt + 1
+        llm_retries.inc(client=self.name, reason=reason, outcome="retried")
+        return retry_delay(error, attempt)
+
+    def call(self, fn: Callable[[], Any], estimated_tokens: int, count_tokens: Callable[[Any], Optional[int]] = None,
+             requests: int = 1) -> Any:
+        """在限流器内执行 fn，被限流或遇到临时错误时重新排队重试"""
+        retries = {}
+        while True:
+            self._acquire(estimated_tokens, requests)
+            try:
+                result = fn()
+            except Exception as e:
+                self._release(estimated_tokens, None, is_rate_limit_error(e))
+                delay = self._retry_delay(e, retries)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            self._release(estimated_tokens, count_tokens(result) if count_tokens else None, False)
+            return result
+
+    def stream(self, make_iterator: Callable[[], Iterator], estimated_tokens: int,
+               count_tokens: Callable[[Any], Optional[int]] = None) -> Iterator:
+        """流式版本的 call：只有在收到第一个分块之前出错才重试，已输出的内容无法撤回"""
+        retries = {}
+        while True:
+            self._acquire(estimated_tokens, 1)
+            started = False
+            released = False
+            actual_tokens = None
+            try:
+                for chunk in make_iterator():
+                    started = True
+                    if count_tokens:
+                        actual_tokens = count_tokens(chunk) or actual_tokens
+                    yield chunk
+            except Exception as e:
+                released = True
+                self._release(estimated_tokens, None, is_rate_limit_error(e))
+                delay = None if started else self._retry_delay(e, retries)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            finally:
+                # 正常结束，或调用方提前关闭生成器
+                if not released:
+                    self._release(estimated_tokens, actual_tokens, False)
+            return
+
+    def stats(self) -> dict:
+        return {"limit": int(self.concurrency.limit), "in_flight": self.concurrency.in_flight}
+
+
+def estimate_tokens(text_length: int) -> int:
+    """按字符数粗略估算令牌数（中文约每2个字符一个令牌）"""
+    return max(1, math.ceil(text_length / 2))
+
+
+# 服务名 -> 对话模型限流器，各服务的额度和自适应并发互不影响
+chat_limiters = {}
+_chat_limiters_lock = threading.Lock()
+
+
+def get_chat_limiter(provider: str) -> ProviderRateLimiter:
+    """获取（必要时创建）指定服务的对话模型限流器，同一服务的不同模型共用额度"""
+    with _chat_limiters_lock:
+        limiter = chat_limiters.get(provider)
+        if limiter is None:
+            limiter = ProviderRateLimiter(
+                f"llm.{provider}", Config.LLM_REQUESTS_PER_MINUTE, Config.LLM_TOKENS_PER_MINUTE,
+                Config.LLM_CONCURRENCY, Config.LLM_MIN_CONCURRENCY, Config.LLM_MAX_CONCURRENCY,
+                Config.LLM_RATE_LIMIT_RETRIES, Config.LLM_TRANSIENT_RETRIES,
+            )
+            chat_limiters[provider] = limiter
+        return limiter
+
+
+embedding_limiter = ProviderRateLimiter(
+    "embedding", Config.EMBEDDING_REQUESTS_PER_MINUTE, Config.EMBEDDING_TOKENS_PER_MINUTE,
+    Config.EMBEDDING_CONCURRENCY, Config.LLM_MIN_CONCURRENCY, Config.EMBEDDING_MAX_CONCURRENCY,
+    Config.LLM_RATE_LIMIT_RETRIES, Config.LLM_TRANSIENT_RETRIES,
+)
+
+
+def collect_rate_limit_metrics() -> list:
+    lines = format_header("llm_concurrency_limit", "Current adaptive concurrency limit for LLM provider calls", "gauge")
+    limiters = [*chat_limiters.values(), embedding_limiter]
+    for limiter in limiters:
+        lines.append(format_sample("llm_concurrency_limit", limiter.stats()["limit"], {"client": limiter.name}))
+    lines.extend(format_header("llm_in_flight", "LLM provider calls currently in flight", "gauge"))
+    for limiter in limiters:
+        lines.append(format_sample("llm_in_flight", limiter.stats()["in_flight"], {"client": limiter.name}))
+    return lines
+
+
+registry.register_collector(collect_rate_limit_metrics)
@@ -0,0 +1,96 @@
+"""OpenTelemetry 链路追踪
+
+Config.TRACING_EXPORTER 选择导出方式：
+- none: 不导出（默认），span 为空操作，几乎没有开销；
+- console: 输出到标准输出；
+- file: 每个 span 一行JSON写入 Config.TRACING_FILE，便于离线分析；
+- otlp: 通过 OTLP/gRPC 导出，地址由 OTEL_EXPORTER_OTLP_ENDPOINT 环境变量指定。
+"""
+import functools
+import json
+import logging
+import os
+import threading
+from typing import Optional, Sequence
+from opentelemetry import trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import ReadableSpan, TracerProvider
+from opentelemetry.sdk.trace.export import (BatchSpanProcessor, ConsoleSpanExporter, SimpleSpanProcessor,
+                                            SpanExporter, SpanExportResult)
+from .config import Config
+
+logger = logging.getLogger(__name__)
+
+tracer = trace.get_tracer("myagent")
+
+
+class JsonLinesFileExporter(SpanExporter):
+    """将 span 以JSON行的形式追加写入本地文件"""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        try:
+            with self._lock:
+                for span in spans:
+                    self._file.write(json.dumps(json.loads(span.to_json()), ensure_ascii=False) + "\n")
+                self._file.flush()
+            return SpanExportResult.SUCCESS
+        except Exception as e:
+            logger.error(f"Failed to export spans to file: {e}")
+            return SpanExportResult.FAILURE
+
+    def shutdown(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+def setup_tracing(app=None, exporter: str = Config.TRACING_EXPORTER) -> Optional[TracerProvider]:
+    """初始化全局 TracerProvider，传入 FastAPI 应用时为其开启HTTP请求追踪"""
+    if exporter == "none":
+        return None
+    if exporter == "console":
+        processor = SimpleSpanProcessor(ConsoleSpanExporter())
+    elif exporter == "file":
+        processor = BatchSpanProcessor(JsonLinesFileExporter(Config.TRACING_FILE))
+    elif exporter == "otlp":
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+        processor = BatchSpanProcessor(OTLPSpanExporter())
+    else:
+        raise ValueError(f"不支持的追踪导出方式: {exporter}. 可用的方式: ['none', 'console', 'file', 'otlp']")
+
+    provider = TracerProvider(resource=Resource.create({"service.name": Config.TRACING_SERVICE_NAME}))
+    provider.add_span_processor(processor)
+    trace.set_tracer_provider(provider)
+    if app is not None:
+        from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
+        FastAPIInstrumentor.instrument_app(app, excluded_urls="metrics")
+    logger.info(f"Tracing enabled with {exporter} exporter")
+    return provider
+
+
+def shutdown_tracing(provider: Optional[TracerProvider]) -> None:
+    """导出缓冲中剩余的 span"""
+    if provider is not None:
+        provider.shutdown()
+
+
+def traced(name: str):
+    """为函数调用创建一个 span，函数抛出异常时记录到 span 上"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with tracer.start_as_current_span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def set_span_attributes(**attributes) -> None:
+    """为当前 span 设置属性，没有活动的 span 时为空操作"""
+    span = trace.get_current_span()
+    if span.is_recording():
+        span.set_attributes({key: value for key, value in attributes.items() if value is not None})